@@ -3,6 +3,6 @@
 Reading SDM (meta)data with Python
 """
 
-from .sdmreader import read_bdf, calc_uvw, read_metadata, BDFData
+from .sdmreader import read_bdf, read_autos, iter_bdf, follow_bdf, read_bdfs, find_integrations, plan_shards, open_shard, read_shard, calc_uvw, calc_uvw_scan, UVWSession, read_metadata, BDFData
 
 
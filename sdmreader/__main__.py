@@ -0,0 +1,10 @@
+# Copyright 2014 Casey Law <caseyjlaw@gmail.com> and collaborators.
+# Licensed under GNU GPL v2.
+
+""" python -m sdmreader runs the sdmreader command (see cli module).
+"""
+
+import sys
+from .cli import main
+
+sys.exit(main())
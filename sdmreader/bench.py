@@ -0,0 +1,246 @@
+# Copyright 2014 Casey Law <caseyjlaw@gmail.com> and collaborators.
+# Licensed under GNU GPL v2.
+
+""" bench -- benchmarks of the sdmreader read paths
+
+Times each stage (read_metadata, BDFData parse with and without cached index, get_data,
+read_bdf, iter_bdf with and without prefetch, calc_uvw_scan and, if CASA is available, calc_uvw) on a synthetic SDM
+from the synth module or on a given SDM. Each stage runs in a forked process, so peak RSS
+is measured per stage. Reports MB/s, microseconds per integration and peak RSS.
+
+Data is read through the page cache, so the first repeat of a stage may include disk reads
+and the best of the repeats is reported.
+
+> python -m sdmreader.bench --nants 27 --nchans 64 --nspws 16 --nints 200
+> python -m sdmreader.bench --sdm /path/to/sdm --scan 3 --json results.json
+"""
+
+import os, sys, time, json, shutil, tempfile, argparse, logging
+import multiprocessing
+from . import sdmreader, synth
+
+logger = logging.getLogger(__name__)
+
+def run(sdmfile, scan, repeat=3, stages=None):
+    """ Runs benchmark stages on scan of sdmfile.
+    stages is list of stage names (default all in stagenames).
+    Returns list of result dicts with stage, seconds, nbytes, nints, mbps, usperint, peakrss and deltarss (MB).
+    Stages that cannot run (e.g., calc_uvw without CASA) are left out.
+    """
+
+    metadata = sdmreader.read_metadata(sdmfile, cachedir='')
+    workdir = tempfile.mkdtemp()
+    results = []
+    try:
+        for stage in stages or stagenames:
+            best = None
+            for i in range(repeat):
+                result = _run_forked(_stages[stage], sdmfile, scan, metadata, workdir)
+                if result is None:
+                    break
+                if best is None or result['seconds'] < best['seconds']:
+                    best = result
+            if best is None:
+                logger.info('Skipping stage %s' % stage)
+                continue
+
+            best['stage'] = stage
+            best['mbps'] = best['nbytes']/1e6/best['seconds'] if best['seconds'] else float('inf')
+            best['usperint'] = 1e6*best['seconds']/best['nints'] if best['nints'] else float('nan')
+            results.append(best)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+def report(results, fp=sys.stdout):
+    """ Writes table of benchmark results.
+    """
+
+    fp.write('%-16s %10s %10s %12s %10s %10s\n' % ('stage', 'ms', 'MB/s', 'us/int', 'peak MB', 'delta MB'))
+    for result in results:
+        fp.write('%-16s %10.2f %10.1f %12.2f %10.1f %10.1f\n' % (result['stage'], 1e3*result['seconds'], result['mbps'],
+                                                                 result['usperint'], result['peakrss'], result['deltarss']))
+
+def _run_forked(stage, sdmfile, scan, metadata, workdir):
+    """ Runs stage in a forked process and returns its result dict.
+    stage(sdmfile, scan, metadata, workdir) does any setup and returns the function to time,
+    which returns (nbytes, nints) or None if it cannot run.
+    """
+
+    recv, send = multiprocessing.Pipe(duplex=False)
+
+    def target():
+        try:
+            func = stage(sdmfile, scan, metadata, workdir)
+            _reset_peakrss()
+            startrss = _rss('VmRSS')
+            t0 = time.time()
+            out = func()
+            seconds = time.time() - t0
+            if out is None:
+                send.send(None)
+            else:
+                peak = _rss('VmHWM')
+                send.send({'seconds': seconds, 'nbytes': out[0], 'nints': out[1], 'peakrss': peak, 'deltarss': peak - startrss})
+        except Exception as exc:
+            logger.warn('Stage %s failed: %s' % (stage.__name__, exc))
+            send.send(None)
+
+    proc = multiprocessing.Process(target=target)
+    proc.start()
+    result = recv.recv()
+    proc.join()
+
+    return result
+
+def _reset_peakrss():
+    """ Resets peak RSS of this process, if the kernel allows it.
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except (IOError, OSError):
+        pass
+
+def _rss(field):
+    """ Memory use of this process in MB from /proc (VmRSS or VmHWM), or peak from getrusage.
+    """
+
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])/1024.
+    except IOError:
+        pass
+
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+def _bdf(sdmfile, scan, metadata, cachedir=''):
+    scans, bdf = sdmreader._open_bdf(sdmfile, scan, cachedir=cachedir, metadata=metadata)
+    return bdf
+
+# each stage does its setup and returns the function that is timed
+
+def stage_read_metadata(sdmfile, scan, metadata, workdir):
+    sdmreader._metadatacache.clear()
+    nbytes = sum([os.path.getsize(os.path.join(sdmfile, table)) for table in sdmreader._metadatatables
+                  if os.path.exists(os.path.join(sdmfile, table))])
+
+    def func():
+        scandict, sourcedict = sdmreader.read_metadata(sdmfile, cachedir='')
+        return nbytes, len(scandict)
+    return func
+
+def stage_parse(sdmfile, scan, metadata, workdir):
+    def func():
+        bdf = _bdf(sdmfile, scan, metadata)
+        return os.path.getsize(bdf.fp.name), bdf.n_integrations
+    return func
+
+def stage_parse_cached(sdmfile, scan, metadata, workdir):
+    cachedir = os.path.join(workdir, 'cache')
+    _bdf(sdmfile, scan, metadata, cachedir=cachedir)    # fills cache
+
+    def func():
+        bdf = _bdf(sdmfile, scan, metadata, cachedir=cachedir)
+        return os.path.getsize(bdf.fp.name), bdf.n_integrations
+    return func
+
+def stage_get_data(sdmfile, scan, metadata, workdir):
+    bdf = _bdf(sdmfile, scan, metadata)
+
+    def func():
+        for i in xrange(bdf.n_integrations):
+            bdf.get_data('crossData.bin', i)
+        return bdf.n_integrations*bdf.sizeinfo['crossData.bin'], bdf.n_integrations
+    return func
+
+def stage_read_bdf(sdmfile, scan, metadata, workdir):
+    def func():
+        data = sdmreader.read_bdf(sdmfile, scan, cachedir='', metadata=metadata)
+        return data.nbytes, len(data)
+    return func
+
+def stage_read_bdf_view(sdmfile, scan, metadata, workdir):
+    def func():
+        data = sdmreader.read_bdf(sdmfile, scan, cachedir='', metadata=metadata, copy=False)
+        data.sum()      # touch all data
+        return data.nbytes, len(data)
+    return func
+
+def stage_iter_bdf(sdmfile, scan, metadata, workdir):
+    def func():
+        nbytes = nints = 0
+        for ints, mjds, data in sdmreader.iter_bdf(sdmfile, scan, chunk_ints=16, cachedir='', metadata=metadata):
+            nbytes += data.nbytes
+            nints += len(ints)
+        return nbytes, nints
+    return func
+
+def stage_iter_bdf_prefetch(sdmfile, scan, metadata, workdir):
+    def func():
+        nbytes = nints = 0
+        for ints, mjds, data in sdmreader.iter_bdf(sdmfile, scan, chunk_ints=16, cachedir='', metadata=metadata, prefetch=4):
+            nbytes += data.nbytes
+            nints += len(ints)
+        return nbytes, nints
+    return func
+
+def stage_calc_uvw_scan(sdmfile, scan, metadata, workdir):
+    def func():
+        uvw = sdmreader.calc_uvw_scan(sdmfile, scan, cachedir='', metadata=metadata)
+        return uvw.nbytes, len(uvw)
+    return func
+
+def stage_calc_uvw(sdmfile, scan, metadata, workdir):
+    def func():
+        uvw = sdmreader.calc_uvw(sdmfile, scan, metadata=metadata)
+        if uvw is None:
+            return None
+        return 3*uvw[0].nbytes, 1
+    return func
+
+stagenames = ['read_metadata', 'parse', 'parse_cached', 'get_data', 'read_bdf', 'read_bdf_view', 'iter_bdf',
+              'iter_bdf_prefetch', 'calc_uvw_scan', 'calc_uvw']
+_stages = dict((name, globals()['stage_' + name]) for name in stagenames)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark sdmreader read paths on a synthetic or given SDM.')
+    parser.add_argument('--sdm', help='SDM to read. Default is a synthetic SDM in a temporary directory.')
+    parser.add_argument('--scan', type=int, default=1, help='Scan to read')
+    parser.add_argument('--nants', type=int, default=10)
+    parser.add_argument('--nchans', type=int, default=64, help='Channels per spw')
+    parser.add_argument('--nspws', type=int, default=4)
+    parser.add_argument('--npols', type=int, default=4, choices=[1, 2, 4])
+    parser.add_argument('--nints', type=int, default=200)
+    parser.add_argument('--irregular', action='store_true', help='Write BDF with varying integration spacing')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', choices=stagenames, help='Stages to run (default all)')
+    parser.add_argument('--json', help='Also write results to this json file')
+    args = parser.parse_args(argv)
+
+    tmpdir = None
+    sdmfile = args.sdm
+    if not sdmfile:
+        tmpdir = tempfile.mkdtemp()
+        sdmfile = synth.write_sdm(os.path.join(tmpdir, 'bench.sdm'), nscans=1, nants=args.nants, nchans=[args.nchans]*args.nspws,
+                                  pols=['RR', 'RL', 'LR', 'LL'][:args.npols] if args.npols != 2 else ['RR', 'LL'],
+                                  nints=args.nints, irregular=args.irregular)
+
+    try:
+        results = run(sdmfile, args.scan, repeat=args.repeat, stages=args.stages)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+# Copyright 2014 Casey Law <caseyjlaw@gmail.com> and collaborators.
+# Licensed under GNU GPL v2.
+
+""" cache -- on-disk caches of BDF indexes and SDM metadata
+
+An index file holds only the numbers BDFData needs to read a bdf without
+scanning it (blob offsets and sizes, integration times, dimensions, pol
+products). It is keyed by the absolute path of the bdf and checked against the
+size and mtime of the bdf when read, so a changed bdf is parsed again.
+
+Index files live in a cache directory that defaults to $SDMREADER_CACHE or
+~/.cache/sdmreader. Setting SDMREADER_CACHE to an empty string turns caching
+off. The directory is kept under a size cap (default $SDMREADER_CACHE_SIZE or
+100 MB) by removing the least recently used files. If the directory cannot be
+written (e.g., a read-only home directory), the first failure for it is logged
+as a warning and later ones only at debug level.
+
+File format is a magic line with the format version, one line of json with the
+scalars and then the raw little-endian arrays in the order listed in the json.
+
+Metadata files hold the (scandict, sourcedict) of read_metadata as json, with
+the scan and source numbers made ints again when read. They are keyed by the
+path of the SDM and the sizes and mtimes of the tables it was parsed from, so
+editing a table makes a new key.
+"""
+
+import numpy as np
+import os, re, json, time, hashlib, logging
+
+logger = logging.getLogger(__name__)
+
+version = 4
+magic = 'SDMRIDX %d\n' % version
+defaultsize = 100*1024**2
+tmpage = 3600.          # seconds after which a .tmp file is left over from a failed write
+_cachefile = re.compile(r'^([0-9a-f]{40}\.(idx|meta)|tmp\w+\.tmp)$')
+_unwritable = set()     # cache directories that failed a write, which was logged as a warning
+
+def get_cachedir(cachedir=None):
+    """ Returns cache directory to use, or '' if caching is off.
+    cachedir=None uses $SDMREADER_CACHE or ~/.cache/sdmreader.
+    """
+
+    if cachedir is None:
+        cachedir = os.environ.get('SDMREADER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'sdmreader'))
+
+    return cachedir or ''
+
+def get_maxsize():
+    """ Returns size cap of cache directory in bytes.
+    """
+
+    return int(os.environ.get('SDMREADER_CACHE_SIZE', defaultsize))
+
+def read_index(cachedir, path):
+    """ Reads cached index for bdf at path.
+    Returns state dict for BDFData, or None if there is no valid index.
+    """
+
+    path = os.path.abspath(path)
+    idxname = _idxname(cachedir, path)
+    try:
+        with open(idxname, 'rb') as fp:
+            buf = fp.read()
+    except IOError:
+        return None
+
+    try:
+        assert buf.startswith(magic), 'unknown index version'
+        end = buf.index('\n', len(magic))
+        state = json.loads(buf[len(magic):end])
+
+        st = os.stat(path)
+        if state['path'] != path or state['size'] != st.st_size or state['mtime'] != st.st_mtime:
+            logger.info('Cached index for %s is stale.' % path)
+            return None
+
+        # arrays follow the json, in order
+        pos = end + 1
+        for name, dtype, n in state.pop('arrays'):
+            arr = np.frombuffer(buf, dtype=dtype, count=n, offset=pos)
+            pos += arr.nbytes
+            if '/' in name:
+                name, kind = name.split('/', 1)
+                state.setdefault(name, {})[kind] = arr
+            else:
+                state[name] = arr
+    except Exception as exc:
+        logger.warn('Could not read cached index %s (%s). Ignoring it.' % (idxname, exc))
+        return None
+
+    # mark as recently used
+    try:
+        os.utime(idxname, None)
+    except OSError:
+        pass
+
+    return state
+
+def write_index(cachedir, path, state):
+    """ Writes index for bdf at path from BDFData state dict.
+    Arrays go in raw form after the json of the scalars.
+    Returns True if written.
+    """
+
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    header = {'path': path, 'size': st.st_size, 'mtime': st.st_mtime, 'arrays': []}
+    arrays = []
+    for name, value in sorted(state.iteritems()):
+        if isinstance(value, np.ndarray):
+            arrays.append((name, value))
+        elif isinstance(value, dict) and value and all(isinstance(v, np.ndarray) for v in value.itervalues()):
+            arrays += [(name + '/' + kind, value[kind]) for kind in sorted(value)]
+        else:
+            header[name] = value
+
+    for name, arr in arrays:
+        header['arrays'].append((name, arr.dtype.newbyteorder('<').str, len(arr)))
+
+    import tempfile
+    try:
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        fd, tmpname = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(magic)
+            fp.write(json.dumps(header) + '\n')
+            for name, arr in arrays:
+                fp.write(np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('<')).tostring())
+        os.rename(tmpname, _idxname(cachedir, path))
+    except (IOError, OSError) as exc:
+        _write_failed(cachedir, 'Could not write index for %s to cache %s (%s).' % (path, cachedir, exc))
+        return False
+
+    logger.debug('Wrote index for %s to cache %s.' % (path, cachedir))
+    evict(cachedir)
+    return True
+
+def read_metadata(cachedir, key):
+    """ Reads cached metadata for key made by metadata_key.
+    Returns tuple (scandict, sourcedict) or None if not cached.
+    """
+
+    metaname = os.path.join(cachedir, hashlib.sha1(key).hexdigest() + '.meta')
+    try:
+        with open(metaname, 'rb') as fp:
+            stored = json.load(fp)
+        storedkey = stored['key']
+        metadata = (dict((int(scan), info) for scan, info in stored['scans'].iteritems()),
+                    dict((int(source), info) for source, info in stored['sources'].iteritems()))
+    except IOError:
+        return None
+    except Exception as exc:
+        logger.warn('Could not read cached metadata %s (%s). Ignoring it.' % (metaname, exc))
+        return None
+
+    if storedkey != key:
+        return None
+
+    try:
+        os.utime(metaname, None)
+    except OSError:
+        pass
+
+    return metadata
+
+def write_metadata(cachedir, key, metadata):
+    """ Writes metadata tuple (scandict, sourcedict) for key made by metadata_key.
+    Returns True if written.
+    """
+
+    import tempfile
+    scandict, sourcedict = metadata
+    try:
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        fd, tmpname = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            json.dump({'key': key, 'scans': scandict, 'sources': sourcedict}, fp)
+        os.rename(tmpname, os.path.join(cachedir, hashlib.sha1(key).hexdigest() + '.meta'))
+    except (IOError, OSError, ValueError) as exc:
+        _write_failed(cachedir, 'Could not write metadata for %s to cache %s (%s).' % (key.split('\n')[0], cachedir, exc))
+        return False
+
+    evict(cachedir)
+    return True
+
+def _write_failed(cachedir, message):
+    """ Logs failed write to cachedir as a warning the first time for cachedir, later at debug level.
+    """
+
+    if cachedir in _unwritable:
+        logger.debug(message)
+    else:
+        _unwritable.add(cachedir)
+        logger.warn(message + ' Further failures to write this cache are logged at debug level.')
+
+def metadata_key(sdmfile, bdfdir, tables):
+    """ Key for metadata of sdmfile parsed from list of table files.
+    Uses size and mtime of each table and of bdfdir, since bdfs found there are part of the metadata.
+    """
+
+    lines = [os.path.abspath(sdmfile), os.path.abspath(bdfdir)]
+    for name in [bdfdir] + [os.path.join(sdmfile, table) for table in tables]:
+        try:
+            st = os.stat(name)
+            lines.append('%s %d %r' % (os.path.basename(name), st.st_size, st.st_mtime))
+        except OSError:
+            lines.append('%s missing' % os.path.basename(name))
+
+    return '\n'.join(lines)
+
+def evict(cachedir, maxsize=None):
+    """ Removes least recently used files until cache is under maxsize bytes.
+    Only index and metadata files written by this module count, and .tmp files
+    of writes that are older than tmpage. Other files in cachedir are left alone.
+    """
+
+    if maxsize is None:
+        maxsize = get_maxsize()
+
+    entries = []
+    now = time.time()
+    for name in os.listdir(cachedir):
+        if not _cachefile.match(name):
+            continue
+        try:
+            st = os.stat(os.path.join(cachedir, name))
+        except OSError:
+            continue
+        if name.endswith('.tmp') and now - st.st_mtime < tmpage:
+            continue        # write in progress
+        entries.append((st.st_mtime, st.st_size, name))
+
+    total = sum([entry[1] for entry in entries])
+    for mtime, size, name in sorted(entries):
+        if total <= maxsize:
+            break
+        try:
+            os.remove(os.path.join(cachedir, name))
+            total -= size
+            logger.debug('Evicted %s from cache %s.' % (name, cachedir))
+        except OSError:
+            pass
+
+def _idxname(cachedir, path):
+    """ Name of index file in cachedir for bdf at (absolute) path.
+    """
+
+    return os.path.join(cachedir, hashlib.sha1(path).hexdigest() + '.idx')
@@ -0,0 +1,351 @@
+# Copyright 2014 Casey Law <caseyjlaw@gmail.com> and collaborators.
+# Licensed under GNU GPL v2.
+
+""" cli -- command-line extraction of scans from an SDM
+
+select_scans -- scan numbers of metadata matching scan numbers, intents and source names.
+extract -- reads scans with a pool of worker processes and writes them to .npy files.
+main -- the sdmreader command (also python -m sdmreader).
+
+Scans are split into tasks of chunk_ints integrations. The parent parses the bdfs
+and creates the output files, then forks the workers, which inherit both. Tasks go
+to the workers through a bounded queue and workers report each finished task on
+another bounded queue. No data passes through the queues: workers write straight
+into the output files. Progress (integrations/s and MB/s of bdf data) is reported
+as tasks finish.
+
+Output files in outdir, per scan:
+scan<N>.npy -- data of shape (nints, nbl, nchan, npol) after selection and averaging,
+    complex64 or dtype with an axis of (real, imag) as from read_bdf.
+scan<N>_times.npy -- mjd of each output integration (middle of each time bin with tavg).
+scan<N>_flags.npy -- booleans of shape (nints, nbl, nchan, npol) with flags='mask' (True is flagged).
+extract.json -- sdm, options and, per scan, the shape, dtype and files written.
+
+> sdmreader /data/sdm --list
+> sdmreader /data/sdm --intent TARGET --spws 0 1 --tavg 10 --favg 4 --workers 8 --outdir out
+"""
+
+import numpy as np
+import os, sys, time, json, fnmatch, argparse, logging
+from . import sdmreader, stats
+
+logger = logging.getLogger(__name__)
+
+def select_scans(metadata, scans=None, intents=None, sources=None):
+    """ Sorted scan numbers of metadata (scandict, sourcedict) matching all given criteria.
+    scans is list of scan numbers. intents is list of strings, one of which must be in the
+    scan intent (case is ignored). sources is list of source names or shell patterns (e.g., 'J19*').
+    Scans without bdf are left out.
+    """
+
+    scandict = metadata[0]
+    selected = []
+    for scan in sorted(scandict):
+        info = scandict[scan]
+        if scans and scan not in scans:
+            continue
+        if intents and not any([intent.upper() in (info.get('intent') or '').upper() for intent in intents]):
+            continue
+        if sources and not any([fnmatch.fnmatchcase(str(info.get('source')), pattern) for pattern in sources]):
+            continue
+        if not info.get('bdfstr'):
+            logger.warn('Scan %d has no bdf. Skipping it.' % scan)
+            continue
+        selected.append(scan)
+
+    return selected
+
+def extract(sdmpath, scans, outdir, workers=4, queue=8, chunk_ints=100, tavg=1, favg=1, flags='none',
+            dtype=None, layout='interleaved', scale=None, selection=None, bdfdir=None, cachedir=None,
+            metadata=None, progress=None):
+    """ Reads scans of sdmpath and writes them to outdir (see module docstring).
+    workers processes read tasks of chunk_ints integrations (rounded up to whole tavg bins),
+    with at most queue tasks waiting in each queue. workers=1 (or 0) reads in this process.
+    selection is dict of spws, chans, bls, ants and pols as taken by read_bdf.
+    tavg and favg average as in read_bdf and dtype, layout and scale convert as in read_bdf,
+    but not both. flags is 'none', 'zero' (flagged data set to zero; with averaging, bins with
+    all samples flagged) or 'mask' (flags written to a file).
+    progress is optional function called as progress(ints, totalints, nbytes, seconds) after each task.
+    Returns summary dict as written to extract.json, with stats of the workers (see stats module).
+    """
+
+    assert flags in ('none', 'zero', 'mask'), 'flags must be "none", "zero" or "mask"'
+    averaging = tavg > 1 or favg > 1
+    if averaging and (dtype is not None or layout != 'interleaved' or scale is not None):
+        raise ValueError('dtype, layout and scale cannot be used with tavg or favg')
+    if not metadata:
+        metadata = sdmreader.read_metadata(sdmpath, bdfdir=bdfdir, cachedir=cachedir)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    chunk_ints = tavg*int(np.ceil(chunk_ints/float(tavg)))
+    opts = {'tavg': tavg, 'favg': favg, 'flags': flags, 'layout': layout, 'scale': scale}
+    summary = {'sdm': os.path.abspath(sdmpath), 'options': dict(opts, dtype=dtype, selection=selection or {}), 'scans': {}}
+
+    # parse bdfs and create outputs in parent, so workers inherit them
+    jobs = []; tasks = []
+    for scan in scans:
+        job = _make_job(sdmpath, scan, outdir, opts, dtype, selection or {}, bdfdir, cachedir, sdmreader._select_scan(metadata, scan))
+        nints = job['nints']
+        tasks += [(len(jobs), start, min(start+chunk_ints, nints)) for start in xrange(0, nints, chunk_ints)]
+        summary['scans'][str(scan)] = job['entry']
+        jobs.append(job)
+
+    totalints = sum([job['nints'] for job in jobs])
+    logger.info('Extracting %d ints of %d scans in %d tasks with %d workers' % (totalints, len(scans), len(tasks), workers))
+
+    global _jobs
+    _jobs = jobs
+    merged = stats.Stats()
+    t0 = time.time()
+    done = [0, 0]     # ints and bdf bytes
+
+    def finished(i, nints, nbytes):
+        done[0] += nints
+        done[1] += nbytes
+        if progress:
+            progress(done[0], totalints, done[1], time.time() - t0)
+
+    try:
+        if workers > 1 and len(tasks) > 1:
+            _run_pool(tasks, min(workers, len(tasks)), queue, finished, merged)
+        else:
+            with stats.collect() as collected:
+                for task in tasks:
+                    finished(*_extract_task(task))
+            _merge_stats(merged, collected.as_dict())
+    finally:
+        _jobs = None
+
+    for job in jobs:
+        job['data'].flush()
+        if job['flags'] is not None:
+            job['flags'].flush()
+
+    seconds = time.time() - t0
+    summary.update({'ints': done[0], 'bytes': done[1], 'seconds': seconds,
+                    'ints_per_s': done[0]/seconds if seconds else 0., 'mb_per_s': done[1]/1e6/seconds if seconds else 0.})
+    with open(os.path.join(outdir, 'extract.json'), 'w') as fp:
+        json.dump(summary, fp, indent=1, sort_keys=True)
+    summary['stats'] = merged
+
+    return summary
+
+_jobs = None
+
+def _make_job(sdmpath, scan, outdir, opts, dtype, selection, bdfdir, cachedir, metadata):
+    """ Opens bdf of scan and creates its output files. Returns job dict for _extract_task.
+    """
+
+    scans, bdf = sdmreader._open_bdf(sdmpath, scan, bdfdir=bdfdir, cachedir=cachedir, metadata=metadata)
+    sel = bdf.selection(**selection)
+    tavg, favg = opts['tavg'], opts['favg']
+    nints = bdf.n_integrations - bdf.n_integrations % tavg
+    nbl, nchan, npol = bdf.get_shape('crossData.bin', sel)
+    flagshape = (nints//tavg, nbl, nchan//favg, npol)
+    if tavg > 1 or favg > 1:
+        shape = flagshape
+    else:
+        shape = bdf.get_outshape('crossData.bin', nints, sel, dtype, opts['layout'])
+
+    names = {'data': 'scan%d.npy' % scan, 'times': 'scan%d_times.npy' % scan}
+    data = np.lib.format.open_memmap(os.path.join(outdir, names['data']), mode='w+', dtype=dtype or 'complex64', shape=shape)
+    flags = None
+    if opts['flags'] == 'mask':
+        names['flags'] = 'scan%d_flags.npy' % scan
+        flags = np.lib.format.open_memmap(os.path.join(outdir, names['flags']), mode='w+', dtype=bool, shape=flagshape)
+
+    mjds = sdmreader._int_times(bdf, scans[scan])
+    np.save(os.path.join(outdir, names['times']), mjds[:nints].reshape(-1, tavg).mean(axis=1))
+
+    pols = [bdf.crosspols[i] for i in np.arange(len(bdf.crosspols))[sel[2]]]
+    entry = {'shape': list(shape), 'dtype': str(data.dtype), 'files': names, 'pols': pols}
+    return {'bdf': bdf, 'sel': sel, 'nints': nints, 'data': data, 'flags': flags, 'opts': opts, 'entry': entry}
+
+def _extract_task(task):
+    """ Reads integrations start to stop of job i into its outputs.
+    Returns (i, nints, nbytes) with bytes of bdf data read.
+    """
+
+    i, start, stop = task
+    job = _jobs[i]
+    bdf, sel, opts = job['bdf'], job['sel'], job['opts']
+    tavg = opts['tavg']
+
+    if tavg > 1 or opts['favg'] > 1:
+        out = job['data'][start//tavg:stop//tavg]
+        result = bdf.average(start, stop, tavg=tavg, favg=opts['favg'], sel=sel, flags=opts['flags'] != 'none', out=out)
+        if job['flags'] is not None:
+            job['flags'][start//tavg:stop//tavg] = result[1] == 0
+    else:
+        out = job['data'][:, start:stop] if opts['layout'] == 'planar' else job['data'][start:stop]
+        bdf.read('crossData.bin', start, stop, out=out, sel=sel, layout=opts['layout'], scale=opts['scale'])
+        if opts['flags'] == 'zero':
+            sdmreader._apply_flags(out, bdf.get_flags(start, stop, sel=sel), 'zero', layout=opts['layout'])
+        elif job['flags'] is not None:
+            job['flags'][start:stop] = bdf.get_flags(start, stop, sel=sel)
+
+    return i, stop - start, (stop - start)*bdf.sizeinfo['crossData.bin']
+
+def _run_pool(tasks, workers, queue, finished, merged):
+    """ Runs tasks in forked worker processes, feeding them through a task queue of at most queue
+    tasks and calling finished(i, nints, nbytes) as they report back. Adds worker stats to merged.
+    """
+
+    import multiprocessing, Queue
+    taskq = multiprocessing.Queue(queue)
+    resultq = multiprocessing.Queue(queue)
+    procs = [multiprocessing.Process(target=_worker, args=(taskq, resultq)) for i in range(workers)]
+    for proc in procs:
+        proc.daemon = True
+        proc.start()
+
+    try:
+        nsent = ndone = nstats = 0
+        while nstats < workers:
+            # keep task queue full, then stop workers once all tasks are done
+            while nsent < len(tasks):
+                try:
+                    taskq.put(tasks[nsent], block=False)
+                    nsent += 1
+                except Queue.Full:
+                    break
+            if ndone == len(tasks) and nsent == len(tasks):
+                for proc in procs:
+                    taskq.put(None)
+                nsent += 1
+
+            try:
+                message = resultq.get(timeout=1.)
+            except Queue.Empty:
+                if [proc for proc in procs if proc.exitcode]:
+                    raise RuntimeError('extract worker died')
+                continue
+
+            if message[0] == 'done':
+                ndone += 1
+                finished(*message[1:])
+            elif message[0] == 'stats':
+                nstats += 1
+                _merge_stats(merged, message[1])
+            else:
+                raise RuntimeError('extract worker failed on task %s:\n%s' % message[1:])
+    finally:
+        for proc in procs:
+            if proc.is_alive() and nstats < workers:
+                proc.terminate()
+            proc.join()
+
+def _worker(taskq, resultq):
+    """ Runs tasks from taskq until it gets None, then sends its stats. Runs in worker process.
+    """
+
+    import traceback
+    collected = stats.enable()
+    while True:
+        task = taskq.get()
+        if task is None:
+            break
+        try:
+            resultq.put(('done',) + _extract_task(task))
+        except Exception:
+            resultq.put(('error', task, traceback.format_exc()))
+            return
+    stats.disable(collected)
+    resultq.put(('stats', collected.as_dict()))
+
+def _merge_stats(merged, collected):
+    """ Adds stats dict collected (from Stats.as_dict) to Stats object merged.
+    """
+
+    for key in ('times', 'calls', 'counts'):
+        for name, value in collected[key].iteritems():
+            getattr(merged, key)[name] += value
+
+class _Progress(object):
+    """ Writes progress of extract to stream fp at most every interval seconds, on one line if fp is a terminal.
+    """
+
+    def __init__(self, fp=sys.stderr, interval=1.):
+        self.fp = fp
+        self.interval = interval
+        self.last = 0.
+        self.tty = hasattr(fp, 'isatty') and fp.isatty()
+
+    def __call__(self, ints, totalints, nbytes, seconds):
+        if ints < totalints and seconds - self.last < self.interval:
+            return
+        self.last = seconds
+        line = '%d/%d ints  %10.1f ints/s  %8.1f MB/s' % (ints, totalints, ints/seconds if seconds else 0.,
+                                                          nbytes/1e6/seconds if seconds else 0.)
+        self.fp.write(('\r' + line + ('\n' if ints >= totalints else '')) if self.tty else line + '\n')
+        self.fp.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='sdmreader', description='Extract scans of an SDM to .npy files with a pool of worker processes.')
+    parser.add_argument('sdm', help='SDM directory')
+    parser.add_argument('--outdir', help='Directory for output files (needed unless --list)')
+    parser.add_argument('--list', action='store_true', help='List selected scans and exit')
+    group = parser.add_argument_group('scan selection (all given must match)')
+    group.add_argument('--scans', type=int, nargs='+', help='Scan numbers')
+    group.add_argument('--intent', nargs='+', help='Scan intents (substrings, e.g., TARGET)')
+    group.add_argument('--source', nargs='+', help='Source names or shell patterns')
+    group = parser.add_argument_group('data selection and output')
+    group.add_argument('--spws', type=int, nargs='+', help='Spw numbers (0-based, in bdf order)')
+    group.add_argument('--chans', help='Channel range start:stop over the selected spws')
+    group.add_argument('--ants', type=int, nargs='+', help='Antenna numbers (baselines between them)')
+    group.add_argument('--bls', type=int, nargs='+', help='Baseline numbers')
+    group.add_argument('--pols', nargs='+', help='Pol products (e.g., RR LL)')
+    group.add_argument('--tavg', type=int, default=1, help='Integrations per time bin')
+    group.add_argument('--favg', type=int, default=1, help='Channels per frequency bin')
+    group.add_argument('--flags', default='none', choices=['none', 'zero', 'mask'], help='Zero flagged data or write flag files')
+    group.add_argument('--dtype', choices=['complex64', 'complex128', 'float32', 'float16', 'int16'], help='Output dtype')
+    group.add_argument('--layout', default='interleaved', choices=['interleaved', 'planar'], help='Layout of (real, imag) for real dtypes')
+    group.add_argument('--scale', type=float, help='Factor applied before conversion to dtype')
+    group = parser.add_argument_group('pipeline')
+    group.add_argument('--workers', type=int, default=4, help='Worker processes')
+    group.add_argument('--queue', type=int, default=8, help='Tasks held in each queue')
+    group.add_argument('--chunk-ints', type=int, default=100, help='Integrations per task')
+    group.add_argument('--interval', type=float, default=1., help='Seconds between progress lines')
+    group.add_argument('--bdfdir', help='Directory of bdfs (default ASDMBinary of sdm)')
+    group.add_argument('--cachedir', help='Cache directory for bdf indexes and metadata (\'\' for none)')
+    parser.add_argument('--stats', action='store_true', help='Print stats of the read stages at the end')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log progress of the readers')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    metadata = sdmreader.read_metadata(args.sdm, bdfdir=args.bdfdir, cachedir=args.cachedir)
+    scans = select_scans(metadata, scans=args.scans, intents=args.intent, sources=args.source)
+    if args.list:
+        sys.stdout.write('%6s %-20s %8s %10s  %s\n' % ('scan', 'source', 'nints', 'seconds', 'intent'))
+        for scan in scans:
+            info = metadata[0][scan]
+            sys.stdout.write('%6d %-20s %8d %10.1f  %s\n' % (scan, info['source'], info['nints'], info['duration']*86400, info['intent']))
+        return 0
+
+    if not args.outdir:
+        parser.error('--outdir is needed to extract')
+    if not scans:
+        parser.error('no scans with bdf match the selection')
+    if (args.tavg > 1 or args.favg > 1) and (args.dtype or args.layout != 'interleaved' or args.scale is not None):
+        parser.error('--dtype, --layout and --scale cannot be used with --tavg or --favg')
+
+    selection = dict((key, getattr(args, key)) for key in ('spws', 'ants', 'bls', 'pols') if getattr(args, key) is not None)
+    if args.chans:
+        selection['chans'] = tuple([int(val) if val else None for val in args.chans.split(':')])
+
+    summary = extract(args.sdm, scans, args.outdir, workers=args.workers, queue=args.queue, chunk_ints=args.chunk_ints,
+                      tavg=args.tavg, favg=args.favg, flags=args.flags, dtype=args.dtype, layout=args.layout, scale=args.scale,
+                      selection=selection, bdfdir=args.bdfdir, cachedir=args.cachedir, metadata=metadata,
+                      progress=_Progress(sys.stderr, args.interval))
+
+    sys.stdout.write('Extracted %d ints of %d scans to %s in %.1f s (%.1f ints/s, %.1f MB/s)\n'
+                     % (summary['ints'], len(scans), args.outdir, summary['seconds'], summary['ints_per_s'], summary['mb_per_s']))
+    if args.stats:
+        sys.stdout.write(summary['stats'].report() + '\n')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
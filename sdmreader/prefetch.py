@@ -0,0 +1,172 @@
+# Copyright 2014 Casey Law <caseyjlaw@gmail.com> and collaborators.
+# Licensed under GNU GPL v2.
+
+""" prefetch -- reading bdf data ahead of its consumer
+
+willneed -- asks the kernel to start reading a byte range of a mmap (madvise MADV_WILLNEED).
+Prefetcher -- iterates over blocks of integrations of a BDFData while a background thread reads the next blocks.
+
+Reads through the mmap of a bdf fault in pages as they are touched, so a consumer
+that reads one block and then works on it leaves the disk idle while it works.
+Prefetcher keeps the disk busy: a thread copies the next blocks into a pool of
+buffers while the consumer works on the current one, and the kernel is told to
+read further blocks ahead with madvise. numpy releases the GIL while copying, so
+the thread runs alongside the consumer.
+
+madvise is called through ctypes on the address of the mmap. ctypes and the
+threading modules are imported when first used. Where madvise is not available
+(no libc, other platforms), willneed does nothing and only the thread reads ahead.
+"""
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+defaultbudget = 256*1024**2     # bytes of buffers held by a Prefetcher
+MADV_WILLNEED = 3
+_pagesize = 4096
+_madvise = None
+
+def _load_madvise():
+    """ Returns libc madvise function via ctypes, or False if not available.
+    Loaded on first call.
+    """
+
+    global _madvise, _pagesize
+    if _madvise is not None:
+        return _madvise
+
+    _madvise = False
+    try:
+        import ctypes, ctypes.util, mmap
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.madvise
+        func.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+        func.restype = ctypes.c_int
+        _pagesize = mmap.PAGESIZE
+        _madvise = func
+    except (OSError, AttributeError, TypeError) as exc:
+        logger.debug('No madvise available (%s). Only reading ahead with threads.' % exc)
+
+    return _madvise
+
+def willneed(mm, offset, size):
+    """ Asks kernel to read bytes offset to offset+size of mmap mm in the background.
+    Returns True if the advice was given.
+    """
+
+    madvise = _load_madvise()
+    if not madvise or size <= 0:
+        return False
+
+    start = max(0, offset - offset % _pagesize)
+    size = min(offset + size, len(mm)) - start
+    if size <= 0:
+        return False
+
+    address = np.frombuffer(mm, dtype=np.uint8).ctypes.data
+    return madvise(address + start, size, MADV_WILLNEED) == 0
+
+class Prefetcher(object):
+    """ Iterates over blocks of integrations start to stop of a BDFData, reading ahead.
+    Yields tuples (i0, i1, data) with data of integrations i0 to i1 as from
+    bdf.read(datakind, i0, i1, sel=sel, dtype=dtype, layout=layout, scale=scale).
+    data is a buffer that is reused once the next block is requested, so copy it to keep it.
+
+    A thread reads up to depth blocks of chunk_ints integrations ahead of the consumer, and
+    the kernel is asked to read depth more blocks ahead of the thread. Buffers held by the
+    prefetcher are limited to budget bytes (default defaultbudget), which may lower depth.
+    """
+
+    def __init__(self, bdf, start=0, stop=None, chunk_ints=16, depth=4, budget=None, sel=None, datakind='crossData.bin',
+                 dtype=None, layout='interleaved', scale=None):
+        self.bdf = bdf
+        self.start = start
+        self.stop = bdf.n_integrations if stop is None else stop
+        bdf._check_range(start, self.stop)
+        self.chunk_ints = chunk_ints
+        self.sel = sel
+        self.datakind = datakind
+        self.dtype = dtype
+        self.layout = layout
+        self.scale = scale
+
+        itemsize = np.dtype(dtype).itemsize if dtype else 8     # complex64 at most
+        blockbytes = chunk_ints*int(np.prod(bdf.get_outshape(datakind, 1, sel, dtype, layout)))*itemsize
+        nbuf = max(2, min(depth + 1, (budget or defaultbudget) // max(blockbytes, 1)))
+        if nbuf < depth + 1:
+            logger.info('Prefetch depth lowered from %d to %d blocks to fit budget.' % (depth, nbuf - 1))
+        self.depth = nbuf - 1
+
+    def __iter__(self):
+        import threading, Queue
+        free = Queue.Queue()
+        ready = Queue.Queue()
+        done = threading.Event()
+        for i in range(self.depth + 1):
+            free.put(None)       # allocated on first use
+
+        thread = threading.Thread(target=self._run, args=(free, ready, done))
+        thread.daemon = True
+        thread.start()
+
+        held = None
+        try:
+            while True:
+                if held is not None:
+                    free.put(held)
+                    held = None
+                item = ready.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                i0, i1, held = item
+                yield i0, i1, self._block(held, i1-i0)
+        finally:
+            done.set()
+            thread.join()
+
+    def _block(self, buf, nints):
+        """ First nints integrations of buffer buf.
+        """
+
+        return buf[:, :nints] if self.layout == 'planar' else buf[:nints]
+
+    def _run(self, free, ready, done):
+        """ Reads blocks into free buffers and queues them in order. Runs in thread.
+        """
+
+        import Queue
+        bdf = self.bdf
+        advised = self.start
+        try:
+            for i0 in xrange(self.start, self.stop, self.chunk_ints):
+                i1 = min(i0 + self.chunk_ints, self.stop)
+
+                # kernel reads the blocks after those the thread will hold
+                ahead = min(i1 + 2*self.depth*self.chunk_ints, self.stop)
+                if ahead > advised:
+                    bdf.advise(max(advised, i1), ahead)
+                    advised = ahead
+
+                buf = None
+                while not done.is_set():
+                    try:
+                        buf = free.get(timeout=0.1)
+                        break
+                    except Queue.Empty:
+                        pass
+                if done.is_set():
+                    return
+
+                if buf is None:
+                    buf = bdf.read(self.datakind, i0, i1, sel=self.sel, dtype=self.dtype, layout=self.layout, scale=self.scale)
+                else:
+                    bdf.read(self.datakind, i0, i1, out=self._block(buf, i1-i0), sel=self.sel, layout=self.layout, scale=self.scale)
+                ready.put((i0, i1, buf))
+            ready.put(None)
+        except Exception as exc:
+            logger.exception('Prefetch of bdf %s failed' % bdf.fp.name)
+            ready.put(exc)
@@ -5,164 +5,714 @@
 
 Functions:
 
-read_bdf -- reads data from binary data format and returns numpy array.
+read_bdf -- reads data from binary data format and returns numpy array, optionally with flags applied.
+read_autos -- reads autocorrelations from binary data format and returns numpy array.
+iter_bdf -- generator over blocks of integrations from binary data format, using bounded memory.
+follow_bdf -- generator over integrations of a bdf that is still being written, as they are completed.
+read_bdfs -- reads many scans or integration ranges with a pool of processes into shared output arrays.
+find_integrations -- finds (scan, nskip, readints) ranges of integrations in a time range, for read_bdf or read_bdfs.
+plan_shards -- splits the bdf of a scan into shards: integration ranges with their byte range and index, as json-able dicts.
+open_shard, read_shard -- open or read one shard, mapping only its bytes of the bdf and without parsing it (e.g., on another node).
 calc_uvw -- parses metadata to calculate uvw coordinates for given scan (or time/direction). returns (u,v,w) tuple. Requires CASA libraries.
+UVWSession -- keeps antenna positions and CASA tools of an SDM for repeated uvw calculations (used by calc_uvw and calc_uvw_scan).
+calc_uvw_scan -- calculates uvw coordinates for all integrations of a scan with numpy. returns (nint, nbl, 3) array.
 read_metadata -- parses metadata of SDM file (xml format) to return tuple with two dictionaries (scaninfo, sourceinfo). Scan info defines BDF location per scan.
 
-BDFData class does the heavy lifting to parse binary data format and return numpy array. Does not yet parse flag table.
+BDFData class does the heavy lifting to parse binary data format and return numpy arrays of data and flags.
+
+sdmpy, ElementTree and the CASA libraries are imported when first needed, so importing sdmreader is fast.
 
 Note: baseline order used in the bdf is a bit unusual and different from what is assumed when working with a measurement set.
 Order of uvw and axis=1 of data array Pythonically would be [i*nants+j for j in range(nants) for i in range(j)], so [ (1,2), (1,3), (2,3), (1,4), ...].
 """
 
 import numpy as np
-import os, mmap, math, string, sdmpy, logging
-import cPickle as pickle
-import xml.etree.ElementTree as et    # sdmpy can do this part...
-from email.feedparser import FeedParser
-from email.message import Message
+import os, re, mmap, math, time, string, itertools, collections, logging
+from . import cache, stats
+from .prefetch import Prefetcher, willneed
 
 logger = logging.getLogger(__name__)
 
-def read_bdf(sdmpath, scan, nskip=0, readints=0, writebdfpkl=False, bdfdir=None):
+def read_bdf(sdmpath, scan, nskip=0, readints=0, writebdfpkl=False, bdfdir=None, cachedir=None, copy=True, metadata=None,
+             spws=None, chans=None, bls=None, ants=None, pols=None, apply_flags=False, tavg=1, favg=1, tstart=None, tstop=None,
+             out=None, dtype=None, layout='interleaved', scale=None):
     """ Reads given range of integrations from sdm of given scan.
     Uses BDFData object to read.
     readints=0 will read all of bdf (skipping nskip).
-    Option to write pkl to store bdf info for faster parse next time.
+    bdf index is cached in cachedir for faster parse next time (see BDFData).
+    writebdfpkl is ignored and only kept for old callers.
+    metadata is optional (scandict, sourcedict) from read_metadata, to skip reading it again.
+    copy=False returns a read-only view backed by the mmap of the bdf (no copies).
+    The view stays valid after the bdf file is closed, since it holds a reference to the mmap.
+    spws, chans, bls, ants and pols select data to read (see BDFData.selection).
+    Selections that are not contiguous are gathered into a new array, even with copy=False.
+    apply_flags=True returns a numpy masked array with the bdf flags as mask.
+    apply_flags='zero' returns data with flagged samples set to zero (always a copy).
+    tavg and favg average data in bins of that many integrations and (selected) channels while reading,
+    so the full resolution data is never in memory (see BDFData.average). Partial bins at the end are dropped.
+    With apply_flags, averages leave out flagged samples and only bins with all samples flagged are flagged.
+    tstart and tstop (mjd) select integrations with times tstart <= t < tstop instead of nskip and readints.
+    Either can be None for an open range. Integrations are found in the time index of the bdf (see BDFData.time_range).
+    out is optional array to read into (e.g., pinned or shared memory), of the shape of the returned data.
+    dtype, layout and scale convert the data while it is copied out of the bdf, with no intermediate copies
+    (see BDFData.read): e.g., dtype='int16', scale=1000 gives (real, imag) pairs of int16 in a last axis and
+    dtype='float16', layout='planar' gives a real and an imaginary plane of float16. Flags apply to both parts.
+    Conversion is not done with tavg or favg, which take only out (complex64).
+    """
+
+    scans, bdf = _open_bdf(sdmpath, scan, bdfdir=bdfdir, cachedir=cachedir, metadata=metadata)
+    if tstart is not None or tstop is not None:
+        nskip, stop = bdf.time_range(tstart, tstop)
+        readints = stop - nskip
+    elif readints == 0:
+        readints = bdf.n_integrations - nskip
+    bdf._check_range(nskip, nskip+readints)
+    sel = bdf.selection(spws=spws, chans=chans, bls=bls, ants=ants, pols=pols)
+
+    convert = dtype is not None or layout != 'interleaved' or scale is not None
+
+    logger.info('Reading %d ints starting at int %d' % (readints, nskip))
+    if tavg > 1 or favg > 1:
+        if convert:
+            raise ValueError('dtype, layout and scale cannot be used with tavg or favg')
+        return _read_averaged(bdf, nskip, nskip+readints, tavg, favg, sel, apply_flags, out=out)
+
+    if not copy and apply_flags != 'zero' and out is None and not convert:
+        data = bdf.as_array('crossData.bin')[nskip:nskip+readints]
+        if all([isinstance(idx, slice) for idx in sel]):
+            data = data[(slice(None),) + sel]
+        else:
+            data = _gather(data, sel, np.empty((readints,) + bdf.get_shape('crossData.bin', sel), dtype='complex64'))
+    else:
+        bdf.advise(nskip, nskip+readints)
+        data = bdf.read('crossData.bin', nskip, nskip+readints, out=out, sel=sel, dtype=dtype, layout=layout, scale=scale)
+
+    if apply_flags:
+        data = _apply_flags(data, bdf.get_flags(nskip, nskip+readints, sel=sel), apply_flags, layout=layout)
+
+    return data
+
+def read_autos(sdmpath, scan, nskip=0, readints=0, bdfdir=None, cachedir=None, metadata=None, ants=None, apply_flags=False):
+    """ Reads given range of autocorrelations from sdm of given scan.
+    Returns array of shape (nints, nants, nchan, 2), read like read_bdf with strided copies.
+    ants is list of antenna numbers to read. nskip, readints, metadata and apply_flags are as in read_bdf.
+    Antenna flags are applied to both autocorrelation products if they are not given per product.
+    """
+
+    scans, bdf = _open_bdf(sdmpath, scan, bdfdir=bdfdir, cachedir=cachedir, metadata=metadata)
+    if readints == 0:
+        readints = bdf.n_integrations - nskip
+    sel = (_as_slice(np.arange(bdf.n_antennas)[ants if ants is not None else slice(None)]), slice(None), slice(None))
+
+    logger.info('Reading autos of %d ints starting at int %d' % (readints, nskip))
+    data = bdf.read('autoData.bin', nskip, nskip+readints, sel=sel)
+    if apply_flags:
+        data = _apply_flags(data, bdf.get_flags(nskip, nskip+readints, sel=sel, autos=True), apply_flags)
+
+    return data
+
+def iter_bdf(sdmpath, scan, chunk_ints=100, nskip=0, readints=0, bdfdir=None, cachedir=None, metadata=None,
+             spws=None, chans=None, bls=None, ants=None, pols=None, apply_flags=False, tavg=1, favg=1, prefetch=0,
+             dtype=None, layout='interleaved', scale=None):
+    """ Generator over blocks of up to chunk_ints integrations from sdm of given scan.
+    Yields tuple (ints, mjds, data) with integration numbers, mjd of each integration and
+    data array of shape (nints, nbl, nchan, npol).
+    Memory use is bounded by one block: data is a view of an output buffer that is reused,
+    so it is overwritten by the next block. Copy it to keep it.
+    nskip, readints, cachedir, metadata, apply_flags, tavg, favg and the selection (spws, chans, bls, ants, pols) are as in read_bdf.
+    With tavg, chunk_ints is rounded up to whole time bins and ints and mjds are of the first integration and middle of each bin.
+    prefetch > 0 reads that many blocks ahead in a background thread, so disk reads overlap with work on the
+    yielded block (see prefetch.Prefetcher). Memory use is then prefetch+1 blocks. Not used with tavg or favg.
+    dtype, layout and scale convert each block while it is read, as in read_bdf. With layout='planar' blocks
+    have shape (2, nints, nbl, nchan, npol).
+    """
+
+    scans, bdf = _open_bdf(sdmpath, scan, bdfdir=bdfdir, cachedir=cachedir, metadata=metadata)
+    if readints == 0:
+        readints = bdf.n_integrations - nskip
+    sel = bdf.selection(spws=spws, chans=chans, bls=bls, ants=ants, pols=pols)
+
+    mjds = _int_times(bdf, scans[scan])
+
+    if tavg > 1 or favg > 1:
+        if dtype is not None or layout != 'interleaved' or scale is not None:
+            raise ValueError('dtype, layout and scale cannot be used with tavg or favg')
+        chunk_ints = tavg*int(math.ceil(chunk_ints/float(tavg)))
+        readints -= readints % tavg
+        nbl, nchan, npol = bdf.get_shape('crossData.bin', sel)
+        data = np.empty( (min(chunk_ints, readints)//tavg, nbl, nchan//favg, npol), dtype='complex64')
+        logger.info('Iterating over %d ints starting at int %d in blocks of %d, averaging %d ints and %d chans'
+                    % (readints, nskip, chunk_ints, tavg, favg))
+        for start in xrange(nskip, nskip+readints, chunk_ints):
+            stop = min(start+chunk_ints, nskip+readints)
+            block = _read_averaged(bdf, start, stop, tavg, favg, sel, apply_flags, out=data[:(stop-start)//tavg])
+            yield np.arange(start, stop, tavg), mjds[start:stop].reshape(-1, tavg).mean(axis=1), block
+        return
+
+    logger.info('Iterating over %d ints starting at int %d in blocks of %d' % (readints, nskip, chunk_ints))
+    if prefetch:
+        for start, stop, block in Prefetcher(bdf, nskip, nskip+readints, chunk_ints=chunk_ints, depth=prefetch, sel=sel,
+                                             dtype=dtype, layout=layout, scale=scale):
+            if apply_flags:
+                block = _apply_flags(block, bdf.get_flags(start, stop, sel=sel), apply_flags, layout=layout)
+            yield np.arange(start, stop), mjds[start:stop], block
+        return
+
+    dtype = dtype or 'complex64'
+    data = np.empty(bdf.get_outshape('crossData.bin', min(chunk_ints, readints), sel, dtype, layout), dtype=dtype, order='C')
+    for start in xrange(nskip, nskip+readints, chunk_ints):
+        stop = min(start+chunk_ints, nskip+readints)
+        out = data[:, :stop-start] if layout == 'planar' else data[:stop-start]
+        block = bdf.read('crossData.bin', start, stop, out=out, sel=sel, layout=layout, scale=scale)
+        if apply_flags:
+            block = _apply_flags(block, bdf.get_flags(start, stop, sel=sel), apply_flags, layout=layout)
+        yield np.arange(start, stop), mjds[start:stop], block
+
+def follow_bdf(bdffile, poll=0.1, timeout=60., spws=None, chans=None, bls=None, ants=None, pols=None, apply_flags=False):
+    """ Generator over integrations of a bdf that is still being written (e.g., by the correlator).
+    Yields tuple (ints, mjds, data) as in iter_bdf with the integrations completed since the last yield,
+    as soon as the closing MIME boundary of each is in the file. data is a new array each time.
+    Waits for the file and its header to appear, then checks for new data every poll seconds.
+    Stops at the closing boundary of the bdf or after timeout seconds without a new integration (None waits forever).
+    Bytes already indexed are not scanned again (see BDFData.refresh). The index is not cached.
+    Selection and apply_flags are as in read_bdf.
+    """
+
+    t0 = time.time()
+    bdf = None
+    while bdf is None:
+        try:
+            with open(bdffile, 'r') as fp:
+                bdf = BDFData(fp, cachedir='').parse(follow=True)
+        except (IOError, ValueError, RuntimeError) as exc:   # no file, empty file or incomplete header
+            if timeout is not None and time.time() - t0 > timeout:
+                raise
+            logger.debug('Waiting for bdf %s (%s)' % (bdffile, exc))
+            time.sleep(poll)
+    sel = bdf.selection(spws=spws, chans=chans, bls=bls, ants=ants, pols=pols)
+
+    logger.info('Following bdf %s' % bdffile)
+    nread = 0
+    last = time.time()
+    while True:
+        if bdf.n_integrations > nread:
+            start, stop = nread, bdf.n_integrations
+            data = bdf.read('crossData.bin', start, stop, sel=sel)
+            if apply_flags:
+                data = _apply_flags(data, bdf.get_flags(start, stop, sel=sel), apply_flags)
+            yield np.arange(start, stop), bdf.times[start:stop], data
+            nread = stop
+            last = time.time()
+        elif bdf.finished:
+            logger.info('bdf %s finished after %d integrations' % (bdffile, nread))
+            return
+        elif timeout is not None and time.time() - last > timeout:
+            logger.warn('No new integrations in bdf %s for %.1f s. Stopping after %d integrations.' % (bdffile, timeout, nread))
+            return
+        else:
+            time.sleep(poll)
+        bdf.refresh()
+
+def find_integrations(sdmpath, tstart, tstop, bdfdir=None, cachedir=None, metadata=None):
+    """ Finds integrations of all scans with times (mjd) in tstart <= t < tstop.
+    Returns list of (scan, nskip, readints) tuples in time order, as taken by read_bdfs.
+    Scans overlapping the range are found by binary search of scan start and end times from metadata,
+    and integrations by binary search of the time index of their bdfs, so only those bdfs are opened.
+    Scans without bdf are left out.
+    """
+
+    if not metadata:
+        metadata = read_metadata(sdmpath, bdfdir=bdfdir, cachedir=cachedir)
+    scans = metadata[0]
+
+    order = sorted([scan for scan in scans if scans[scan].get('bdfstr')], key=lambda scan: scans[scan]['startmjd'])
+    starts = np.array([scans[scan]['startmjd'] for scan in order])
+    ends = np.maximum.accumulate([scans[scan]['endmjd'] for scan in order]) if order else np.array([])
+    first = np.searchsorted(ends, tstart, 'right')
+    last = np.searchsorted(starts, tstop, 'left')
+
+    ranges = []
+    for scan in order[first:last]:
+        scandict, bdf = _open_bdf(sdmpath, scan, bdfdir=bdfdir, cachedir=cachedir, metadata=_select_scan(metadata, scan))
+        start, stop = bdf.time_range(tstart, tstop)
+        if stop > start:
+            ranges.append((scan, start, stop - start))
+
+    logger.info('Found %d integrations in %d scans between mjd %.6f and %.6f' % (sum([r[2] for r in ranges]), len(ranges), tstart, tstop))
+    return ranges
+
+def plan_shards(sdmpath, scan, nshards, bdfdir=None, cachedir=None, metadata=None):
+    """ Splits integrations of the bdf of scan into nshards ranges of (nearly) equal size.
+    Returns list of shard dicts (see BDFData.shard) with sdm and scan added.
+    Shards hold only numbers, strings and lists, so the plan can be saved with json and sent to
+    workers on other nodes. A worker reads its shard with read_shard or open_shard, which map only
+    the bytes of the shard and do not parse the bdf, so reads of one large scan scale with workers.
+    """
+
+    scans, bdf = _open_bdf(sdmpath, scan, bdfdir=bdfdir, cachedir=cachedir, metadata=metadata)
+    bounds = np.linspace(0, bdf.n_integrations, max(1, min(nshards, bdf.n_integrations)) + 1).astype(int)
+
+    shards = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        shard = bdf.shard(int(start), int(stop))
+        shard['sdm'] = os.path.abspath(sdmpath)
+        shard['scan'] = scan
+        shards.append(shard)
+
+    logger.info('Planned %d shards of %d ints of scan %d' % (len(shards), bdf.n_integrations, scan))
+    return shards
+
+def open_shard(shard):
+    """ Opens shard from plan_shards (or BDFData.shard) as BDFData object of its integrations.
+    Only the byte range of the shard is mapped and its index comes from the shard, so the bdf is not parsed.
+    Integration numbers of the object count from the start of the shard (its integration 0 is shard['start']).
+    Raises ValueError if the bdf changed since the shard was made.
+    """
+
+    if shard.get('version') != shardversion:
+        raise ValueError('shard has version %s, not %d' % (shard.get('version'), shardversion))
+
+    with open(shard['path'], 'r') as fp:
+        st = os.fstat(fp.fileno())
+        if st.st_size != shard['filesize'] or int(st.st_mtime) != shard['mtime']:
+            raise ValueError('bdf %s changed since shard was made' % shard['path'])
+        bdf = BDFData(fp, cachedir='', offset=shard['offset'], length=shard['length'])
+
+    state = dict(shard['index'])
+    base = shard['offset'] - bdf.mapoffset
+    state['offsets'] = dict((str(kind), np.where(np.array(offs, dtype=np.int64) < 0, -1, np.array(offs, dtype=np.int64) + base))
+                            for kind, offs in state['offsets'].iteritems())
+    state['sizes'] = dict((str(kind), np.array(sizes, dtype=np.int64)) for kind, sizes in state['sizes'].iteritems())
+    state['times'] = np.array(state['times'], dtype=np.float64)
+    bdf._setstate(state)
+    bdf.firstint = shard['start']
+    bdf.n_pols = len(bdf.crosspols)
+    bdf.headsize, bdf.intsize = bdf.calc_intsize()
+
+    return bdf
+
+def read_shard(shard, spws=None, chans=None, bls=None, ants=None, pols=None, apply_flags=False,
+               out=None, dtype=None, layout='interleaved', scale=None):
+    """ Reads all integrations of shard (see plan_shards) without parsing the bdf.
+    Selection, apply_flags, out, dtype, layout and scale are as in read_bdf.
+    Returns data of integrations shard['start'] to shard['stop'] of the scan.
+    """
+
+    bdf = open_shard(shard)
+    sel = bdf.selection(spws=spws, chans=chans, bls=bls, ants=ants, pols=pols)
+
+    logger.info('Reading shard of ints %d to %d of bdf %s' % (shard['start'], shard['stop'], shard['path']))
+    bdf.advise(0, bdf.n_integrations)
+    data = bdf.read('crossData.bin', 0, bdf.n_integrations, out=out, sel=sel, dtype=dtype, layout=layout, scale=scale)
+    if apply_flags:
+        data = _apply_flags(data, bdf.get_flags(0, bdf.n_integrations, sel=sel), apply_flags, layout=layout)
+
+    return data
+
+def read_bdfs(sdmpath, scans, workers=4, ints_per_task=0, outdir=None, bdfdir=None, cachedir=None, metadata=None):
+    """ Reads many scans (or integration ranges of scans) with a pool of worker processes.
+    scans is list of scan numbers or of (scan, nskip, readints) tuples, with readints=0 reading to end of scan.
+    Returns dict of data arrays keyed by the entries of scans.
+    Workers write straight into the output arrays, so no data goes back through pickles.
+    Output is anonymous shared memory, or .npy files in outdir that are returned as memmaps.
+    ints_per_task splits reads into tasks of that many integrations. 0 makes about four tasks per worker.
+    Uses fork to share bdfs and outputs with the workers, so workers=1 (or 0) reads in this process.
+    """
+
+    if not metadata:
+        metadata = read_metadata(sdmpath, bdfdir=bdfdir, cachedir=cachedir)
+    if outdir and not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    # parse bdfs and allocate outputs in parent, so workers inherit them
+    bdfs = []; outputs = []; ranges = []
+    for entry in scans:
+        scan, nskip, readints = entry if isinstance(entry, tuple) else (entry, 0, 0)
+        scandict, bdf = _open_bdf(sdmpath, scan, bdfdir=bdfdir, cachedir=cachedir, metadata=_select_scan(metadata, scan))
+        if readints == 0:
+            readints = bdf.n_integrations - nskip
+
+        shape = (readints,) + bdf.get_shape('crossData.bin')
+        if outdir:
+            name = 'scan%d.npy' % scan if entry == scan else 'scan%d_%d_%d.npy' % (scan, nskip, readints)
+            data = np.lib.format.open_memmap(os.path.join(outdir, name), mode='w+', dtype='complex64', shape=shape)
+        else:
+            nbytes = max(int(np.prod(shape))*np.dtype('complex64').itemsize, 1)
+            data = np.frombuffer(mmap.mmap(-1, nbytes), dtype='complex64', count=int(np.prod(shape))).reshape(shape)
+        bdfs.append(bdf); outputs.append(data); ranges.append((nskip, readints))
+
+    if not ints_per_task:
+        total = sum([readints for (nskip, readints) in ranges])
+        ints_per_task = max(1, int(math.ceil(total/(4.*max(workers, 1)))))
+
+    tasks = [(i, start, min(start+ints_per_task, nskip+readints))
+             for i, (nskip, readints) in enumerate(ranges)
+             for start in xrange(nskip, nskip+readints, ints_per_task)]
+    logger.info('Reading %d scans in %d tasks with %d workers' % (len(scans), len(tasks), workers))
+
+    global _readbdfs_shared
+    _readbdfs_shared = (bdfs, outputs, ranges)
+    try:
+        if workers > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers)
+            try:
+                pool.map(_read_bdfs_task, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            map(_read_bdfs_task, tasks)
+    finally:
+        _readbdfs_shared = None
+
+    for data in outputs:
+        if isinstance(data, np.memmap):
+            data.flush()
+
+    return dict(zip(scans, outputs))
+
+_readbdfs_shared = None
+
+def _read_averaged(bdf, start, stop, tavg, favg, sel, apply_flags, out=None):
+    """ Reads averaged data with BDFData.average and applies flags to the averages as in _apply_flags.
+    Only bins with all samples flagged are flagged.
+    """
+
+    data = bdf.average(start, stop, tavg=tavg, favg=favg, sel=sel, flags=bool(apply_flags), out=out)
+    if apply_flags:
+        data, weights = data
+        if apply_flags is True:
+            data = np.ma.masked_array(data, mask=weights == 0)
+
+    return data
+
+def _apply_flags(data, flags, how, layout='interleaved'):
+    """ Applies boolean flags to data read from bdf.
+    how=True returns masked array. how='zero' sets flagged data to zero in place and returns it.
+    Flags with fewer pols than data flag all pols. Flags of data read into a real dtype
+    (with an axis of real and imag in given layout, see BDFData.read) flag both parts.
+    """
+
+    assert how in (True, 'zero'), 'apply_flags must be True or \'zero\''
+
+    if data.ndim == flags.ndim + 1:
+        flags = flags[None] if layout == 'planar' else flags[..., None]
+    elif flags.shape[-1] != data.shape[-1]:
+        flags = flags.any(axis=-1)[..., None].repeat(data.shape[-1], axis=-1)
+    if flags.shape != data.shape:
+        flags = flags | np.zeros(data.shape, dtype=bool)
+
+    if how == 'zero':
+        np.putmask(data, flags, 0)
+        return data
+
+    return np.ma.masked_array(data, mask=flags)
+
+def _read_bdfs_task(task):
+    """ Reads integrations start to stop of bdf i into its output, for read_bdfs.
+    """
+
+    i, start, stop = task
+    bdfs, outputs, ranges = _readbdfs_shared
+    nskip = ranges[i][0]
+    bdfs[i].read('crossData.bin', start, stop, out=outputs[i][start-nskip:stop-nskip])
+
+def _open_bdf(sdmpath, scan, bdfdir=None, cachedir=None, metadata=None):
+    """ Finds and parses bdf for given scan.
+    Returns tuple (scans, bdf) with scan dict from read_metadata (or metadata) and parsed BDFData object.
     """
 
     assert os.path.exists(sdmpath), 'sdmpath %s does not exist' % sdmpath
-    scans, sources = read_metadata(sdmpath, scan, bdfdir=bdfdir)
+    if metadata:
+        scans, sources = metadata
+    else:
+        scans, sources = read_metadata(sdmpath, scan, bdfdir=bdfdir, cachedir=cachedir)
     assert scans[scan]['bdfstr'], 'bdfstr not defined for scan %d' % scan
     bdffile = scans[scan]['bdfstr']
 
     assert os.path.exists(bdffile), 'Could not find bdf for scan %d and bdfstr %s.' % (scan, scans[scan]['bdfstr'])
 
+    # mmap of the bdf stays valid after the file is closed
     with open(bdffile, 'r') as fp:
-        # define bdfpkldir
-        if writebdfpkl:
-            bdfpkldir = os.path.join(sdmpath, 'bdfpkls')   # make place for bdfpkls, if needed
-            if not os.path.exists(bdfpkldir):
-                os.makedirs(bdfpkldir)
-        else:
-            bdfpkldir = ''
+        bdf = BDFData(fp, cachedir=cachedir).parse()
 
-        bdf = BDFData(fp, bdfpkldir=bdfpkldir).parse()
-        if readints == 0:
-            readints = bdf.n_integrations - nskip
+    return scans, bdf
+
+def _int_times(bdf, scandict):
+    """ Mjd of each integration of bdf, from scandict (metadata of its scan) if the bdf has no times.
+    """
 
-        logger.info('Reading %d ints starting at int %d' % (readints, nskip))
-        data = np.empty( (readints, bdf.n_baselines, bdf.n_channels, len(bdf.crosspols)), dtype='complex64', order='C')
-        for i in xrange(readints):
-            data[i] = bdf.get_data ('crossData.bin', i+nskip)
-#            flag[i] = bdf.get_data ('flags.bin', i+nskip)  # need to get auto+cross parsing right to implement this
+    # use integration times from bdf. if missing, integrations evenly fill the scan
+    mjds = bdf.times
+    if np.isnan(mjds).any():
+        inttime = scandict['duration']/bdf.n_integrations
+        mjds = scandict['startmjd'] + (np.arange(bdf.n_integrations)+0.5)*inttime
 
-    return data
+    return mjds
 
-def calc_uvw(sdmfile, scan=0, datetime=0, radec=()):
+@stats.timed('calc_uvw')
+def calc_uvw(sdmfile, scan=0, datetime=0, radec=(), metadata=None):
     """ Calculates and returns uvw in meters for a given SDM, time, and pointing direction.
     sdmfile is path to sdm directory that includes "Station.xml" file.
     scan is scan number defined by observatory.
     datetime is time (as string) to calculate uvw (format: '2014/09/03/08:33:04.20')
     radec is (ra,dec) as tuple in units of degrees (format: (180., +45.))
+    metadata is optional (scandict, sourcedict) from read_metadata, to skip reading it again.
+    Uses the UVWSession of sdmfile, so repeated calls only set time and direction.
     """
 
-    # set up CASA tools
-    try:
-        import casautil
-    except ImportError:
-        try:
-            import pwkit.environments.casa.util as casautil
-        except ImportError:
-            logger.info('Cannot find pwkit/casautil. No calc_uvw possible.')
+    return _uvw_session(sdmfile).calc_uvw(scan, datetime=datetime, radec=radec, metadata=metadata)
+
+class UVWSession(object):
+    """ State for repeated uvw calculations of one SDM.
+    Keeps the scan configurations and antenna positions read from the SDM tables, the
+    CASA baselines of each configuration and the CASA measures tools with the observatory
+    frame set. calc_uvw then only sets the epoch and direction and projects baselines.
+    CASA is set up on the first calc_uvw. positions works without CASA.
+    Scan and source metadata is not kept, so it follows changes of the SDM (see read_metadata).
+    """
+
+    def __init__(self, sdmfile):
+        assert os.path.exists(os.path.join(sdmfile, 'Station.xml')), 'sdmfile %s has no Station.xml file. Not an SDM?' % sdmfile
+        self.sdmfile = sdmfile
+        self._configs = None
+        self._positions = {}
+        self._baselines = {}
+        self._tools = None
+
+    def positions(self, scan=0):
+        """ ITRF positions (nants, 3) in meters of antennas used in scan, in bdf antenna order
+        (of the scan's ConfigDescription). scan=0 gives all antennas in the Antenna table.
+        """
+
+        if self._configs is None:
+            self._configs = dict((int(row['scanNumber']), row['configDescriptionId']) for row in _read_table(self.sdmfile, 'Main'))
+        configid = self._configs.get(scan) if scan else None
+        assert scan == 0 or configid, 'scan %d not in sdm %s' % (scan, self.sdmfile)
+
+        if configid not in self._positions:
+            antennas = list(_read_table(self.sdmfile, 'Antenna'))
+            stationids = dict((row['antennaId'], row['stationId']) for row in antennas)
+            positions = dict((row['stationId'], [float(val) for val in row['position'].split()[2:5]]) for row in _read_table(self.sdmfile, 'Station'))
+            if configid:
+                antids = [row['antennaId'] for row in _read_table(self.sdmfile, 'ConfigDescription') if row['configDescriptionId'] == configid][0].split()[2:]
+            else:
+                antids = [row['antennaId'] for row in antennas]
+            self._positions[configid] = np.array([positions[stationids[antid]] for antid in antids])
+
+        return self._positions[configid]
+
+    def tools(self):
+        """ CASA (measures, quanta) tools with observatory frame set, or None if CASA is not available.
+        """
+
+        if self._tools is None:
+            try:
+                import casautil
+            except ImportError:
+                try:
+                    import pwkit.environments.casa.util as casautil
+                except ImportError:
+                    logger.info('Cannot find pwkit/casautil. No calc_uvw possible.')
+                    return None
+
+            me = casautil.tools.measures()
+            qa = casautil.tools.quanta()
+            logger.debug('Accessing CASA libraries with casautil.')
+
+            telescopename = next(_read_table(self.sdmfile, 'ExecBlock'))['telescopeName'].strip()
+            logger.debug('Found observatory name %s' % telescopename)
+            me.doframe(me.observatory(telescopename))
+            self._tools = (me, qa)
+
+        return self._tools
+
+    def calc_uvw(self, scan=0, datetime=0, radec=(), metadata=None):
+        """ uvw as in calc_uvw. Returns (u, v, w) tuple or None if CASA is not available.
+        metadata is optional (scandict, sourcedict) from read_metadata. Default reads it (memoised) for every call.
+        """
+
+        tools = self.tools()
+        if tools is None:
             return
+        me, qa = tools
 
-    me = casautil.tools.measures()
-    qa = casautil.tools.quanta()
-    logger.debug('Accessing CASA libraries with casautil.')
+        # get scan info
+        scans, sources = metadata or read_metadata(self.sdmfile)
 
-    assert os.path.exists(os.path.join(sdmfile, 'Station.xml')), 'sdmfile %s has no Station.xml file. Not an SDM?' % sdmfile
+        # default is to use scan info
+        if (datetime == 0) and (len(radec) == 0):
+            assert scan != 0, 'scan must be set when using datetime and radec'   # default scan value not valid
 
-    # get scan info
-    scans, sources = read_metadata(sdmfile, scan)
+            logger.info('Calculating uvw for first integration of scan %d of source %s' % (scan, scans[scan]['source']))
+            datetime = qa.time(qa.quantity(scans[scan]['startmjd'],'d'), form="ymd", prec=8)[0]
+            sourcenum = [kk for kk in sources.keys() if sources[kk]['source'] == scans[scan]['source']][0]
+            direction = me.direction('J2000', str(np.degrees(sources[sourcenum]['ra']))+'deg', str(np.degrees(sources[sourcenum]['dec']))+'deg')
 
-    # default is to use scan info
-    if (datetime == 0) and (len(radec) == 0):
-        assert scan != 0, 'scan must be set when using datetime and radec'   # default scan value not valid
+        # secondary case is when datetime is also given
+        elif (datetime != 0) and (len(radec) == 0):
+            assert scan != 0, 'scan must be set when using datetime and radec'   # default scan value not valid
+            assert '/' in datetime, 'datetime must be in yyyy/mm/dd/hh:mm:ss.sss format'
 
-        logger.info('Calculating uvw for first integration of scan %d of source %s' % (scan, scans[scan]['source']))
-        datetime = qa.time(qa.quantity(scans[scan]['startmjd'],'d'), form="ymd", prec=8)[0]
-        sourcenum = [kk for kk in sources.keys() if sources[kk]['source'] == scans[scan]['source']][0]
-        direction = me.direction('J2000', str(np.degrees(sources[sourcenum]['ra']))+'deg', str(np.degrees(sources[sourcenum]['dec']))+'deg')
+            logger.info('Calculating uvw at %s for scan %d of source %s' % (datetime, scan, scans[scan]['source']))
+            sourcenum = [kk for kk in sources.keys() if sources[kk]['source'] == scans[scan]['source']][0]
+            direction = me.direction('J2000', str(np.degrees(sources[sourcenum]['ra']))+'deg', str(np.degrees(sources[sourcenum]['dec']))+'deg')
 
-    # secondary case is when datetime is also given
-    elif (datetime != 0) and (len(radec) == 0):
-        assert scan != 0, 'scan must be set when using datetime and radec'   # default scan value not valid
-        assert '/' in datetime, 'datetime must be in yyyy/mm/dd/hh:mm:ss.sss format'
+        else:
+            assert '/' in datetime, 'datetime must be in yyyy/mm/dd/hh:mm:ss.sss format'
+            assert len(radec) == 2, 'radec must be (ra,dec) tuple in units of degrees'
+
+            logger.info('Calculating uvw at %s in direction %s' % (datetime, radec))
+            logger.info('This mode assumes all antennas used.')
+            ra = radec[0]; dec = radec[1]
+            direction = me.direction('J2000', str(ra)+'deg', str(dec)+'deg')
+
+        me.doframe(me.epoch('utc', datetime))
+        me.doframe(direction)
+
+        # baselines of configuration are kept
+        positions = self.positions(scan)
+        configid = self._configs.get(scan) if scan else None
+        if configid not in self._baselines:
+            x, y, z = positions.T.tolist()
+            ants = me.position('itrf', qa.quantity(x, 'm'), qa.quantity(y, 'm'), qa.quantity(z, 'm'))
+            self._baselines[configid] = me.asbaseline(ants)
+        uvwlist = me.expand(me.touvw(self._baselines[configid])[0])[1]['value']
+
+        # define new bl order to match sdm binary file bl order
+        uvw = np.asarray(uvwlist, dtype=float).reshape(-1, 3)[_casa_to_bdf_order(len(positions))]
+        u = uvw[:,0].copy(); v = uvw[:,1].copy(); w = uvw[:,2].copy()
+
+        return u, v, w
+
+def _uvw_session(sdmfile):
+    """ UVWSession of sdmfile, kept for the last _uvwsessionsize sdms used.
+    """
 
-        logger.info('Calculating uvw at %s for scan %d of source %s' % (datetime, scan, scans[scan]['source']))
-        sourcenum = [kk for kk in sources.keys() if sources[kk]['source'] == scans[scan]['source']][0]
-        direction = me.direction('J2000', str(np.degrees(sources[sourcenum]['ra']))+'deg', str(np.degrees(sources[sourcenum]['dec']))+'deg')
+    key = os.path.abspath(sdmfile)
+    session = _uvwsessions.pop(key, None) or UVWSession(sdmfile)
+    _uvwsessions[key] = session
+    while len(_uvwsessions) > _uvwsessionsize:
+        _uvwsessions.popitem(last=False)
+
+    return session
+
+_uvwsessions = collections.OrderedDict()
+_uvwsessionsize = 16
+
+@stats.timed('calc_uvw_scan')
+def calc_uvw_scan(sdmfile, scan, mjds=None, metadata=None, bdfdir=None, cachedir=None):
+    """ Calculates uvw in meters for every integration of a scan without CASA.
+    Returns array of shape (nint, nbl, 3) with baselines in bdf order.
+    Antenna positions come from Station.xml (in the antenna order of the scan's ConfigDescription)
+    and phase center from the scan's source.
+    mjds is optional array of times (mjd, utc). Default is integration times from the bdf,
+    or integrations evenly filling the scan if there is no bdf.
+    Baseline for antennas (i, j) is position of j minus position of i, projected on J2000 uvw
+    with IAU 1976 precession and main terms of nutation. UT1-UTC and polar motion are ignored,
+    which makes errors of up to 1e-4 of the baseline length.
+    """
 
+    if metadata:
+        scans, sources = _select_scan(metadata, scan)
     else:
-        assert '/' in datetime, 'datetime must be in yyyy/mm/dd/hh:mm:ss.sss format'
-        assert len(radec) == 2, 'radec must be (ra,dec) tuple in units of degrees'
+        scans, sources = read_metadata(sdmfile, scan, bdfdir=bdfdir, cachedir=cachedir)
+    assert scan in scans, 'scan %d not in sdm %s' % (scan, sdmfile)
 
-        logger.info('Calculating uvw at %s in direction %s' % (datetime, direction))
-        logger.info('This mode assumes all antennas used.')
-        ra = radec[0]; dec = radec[1]
-        direction = me.direction('J2000', str(ra)+'deg', str(dec)+'deg')
+    if mjds is None:
+        if scans[scan].get('bdfstr'):
+            scans, bdf = _open_bdf(sdmfile, scan, cachedir=cachedir, metadata=(scans, sources))
+            mjds = _int_times(bdf, scans[scan])
+        else:
+            nints = scans[scan].get('nints', 1)
+            mjds = scans[scan]['startmjd'] + (np.arange(nints)+0.5)*scans[scan]['duration']/nints
+    mjds = np.atleast_1d(np.asarray(mjds, dtype=float))
 
-    # define metadata "frame" for uvw calculation
-    sdm = sdmpy.SDM(sdmfile)
-    telescopename = sdm['ExecBlock'][0]['telescopeName'].strip()
-    logger.debug('Found observatory name %s' % telescopename)
+    source = [src for src in sources.itervalues() if src['source'] == scans[scan]['source']][0]
+    positions = _uvw_session(sdmfile).positions(scan)
+    ant1, ant2 = _bdf_baselines(len(positions))
+    bls = positions[ant2] - positions[ant1]
 
-    me.doframe(me.observatory(telescopename))
-    me.doframe(me.epoch('utc', datetime))
-    me.doframe(direction)
+    rot = _uvw_rotation(mjds, source['ra'], source['dec'])
+    return np.einsum('tij,bj->tbi', rot, bls)
 
-    # read antpos
-    if scan != 0:
-        configid = [row.configDescriptionId for row in sdm['Main'] if scan == int(row.scanNumber)][0]
-        antidlist = [row.antennaId for row in sdm['ConfigDescription'] if configid == row.configDescriptionId][0].split(' ')[2:]
-        stationidlist = [ant.stationId for antid in antidlist for ant in sdm['Antenna'] if antid == ant.antennaId]
+def _bdf_baselines(nants):
+    """ Antenna index arrays (ant1, ant2) of baselines in bdf order [(0,1), (0,2), (1,2), (0,3), ...].
+    """
+
+    ant2, ant1 = np.tril_indices(nants, -1)
+    return ant1, ant2
+
+def _casa_to_bdf_order(nants):
+    """ Permutation taking baselines from CASA order [(0,1), (0,2), ..., (1,2), ...] to bdf order.
+    """
+
+    ant1, ant2 = _bdf_baselines(nants)
+    return ant1*nants - ant1*(ant1+1)//2 + (ant2-ant1-1)
+
+def _uvw_rotation(mjds, ra, dec):
+    """ Matrices (ntimes, 3, 3) taking ITRF baseline vectors to J2000 uvw toward (ra, dec) in radians.
+    mjds are utc and are used as ut1 and tt, which is good enough at the level of the neglected terms.
+    """
+
+    arcsec = np.pi/(180*3600.)
+    t = (mjds - 51544.5)/36525.     # julian centuries since J2000
+
+    # IAU 1982 gmst
+    gmst = np.radians((67310.54841 + (876600*3600 + 8640184.812866)*t + 0.093104*t**2 - 6.2e-6*t**3) % 86400 / 240.)
+
+    # main terms of IAU 1980 nutation
+    omega = np.radians(125.04452 - 1934.136261*t)
+    lsun = np.radians(280.4665 + 36000.7698*t)
+    lmoon = np.radians(218.3165 + 481267.8813*t)
+    dpsi = (-17.20*np.sin(omega) - 1.32*np.sin(2*lsun) - 0.23*np.sin(2*lmoon) + 0.21*np.sin(2*omega))*arcsec
+    deps = (9.20*np.cos(omega) + 0.57*np.cos(2*lsun) + 0.10*np.cos(2*lmoon) - 0.09*np.cos(2*omega))*arcsec
+    eps = (84381.448 - 46.8150*t - 0.00059*t**2 + 0.001813*t**3)*arcsec
+    gast = gmst + dpsi*np.cos(eps)
+
+    # IAU 1976 precession
+    zeta = (2306.2181*t + 0.30188*t**2 + 0.017998*t**3)*arcsec
+    z = (2306.2181*t + 1.09468*t**2 + 0.018203*t**3)*arcsec
+    theta = (2004.3109*t - 0.42665*t**2 - 0.041833*t**3)*arcsec
+
+    # J2000 -> mean of date -> true of date -> earth fixed
+    prec = np.einsum('tij,tjk,tkl->til', _rot(3, -z), _rot(2, theta), _rot(3, -zeta))
+    nut = np.einsum('tij,tjk,tkl->til', _rot(1, -(eps+deps)), _rot(3, -dpsi), _rot(1, eps))
+    earth = np.einsum('tij,tjk,tkl->til', _rot(3, gast), nut, prec)
+
+    # uvw axes in J2000 for phase center
+    sa, ca, sd, cd = np.sin(ra), np.cos(ra), np.sin(dec), np.cos(dec)
+    proj = np.array([[-sa, ca, 0.], [-sd*ca, -sd*sa, cd], [cd*ca, cd*sa, sd]])
+
+    # uvw = proj . earth^T . b_itrf
+    return np.einsum('ij,tkj->tik', proj, earth)
+
+def _rot(axis, angles):
+    """ Rotation matrices (n, 3, 3) of the coordinate frame by angles (radians) about axis 1, 2 or 3.
+    """
+
+    angles = np.atleast_1d(angles)
+    c, s = np.cos(angles), np.sin(angles)
+    one, zero = np.ones_like(angles), np.zeros_like(angles)
+    if axis == 1:
+        rows = [[one, zero, zero], [zero, c, s], [zero, -s, c]]
+    elif axis == 2:
+        rows = [[c, zero, -s], [zero, one, zero], [s, zero, c]]
     else:
-        stationidlist = [ant.stationId for ant in sdm['Antenna']]
-
-    positions = [station.position.strip().split(' ')
-                 for station in sdm['Station'] 
-                 if station.stationId in stationidlist]
-    x = [float(positions[i][2]) for i in range(len(positions))]
-    y = [float(positions[i][3]) for i in range(len(positions))]
-    z = [float(positions[i][4]) for i in range(len(positions))]
-    ants = me.position('itrf', qa.quantity(x, 'm'), qa.quantity(y, 'm'), qa.quantity(z, 'm'))
-
-    # calc bl
-    bls = me.asbaseline(ants)
-    uvwlist = me.expand(me.touvw(bls)[0])[1]['value']
-
-    # define new bl order to match sdm binary file bl order
-    u = np.empty(len(uvwlist)/3); v = np.empty(len(uvwlist)/3); w = np.empty(len(uvwlist)/3)
-    nants = len(ants['m0']['value'])
-    ord1 = [i*nants+j for i in range(nants) for j in range(i+1,nants)]
-    ord2 = [i*nants+j for j in range(nants) for i in range(j)]
-    key=[]
-    for new in ord2:
-        key.append(ord1.index(new))
-    for i in range(len(key)):
-        u[i] = uvwlist[3*key[i]]
-        v[i] = uvwlist[3*key[i]+1]
-        w[i] = uvwlist[3*key[i]+2]
-
-    return u, v, w
-
-def read_metadata(sdmfile, scan=0, bdfdir=None):
+        rows = [[c, s, zero], [-s, c, zero], [zero, zero, one]]
+
+    return np.transpose(np.array(rows), (2, 0, 1))
+
+@stats.timed('read_metadata')
+def read_metadata(sdmfile, scan=0, bdfdir=None, cachedir=None):
     """ Parses XML files to get scan and source information.
     Returns tuple of dicts (scan, source).
     bdfdir is optional location to look for bdfs, will try that first, then ASDMBinary subdirectory.
     bdfstr in scan dict helps find BDFs with read_bdf (with special behavior for prearchive data.
-    Optional arg scan can be used to speed up parsing for single scan.
+    Optional arg scan selects a single scan (and its source).
+    Metadata of all scans is parsed once and kept in memory and in cachedir (see cache module),
+    until one of the xml tables or bdfdir changes. cachedir='' keeps it only in memory.
     """
 
     sdmfile = sdmfile.rstrip('/')
@@ -173,103 +723,187 @@ def read_metadata(sdmfile, scan=0, bdfdir=None):
             bdfdir = os.path.join(sdmfile, 'ASDMBinary')
     else:
         bdfdir = os.path.join(sdmfile, 'ASDMBinary')
+
+    key = cache.metadata_key(sdmfile, bdfdir, _metadatatables)
+    cachedir = cache.get_cachedir(cachedir)
+    if key in _metadatacache:
+        metadata = _metadatacache.pop(key)
+        stats.count('metadata_memory_hit')
+        logger.debug('Using metadata of %s from memory' % sdmfile)
+    else:
+        metadata = cache.read_metadata(cachedir, key) if cachedir else None
+        if metadata is not None:
+            stats.count('metadata_cache_hit')
+            logger.info('Using cached metadata of %s' % sdmfile)
+        else:
+            stats.count('metadata_cache_miss')
+            metadata = _parse_metadata(sdmfile, bdfdir)
+            if cachedir:
+                cache.write_metadata(cachedir, key, metadata)
+
+    # keep most recently used at end
+    _metadatacache[key] = metadata
+    while len(_metadatacache) > _metadatacachesize:
+        _metadatacache.popitem(last=False)
+
+    return _select_scan(metadata, scan)
+
+_metadatatables = ['ASDM.xml', 'Scan.xml', 'Main.xml', 'Field.xml', 'Subscan.xml']
+_metadatacache = collections.OrderedDict()
+_metadatacachesize = 16
+
+def _select_scan(metadata, scan=0):
+    """ Copies scan and source dicts from metadata, optionally only for one scan and its source.
+    """
+
+    scandict, sourcedict = metadata
+    if scan != 0:
+        scandict = dict((k, v) for (k, v) in scandict.iteritems() if k == scan)
+        sources = [v['source'] for v in scandict.itervalues()]
+        sourcedict = dict((k, v) for (k, v) in sourcedict.iteritems() if v['source'] in sources)
+
+    return (dict((k, dict(v)) for (k, v) in scandict.iteritems()),
+            dict((k, dict(v)) for (k, v) in sourcedict.iteritems()))
+
+@stats.timed('parse_metadata')
+def _parse_metadata(sdmfile, bdfdir):
+    """ Parses XML files of sdmfile to get (scandict, sourcedict) for read_metadata.
+    Each table is read once, with Main and Field rows indexed by scanNumber and fieldName.
+    """
+
     logger.info('Looking for bdfs in %s' % bdfdir)
-    sdmfile = sdmfile.rstrip('/')
     scandict = {}; sourcedict = {}
 
     # read Scan.xml into dictionary also and make a list
-    sdm = sdmpy.SDM(sdmfile)
-    if len(sdm['Scan']) > 1:    # workaround: conversion from MS to SDM tends to make scans into subscans of one large scan
-        for i in range(len(sdm['Scan'])):
-            row  = sdm['Scan'][i]
+    scanrows = list(_read_table(sdmfile, 'Scan'))
+    subscanrows = list(_read_table(sdmfile, 'Subscan')) if len(scanrows) == 1 else []
+    if len(scanrows) > 1 or len(subscanrows) <= 1:    # workaround: conversion from MS to SDM tends to make scans into subscans of one large scan
+        mainrows = {}
+        for row in _read_table(sdmfile, 'Main'):
+            mainrows.setdefault(int(row['scanNumber']), row)      # first row of each scan
+        fieldrows = {}
+        for row in _read_table(sdmfile, 'Field'):
+            fieldrows.setdefault(row['fieldName'].strip(), row)   # first instance of each source
+        knownsources = set()
+
+        for row in scanrows:
             scannum = int(row['scanNumber'])
-            if scan in [0, scannum]:
-                rowkey = [k for k in row.keys if k.lower() == 'numsubscan'][0]   # need to find key but caps rule changes between ALMA/VLA
-                nsubs = int(row[rowkey])
-                scanintents = row['scanIntent']
-                intentstr = string.join(scanintents.strip().split(' ')[2:], ' ')
-                startmjd = float(row['startTime'])*1.0E-9/86400.0           # start and end times in mjd ns
-                endmjd = float(row['endTime'])*1.0E-9/86400.0
-                try:
-                    src = str(row["sourceName"])        # source name
-                except:
-                    logger.warn('Scan %d has no source name' % (len(scandict)+1))
-                finally:
-                    scandict[scannum] = {}
-                    scandict[scannum]['source'] = src
-                    scandict[scannum]['startmjd'] = startmjd
-                    scandict[scannum]['endmjd'] = endmjd
-                    scandict[scannum]['intent'] = intentstr
-                    scandict[scannum]['nsubs'] = nsubs
-                    scandict[scannum]['duration'] = endmjd-startmjd
-                    scandict[scannum]['nints'] = int(sdm['Main'][i]['numIntegration'])
-        
-                try:
-                    bdfstr = sdm['Main'][i]['dataUID'].replace(':', '_').replace('/', '_')
-                except KeyError:
-                    bdfstr = sdm['Main'][i]['dataOid'].replace(':', '_').replace('/', '_')
-
-                scandict[scannum]['bdfstr'] = os.path.join(bdfdir, bdfstr)
-
-                # clear reference to nonexistent BDFs (either bad or not in standard locations)
-                if (not os.path.exists(scandict[scannum]['bdfstr'])) or ('X1' in bdfstr):
-                    scandict[scannum]['bdfstr'] = None
-                    logger.debug('No bdf found scan %d of %s' % (scannum, sdmfile) )
-
-                if scandict[scannum]['source'] not in [sourcedict[source]['source'] for source in sourcedict.iterkeys()]:
-                    for row in sdm['Field']:
-                        src = row['fieldName'].strip()
-                        if src == scandict[scannum]['source']:
-                            sourcenum = int(row["sourceId"])
-                            direction = row["referenceDir"].strip()
-                            (ra,dec) = [float(val) for val in direction.strip().split(' ')[3:]]  # skip first two values in string
-
-                            # original version would add warning if two sources had different ra/dec. this makes one entry for every source
-                            sourcedict[sourcenum] = {}
-                            sourcedict[sourcenum]['source'] = src
-                            sourcedict[sourcenum]['ra'] = ra
-                            sourcedict[sourcenum]['dec'] = dec
-                            break  # just take first instance, then escape
-
-    elif ( (len(sdm['Scan']) == 1) and (len(sdm['Subscan']) > 1) ):
-        logger.warn('Found only one scan with multiple subscans. Treating subscans as scans.')
-        for row in sdm['Subscan']:
-            scannum = int(row['subscanNumber'])
-            if scan in [0, scannum]:
-                startmjd = float(row['startTime'])*1.0E-9/86400.0           # start and end times in mjd ns
-                endmjd = float(row['endTime'])*1.0E-9/86400.0
-                scanintents = row['subscanIntent']
-                if len(scanintents.strip().split(' ')) > 1:
-                    intentstr = string.join(scanintents.strip().split(' ')[2:], ' ')
-                else:
-                    intentstr = scanintents
-
-                try:
-                    src = row["fieldName"].strip()        # source name
-                except:
-                    logger.warn('Scan %d has no source name' % (len(scandict)+1))
-                finally:
-                    scandict[scannum] = {}
-                    scandict[scannum]['source'] = src
-                    scandict[scannum]['intent'] = intentstr
-                    scandict[scannum]['startmjd'] = startmjd
-                    scandict[scannum]['endmjd'] = endmjd
-                    scandict[scannum]['duration'] = endmjd-startmjd
-
+            rowkey = [k for k in row.keys() if k.lower() == 'numsubscan'][0]   # need to find key but caps rule changes between ALMA/VLA
+            nsubs = int(row[rowkey])
+            scanintents = row['scanIntent']
+            intentstr = string.join(scanintents.strip().split(' ')[2:], ' ')
+            startmjd = float(row['startTime'])*1.0E-9/86400.0           # start and end times in mjd ns
+            endmjd = float(row['endTime'])*1.0E-9/86400.0
+            if 'sourceName' in row:
+                src = str(row['sourceName'])        # source name
+            else:
+                logger.warn('Scan %d has no source name' % scannum)
+                src = None
+            mainrow = mainrows.get(scannum, {'numIntegration': '0', 'dataUID': ''})
+
+            scandict[scannum] = {}
+            scandict[scannum]['source'] = src
+            scandict[scannum]['startmjd'] = startmjd
+            scandict[scannum]['endmjd'] = endmjd
+            scandict[scannum]['intent'] = intentstr
+            scandict[scannum]['nsubs'] = nsubs
+            scandict[scannum]['duration'] = endmjd-startmjd
+            scandict[scannum]['nints'] = int(mainrow['numIntegration'])
 
+            try:
+                bdfstr = mainrow['dataUID'].replace(':', '_').replace('/', '_')
+            except KeyError:
+                bdfstr = mainrow['dataOid'].replace(':', '_').replace('/', '_')
+
+            scandict[scannum]['bdfstr'] = os.path.join(bdfdir, bdfstr)
+
+            # clear reference to nonexistent BDFs (either bad or not in standard locations)
+            if (not bdfstr) or (not os.path.exists(scandict[scannum]['bdfstr'])) or ('X1' in bdfstr):
+                scandict[scannum]['bdfstr'] = None
+                logger.debug('No bdf found scan %d of %s' % (scannum, sdmfile) )
+
+            if src not in knownsources and src in fieldrows:
+                knownsources.add(src)
+                field = fieldrows[src]
+                sourcenum = int(field["sourceId"])
+                direction = field["referenceDir"].strip()
+                (ra,dec) = [float(val) for val in direction.strip().split(' ')[3:]]  # skip first two values in string
+
+                # original version would add warning if two sources had different ra/dec. this makes one entry for every source
+                sourcedict[sourcenum] = {}
+                sourcedict[sourcenum]['source'] = src
+                sourcedict[sourcenum]['ra'] = ra
+                sourcedict[sourcenum]['dec'] = dec
 
+    else:
+        logger.warn('Found only one scan with multiple subscans. Treating subscans as scans.')
+        for row in subscanrows:
+            scannum = int(row['subscanNumber'])
+            startmjd = float(row['startTime'])*1.0E-9/86400.0           # start and end times in mjd ns
+            endmjd = float(row['endTime'])*1.0E-9/86400.0
+            scanintents = row['subscanIntent']
+            if len(scanintents.strip().split(' ')) > 1:
+                intentstr = string.join(scanintents.strip().split(' ')[2:], ' ')
+            else:
+                intentstr = scanintents
+
+            if 'fieldName' in row:
+                src = row["fieldName"].strip()        # source name
+            else:
+                logger.warn('Scan %d has no source name' % scannum)
+                src = None
+
+            scandict[scannum] = {}
+            scandict[scannum]['source'] = src
+            scandict[scannum]['intent'] = intentstr
+            scandict[scannum]['startmjd'] = startmjd
+            scandict[scannum]['endmjd'] = endmjd
+            scandict[scannum]['duration'] = endmjd-startmjd
+
+    return (scandict, sourcedict)
+
+def _read_table(sdmfile, name):
+    """ Generator over rows of an SDM table as dicts of strings.
+    name.xml is stream-parsed, so the whole table is never in memory.
+    Values in EntityRef elements (e.g., dataUID of Main) are given by their entityId.
+    Tables stored in binary form (name.bin) are read with sdmpy.
+    """
 
+    xmlname = os.path.join(sdmfile, name + '.xml')
+    if os.path.exists(xmlname):
+        nrows = 0
+        root = None
+        for event, elem in _elementtree().iterparse(xmlname, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event == 'end' and elem.tag.rsplit('}', 1)[-1] == 'row':
+                row = {}
+                for child in elem:
+                    if len(child):
+                        value = child[0].get('entityId', child.text)
+                    else:
+                        value = child.text
+                    row[child.tag.rsplit('}', 1)[-1]] = value if value is not None else ''
+                nrows += 1
+                yield row
+                root.clear()
+
+        if nrows or not os.path.exists(os.path.join(sdmfile, name + '.bin')):
+            return
 
-            
-    return [scandict, sourcedict]
+    import sdmpy
+    for row in sdmpy.SDM(sdmfile)[name]:
+        yield dict((key, str(row[key])) for key in row.keys)
 
 
 """
 Class for reading Binary Data File, the raw format for SDM data.
 
-Abuse the email.feedparser class to read the structure of a BDF binary file.
-We remember where the binary blobs are so we can mmap them into numpy arrays
-later.
+The BDF is a MIME multipart message: a header part with the sdmDataHeader xml,
+then one multipart/related part per integration holding a small xml subset
+header and one binary blob per data kind. We scan the MIME boundaries of the
+mmap'd file with find() and record where every binary blob of every
+integration starts, so we can mmap them into numpy arrays later.
 
 f = open ('/path/to/bdf_file')
 bdf = BDFData (f).parse ()
@@ -278,6 +912,11 @@ for i in xrange (bdf.n_integrations):
     nbl, nchan, npol = c.shape
     ....
 
+or, without copying anything out of the mmap:
+
+c = bdf.as_array ('crossData.bin')
+nint, nbl, nchan, npol = c.shape
+
 The following arrays can be retrieved with the get_data() function:
 
 crossData.bin: the basic cross-correlation data
@@ -290,10 +929,17 @@ autoData.bin: the basic auto-correlation data
 
 flags.bin: flags on the auto and cross correlations
   dtype: uint32
-  shape: (nbaselines + nantennas, nchans, npol)
-  FIXME: I don't know how the baseline/antenna dimension should be indexed!
-         Consult the BDF spec. Also, this will break if the BDF does not
-         contain auto+cross data.
+  shape: (nflags,), laid out as given by the axes attribute in the header.
+  Baseline flags (axis BAL) come first, then antenna flags (axis ANT), as in
+  the BDF spec. Flags may be per spw rather than per channel (no SPP axis)
+  and for all pols at once (no POL axis), and antenna flags are over the
+  single-dish pol products. Use get_flags to decode them into boolean masks
+  shaped like crossData.bin or autoData.bin.
+
+The index of the file is kept in per-kind arrays: offsets[kind][i] and
+sizes[kind][i] are the byte offset and size of the blob of that kind in
+integration i (-1 and 0 if the integration has no such blob), and times[i]
+is the mjd of integration i from its subset header.
 
 Shortcomings:
 
@@ -301,14 +947,18 @@ We hardcode the array axis orderings and which axis have non-unity size. This
 could theoretically all change under us.
 
 The BDF spec makes it sound like the different binary blobs are allowed to
-have differing sizes -- the "size" attribute in the header is a maximum. If
-this ever happens in practice, we're kind of dicked -- I don't see how we
-can guess the datachunk size without just reading it in. Let's hope that
-never happens.
+have differing sizes -- the "size" attribute in the header is a maximum.
+The scanner finds the real extent of every blob from the MIME boundaries, so
+the index stays right when blob sizes or integration spacing vary, but
+get_data can only reshape blobs of the full size and as_array needs evenly
+spaced integrations.
 
 BDF is little-endian as are x86 processors, so we ignore endianness issues.
 """
 
+avgblocksize = 32*1024**2   # bytes of full resolution data read per block by BDFData.average
+shardversion = 1            # format of shard dicts made by BDFData.shard
+
 _datatypes = {
     'autoData.bin': np.complex64,
     'crossData.bin': np.complex64,
@@ -319,90 +969,177 @@ nanttag = 'numAntenna'
 basebandtag = 'baseband'
 
 class BDFData (object):
-    def __init__ (self, fp, bdfpkldir=''):
-        """fp is an open, seekable filestream."""
+    def __init__ (self, fp, bdfpkldir='', cachedir=None, offset=0, length=0):
+        """fp is an open, seekable filestream.
+        bdfpkldir is ignored and only kept for old callers, which passed it
+        second, as BDFData(fp, bdfpkldir).
+        cachedir is directory for cached bdf index (see cache module).
+        None uses the default cache directory and '' turns caching off.
+        offset and length (0 is to the end of the file) map only those bytes of
+        the file, for a shard (see open_shard). The mapping starts at mapoffset,
+        offset rounded down to the mmap granularity, and offsets in the index
+        are relative to it."""
         self.fp = fp
-        self.mmdata = mmap.mmap (fp.fileno (), 0, mmap.MAP_PRIVATE, mmap.PROT_READ)
-        if bdfpkldir:
-            self.pklname = os.path.join(bdfpkldir, os.path.basename(self.fp.name) + '.pkl')
-        else:
-            self.pklname = ''
-
-    def parse(self):
-        """wrapper for original parse function. will read pkl with bdf info, if available."""
-
-        if os.path.exists(self.pklname):        # check for pkl with binary info
-            logger.info('Found bdf pkl file %s. Loading...' % (self.pklname))
-            try:
-                with open(self.pklname,'rb') as pkl:
-                    (self.mimemsg, self.headxml, self.sizeinfo, self.binarychunks, self.n_integrations, self.n_antennas, self.n_baselines, self.n_basebands, self.n_spws, self.n_channels, self.crosspols) = pickle.load(pkl)
-            except:
-                logger.warning('Something went wrong. Parsing bdf directly...')
-                self._parse()
-        else:
-            if self.pklname:
-                logger.info('Could not find bdf pkl file %s.' % (self.pklname))
-            self._parse()
+        self.mapoffset = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self.firstint = 0
+        maplength = length + offset - self.mapoffset if length else 0
+        self.mmdata = mmap.mmap (fp.fileno (), maplength, mmap.MAP_PRIVATE, mmap.PROT_READ, offset=self.mapoffset)
+        stats.count ('bytes_mapped', len (self.mmdata))
+        self.cachedir = cache.get_cachedir (cachedir)
+
+    def parse(self, follow=False):
+        """wrapper for original parse function. will read cached bdf index, if available.
+        follow=True is for a bdf that is still being written: it may have no complete
+        integrations yet, an index is only cached once the bdf is finished, and new
+        integrations are indexed with refresh."""
+
+        state = None
+        if self.cachedir:
+            with stats.timer('index_cache_read'):
+                state = cache.read_index(self.cachedir, self.fp.name)
+            if state is not None:
+                stats.count('index_cache_hit')
+                logger.info('Found cached index for bdf %s.' % (self.fp.name))
+                self._setstate(state)
+            else:
+                stats.count('index_cache_miss')
+
+        if state is None:
+            self._parse(follow=follow)
+            if self.cachedir and (self.finished or not follow):
+                logger.info('Writing index for bdf %s to cache %s...' % (self.fp.name, self.cachedir))
+                with stats.timer('index_cache_write'):
+                    cache.write_index(self.cachedir, self.fp.name, self._getstate())
 
+        self.n_pols = len(self.crosspols)
         self.headsize, self.intsize = self.calc_intsize()
 
         return self
 
-    def _parse (self):
-        """Parse the BDF mime structure and record the locations of the binary
-        blobs. Sets up various data fields in the BDFData object."""
+    _statekeys = ('sizeinfo', 'offsets', 'sizes', 'times', 'n_integrations', 'n_antennas', 'n_baselines',
+                  'n_basebands', 'n_spws', 'n_channels', 'crosspols', 'spw_nchans', 'flagaxes', 'boundary', 'finished',
+                  '_scanpos')
 
-        feedparser = FeedParser (Message)
-        binarychunks = {}
-        sizeinfo = None
-        headxml = None
-        self.fp.seek (0, 0)
+    def _getstate (self):
+        """Index of the bdf as dict of numbers, lists and numpy arrays."""
 
-        while True:
-            data = self.fp.readline ()
-            if not data:
-                break
+        return dict((key, getattr (self, key)) for key in self._statekeys)
 
-            feedparser.feed (data)
-
-            skip = (data == '\n' and
-                    len (feedparser._msgstack) == 3 and
-                    feedparser._msgstack[-1].get_content_type () in ('application/octet-stream',
-                                                                     'binary/octet-stream'))
-            if skip:
-                # We just finished reading the headers for a huge binary blob.
-                # Time to remember where the data chunk is and pretend it doesn't
-                # exist.
-                msg = feedparser._msgstack[-1]
-                ident = msg['Content-Location']
-                assert ident.endswith ('.bin'), 'confusion #1 in hacky MIME parsing!'
-                binarychunks[ident] = self.fp.tell ()
-                if sizeinfo is None:
-                    headxml, sizeinfo, tagpfx = _extract_size_info (feedparser)
-                kind = ident.split ('/')[-1]
-                assert kind in sizeinfo, 'no size info for binary chunk kind %s in MIME!' % kind
-                self.fp.seek (sizeinfo[kind] + 1, 1) # skip ahead by data chunk size
-                sample = self.fp.read (16)
-                assert sample.startswith ('--MIME'), 'crap, unexpected chunk size in MIME parsing: %r' % sample
-                self.fp.seek (-16, 1) # go back
-
-            # check that two major kinds of data are read at least once
-            if any([k.split('/')[3] == '3' for k in binarychunks.iterkeys()]):
-                break
+    def _setstate (self, state):
+        """Set index of the bdf from dict made by _getstate. The header xml is
+        not part of the index, so headxml is None."""
+
+        for key in self._statekeys:
+            setattr (self, key, state[key])
+        self.sizeinfo = dict((str (kind), size) for kind, size in self.sizeinfo.iteritems ())
+        self.crosspols = [str (pol) for pol in self.crosspols]
+        self.flagaxes = [str (axis) for axis in self.flagaxes]
+        self.headxml = None
+
+    @stats.timed ('bdf_scan')
+    def _parse (self, follow=False):
+        """Parse the BDF mime structure and record the locations of the binary
+        blobs. Sets up various data fields in the BDFData object.
+        follow=True allows a bdf without complete integrations."""
 
-        if headxml is None:
+        mm = self.mmdata
+
+        # top level headers give the boundary between the header and integrations
+        headers, pos = _read_mime_headers (mm, 0)
+        if headers is None:
+            raise RuntimeError ('bdf %s has no complete MIME headers' % self.fp.name)
+        self.boundary = _mime_boundary (headers)
+
+        # first part is the sdmDataHeader xml
+        pos = mm.find ('--' + self.boundary, pos)
+        if pos < 0:
             raise RuntimeError ('never found any binary data')
+        headers, start = _read_part_headers (mm, pos)
+        end = mm.find ('\n--' + self.boundary, start)
+        if headers is None or end < 0:
+            raise RuntimeError ('never found any binary data')
+        headxml, sizeinfo, tagpfx = _extract_size_info (mm[start:end])
 
-        self.mimemsg = feedparser.close ()
         self.headxml = headxml
         self.sizeinfo = sizeinfo
-        self.binarychunks = binarychunks
+        self._setdims (tagpfx)
+
+        # then scan every integration
+        self._offsets = dict((kind, []) for kind in sizeinfo)
+        self._sizes = dict((kind, []) for kind in sizeinfo)
+        self._times = []
+        self._template = None
+        self._scanpos = end + 1
+        self.finished = False
+        self._scan (warn=not follow)
+
+        if not self._times and not follow:
+            raise RuntimeError ('never found any binary data')
 
-        headsize, intsize = self.calc_intsize()
+        return self # convenience
+
+    def shard (self, start, stop):
+        """Shard of integrations start to stop as dict of numbers, strings and
+        lists (so it can be saved as json) for open_shard. Holds the path, size
+        and mtime of the bdf, the range of integrations, the byte range (offset,
+        length) of the file that holds their blobs and their index, with blob
+        offsets relative to the start of the byte range (-1 for missing blobs)."""
+
+        if not 0 <= start < stop <= self.n_integrations:
+            raise ValueError ('illegal shard of integrations %d to %d of %d' % (start, stop, self.n_integrations))
+
+        offsets = dict((kind, self.offsets[kind][start:stop]) for kind in self.offsets)
+        sizes = dict((kind, self.sizes[kind][start:stop]) for kind in self.sizes)
+        present = [offsets[kind] >= 0 for kind in offsets]
+        if not any ([mask.any () for mask in present]):
+            raise ValueError ('integrations %d to %d have no data' % (start, stop))
+        first = min ([int (offsets[kind][mask].min ()) for kind, mask in zip (offsets, present) if mask.any ()])
+        last = max ([int ((offsets[kind] + sizes[kind])[mask].max ()) for kind, mask in zip (offsets, present) if mask.any ()])
+
+        index = self._getstate ()
+        index.update ({'offsets': dict ((kind, np.where (offsets[kind] < 0, -1, offsets[kind] - first).tolist ()) for kind in offsets),
+                       'sizes': dict ((kind, sizes[kind].tolist ()) for kind in sizes),
+                       'times': self.times[start:stop].tolist (), 'n_integrations': stop - start,
+                       'finished': True, '_scanpos': None})
+        st = os.fstat (self.fp.fileno ()) if not self.fp.closed else os.stat (self.fp.name)
+
+        return {'version': shardversion, 'path': os.path.abspath (self.fp.name), 'filesize': st.st_size,
+                'mtime': int (st.st_mtime), 'start': self.firstint + start, 'stop': self.firstint + stop,
+                'offset': self.mapoffset + first, 'length': last - first, 'index': index}
+
+    def refresh (self):
+        """Index integrations written to the bdf since it was parsed. The file is
+        mapped again if it grew and the scan resumes after the last complete
+        integration, so bytes already indexed are not read again. Arrays from
+        before the refresh stay valid. Returns the number of new integrations."""
+
+        if self.finished:
+            return 0
+
+        with open (self.fp.name, 'r') as fp:
+            if os.fstat (fp.fileno ()).st_size > len (self.mmdata):
+                self.mmdata = mmap.mmap (fp.fileno (), 0, mmap.MAP_PRIVATE, mmap.PROT_READ)
+                stats.count ('bytes_mapped', len (self.mmdata))
+
+        # index from the cache has arrays only
+        if not hasattr (self, '_times'):
+            self._offsets = dict((kind, self.offsets[kind].tolist ()) for kind in self.offsets)
+            self._sizes = dict((kind, self.sizes[kind].tolist ()) for kind in self.sizes)
+            self._times = self.times.tolist ()
+            self._template = None
+
+        nint = self.n_integrations
+        with stats.timer ('bdf_scan'):
+            self._scan (warn=False)
+        self.headsize, self.intsize = self.calc_intsize ()
+
+        return self.n_integrations - nint
+
+    def _setdims (self, tagpfx):
+        """ Compute some miscellaneous parameters that we'll need from the header xml.
+        """
 
-        # Compute some miscellaneous parameters that we'll need.
-#        self.n_integrations = len (self.mimemsg.get_payload ()) - 1
-        self.n_integrations = os.stat(self.fp.name).st_size/intsize
+        headxml = self.headxml
         self.n_antennas = int (headxml.find (tagpfx + nanttag).text)
         self.n_baselines = (self.n_antennas * (self.n_antennas - 1)) // 2
 
@@ -411,6 +1148,7 @@ class BDFData (object):
         nspw = 0
         nchan = 0
         crosspolstr = None
+        spw_nchans = []
 
         for bb in ds.findall (tagpfx + basebandtag):
             nbb += 1
@@ -418,6 +1156,7 @@ class BDFData (object):
             for spw in bb.getchildren ():
                 nspw += 1
                 nchan += int (spw.get ('numSpectralPoint'))
+                spw_nchans.append (int (spw.get ('numSpectralPoint')))
 
                 if crosspolstr is None:
                     crosspolstr = spw.get ('crossPolProducts')
@@ -428,57 +1167,589 @@ class BDFData (object):
         self.n_spws = nspw
         self.n_channels = nchan
         self.crosspols = crosspolstr.split ()
-        self.n_pols = len(self.crosspols)
-
-        # if bdf info pkl not present, write it
-        if os.path.exists(os.path.dirname(self.pklname)) and self.pklname and (not os.path.exists(self.pklname)):
-            logger.info('Writing bdf pkl info to %s...' % (self.pklname))
-            with open(self.pklname,'wb') as pkl:
-                # Compute some miscellaneous parameters that we'll need.
-                pickle.dump( (self.mimemsg, self.headxml, self.sizeinfo, self.binarychunks, self.n_integrations, self.n_antennas, self.n_baselines, self.n_basebands, self.n_spws, self.n_channels, self.crosspols), pkl)
-
-        return self # convenience
-
-    def get_data (self, datakind, integnum):
+        self.spw_nchans = spw_nchans
+
+        flags = ds.find (tagpfx + fgtag)
+        self.flagaxes = flags.get ('axes', '').split () if flags is not None else []
+
+    @property
+    def spw_chanoffsets (self):
+        """First channel of each spw on the channel axis of the data."""
+
+        return np.cumsum ([0] + self.spw_nchans[:-1])
+
+    @property
+    def baselines (self):
+        """(n_baselines, 2) array of antenna indices of each baseline, in bdf order."""
+
+        return np.array ([(i, j) for j in range (self.n_antennas) for i in range (j)], dtype=int).reshape (-1, 2)
+
+    def selection (self, spws=None, chans=None, bls=None, ants=None, pols=None):
+        """Index for the (baseline, channel, pol) axes of crossData.bin for read().
+        spws is list of spw numbers (0-based, in bdf order).
+        chans is slice, (start, stop) tuple or list of channels, counted over the selected spws.
+        Negative slice bounds count from the end as usual, but list entries must be in range.
+        bls is list of baseline numbers. ants is list of antenna numbers, selecting baselines between them.
+        pols is list of pol products (e.g., ['RR', 'LL']) or their numbers.
+        Each index is a slice where the selection is contiguous, else an array.
+        Raises ValueError for spws, baselines, antennas or pols not in the bdf,
+        for channels out of range and if no channels are selected."""
+
+        blidx = np.arange (self.n_baselines)
+        if ants is not None:
+            unknown = [ant for ant in ants if ant not in range (self.n_antennas)]
+            if unknown:
+                raise ValueError ('antennas %s not in bdf %s with %d antennas' % (unknown, self.fp.name, self.n_antennas))
+            bl = self.baselines
+            blidx = blidx[np.in1d (bl[:,0], ants) & np.in1d (bl[:,1], ants)]
+        if bls is not None:
+            unknown = [bl for bl in bls if bl not in range (self.n_baselines)]
+            if unknown:
+                raise ValueError ('baselines %s not in bdf %s with %d baselines' % (unknown, self.fp.name, self.n_baselines))
+            blset = set (blidx.tolist ())
+            blidx = np.array ([bl for bl in bls if bl in blset], dtype=int)
+
+        chanidx = np.arange (self.n_channels)
+        if spws is not None:
+            unknown = [spw for spw in spws if spw not in range (self.n_spws)]
+            if unknown:
+                raise ValueError ('spws %s not in bdf %s with %d spws' % (unknown, self.fp.name, self.n_spws))
+            offsets = self.spw_chanoffsets
+            chanidx = np.concatenate ([np.arange (offsets[spw], offsets[spw] + self.spw_nchans[spw]) for spw in spws] or [[]]).astype (int)
+        if chans is not None:
+            if isinstance (chans, tuple):
+                chans = slice (*chans)
+            nchan = len (chanidx)
+            if isinstance (chans, slice):
+                unknown = [val for val in (chans.start, chans.stop) if val is not None and not -nchan <= val <= nchan]
+            else:
+                unknown = [chan for chan in chans if chan not in range (nchan)]
+            if unknown:
+                raise ValueError ('channels %s out of range of %d selected channels' % (unknown, nchan))
+            chanidx = chanidx[chans]
+        if not len (chanidx):
+            raise ValueError ('no channels selected with spws %s and chans %s' % (spws, chans))
+
+        polidx = np.arange (len (self.crosspols))
+        if pols is not None:
+            unknown = [pol for pol in pols if pol not in self.crosspols and pol not in range (len (self.crosspols))]
+            if unknown:
+                raise ValueError ('pols %s not in bdf %s with pols %s' % (unknown, self.fp.name, self.crosspols))
+            polidx = np.array ([self.crosspols.index (pol) if pol in self.crosspols else pol for pol in pols], dtype=int)
+
+        return tuple ([_as_slice (idx) for idx in (blidx, chanidx, polidx)])
+
+    def _scan (self, warn=True):
+        """Index all complete integrations from self._scanpos on.
+        An integration is laid out like the one before it, shifted by a fixed
+        stride, whenever the headers around its predicted blob positions match;
+        then it is indexed without searching. Otherwise its MIME parts are read.
+        Stops at the closing boundary or at the first incomplete integration,
+        with a warning about the latter if warn is True."""
+
+        nint = nint0 = len (self._times)
+        while True:
+            if self._template is not None:
+                scanpos = self._predict (nint)
+                if scanpos is not None:
+                    self._scanpos = scanpos
+                    nint += 1
+                    continue
+
+            scanpos = self._scanint (nint)
+            if scanpos is None:
+                break
+            self._scanpos = scanpos
+            nint += 1
+
+        self.offsets = dict((kind, np.array (self._offsets[kind], dtype=np.int64)) for kind in self._offsets)
+        self.sizes = dict((kind, np.array (self._sizes[kind], dtype=np.int64)) for kind in self._sizes)
+        self.times = np.array (self._times, dtype=np.float64)
+        stats.count ('ints_indexed', len (self._times) - nint0)
+        self.n_integrations = len (self._times)
+
+        if warn and not self.finished:
+            logger.warn ('bdf %s ends after %d complete integrations without closing boundary' % (self.fp.name, self.n_integrations))
+
+    def _scanint (self, nint):
+        """Read the MIME parts of the integration starting at self._scanpos,
+        append it to the index and return the position after it. Returns None
+        if there is no complete integration there."""
+
+        mm = self.mmdata
+        outer = '--' + self.boundary
+
+        pos = mm.find (outer, self._scanpos)
+        if pos < 0:
+            self.finished = False
+            return None
+        if mm[pos+len (outer):pos+len (outer)+2] == '--':
+            self.finished = True
+            return None
+        self.finished = False
+
+        headers, pos = _read_part_headers (mm, pos)
+        if headers is None:
+            return None
+        inner = '--' + _mime_boundary (headers)
+        delim = '\n' + inner
+
+        blobs = {}
+        hdrs = {}
+        time = timepos = None
+        pos = mm.find (inner, pos)
+        while pos >= 0 and mm[pos+len (inner):pos+len (inner)+2] != '--':
+            partpos = pos
+            headers, start = _read_part_headers (mm, pos)
+            if headers is None:
+                return None
+
+            location = headers.get ('content-location', '')
+            if location.endswith ('.bin'):
+                kind = location.split ('/')[-1]
+                size = self.sizeinfo.get (kind, -1)
+                if mm[start+size:start+size+len (delim)] != delim:
+                    # blob is not of the size in header, so look for its end
+                    end = mm.find (delim, start)
+                    if end < 0:
+                        return None
+                    size = end - start
+                blobs[kind] = (start, size)
+                hdrs[kind] = mm[partpos:start]
+                pos = mm.find (inner, start + size)
+            else:
+                end = mm.find (delim, start)
+                if end < 0:
+                    return None
+                match = _timeregex.search (mm[start:end])
+                if match:
+                    time = int (match.group (2))
+                    timepos = start + match.start (2)
+                pos = end + 1
+
+        if pos < 0:
+            return None
+        endpos = pos + len (inner) + 2
+        if endpos > len (mm):
+            return None
+
+        self._append (nint, blobs, time)
+
+        # remember the layout, so the next integration can be predicted from it
+        if blobs and timepos is not None and all (k in blobs for k in self._offsets):
+            template = {'endpos': endpos, 'blobs': blobs, 'hdrs': hdrs,
+                        'timepos': timepos, 'timelen': len (match.group (2)), 'timepfx': match.group (1),
+                        'inner': inner, 'nint': nint}
+            template['stride'] = endpos - self._scanpos
+            self._template = template
+        else:
+            self._template = None
+
+        return endpos
+
+    def _predict (self, nint):
+        """Index integration nint, if it has the layout of the integration in
+        self._template shifted by its stride. Returns position after it or None."""
+
+        mm = self.mmdata
+        template = self._template
+        shift = template['stride'] * (nint - template['nint'])
+        endpos = template['endpos'] + shift
+        if endpos > len (mm) or mm[endpos-len (template['inner'])-2:endpos] != template['inner'] + '--':
+            return None
+
+        # integration number in Content-Location counts from 1
+        old = '/%d/' % (template['nint'] + 1)
+        new = '/%d/' % (nint + 1)
+        blobs = {}
+        for kind, (start, size) in template['blobs'].iteritems ():
+            start = start + shift
+            hdr = new.join (template['hdrs'][kind].rsplit (old, 1))
+            if mm[start-len (hdr):start] != hdr:
+                return None
+            end = start + size
+            if mm[end:end+len (template['inner'])+1] != '\n' + template['inner']:
+                return None
+            blobs[kind] = (start, size)
+
+        timepos = template['timepos'] + shift
+        pfx = template['timepfx']
+        timestr = mm[timepos:timepos+template['timelen']]
+        if mm[timepos-len (pfx):timepos] != pfx or not timestr.isdigit () or mm[timepos+len (timestr)] != '<':
+            return None
+
+        self._append (nint, blobs, int (timestr))
+        return endpos
+
+    def _append (self, nint, blobs, time):
+        """Add blob locations and time of an integration to the index."""
+
+        for kind in self._offsets:
+            start, size = blobs.get (kind, (-1, 0))
+            self._offsets[kind].append (start)
+            self._sizes[kind].append (size)
+        self._times.append (time * 1.0E-9/86400.0 if time is not None else np.nan)
+
+    @stats.timed ('get_data')
+    def get_data (self, datakind, integnum, out=None, dtype=None, layout='interleaved', scale=None):
         """Given an integration number (0 <= integnum < self.n_integrations) and a
-        data kind ('crossData.bin', 'autoData.bin'), memory-map the corresponding data
-        and return a wrapping numpy array."""
+        data kind ('crossData.bin', 'autoData.bin'), copy the data out of the
+        memory map into a numpy array of shape get_shape(datakind).
+        dtype, layout and scale convert the data as in read, so the array has
+        the shape of get_outshape(datakind, 1, None, dtype, layout) without its
+        integration axis. Given out must have that shape; its dtype is used if
+        dtype is None. The data is copied once, straight from the mmap."""
 
         if integnum < 0 or integnum >= self.n_integrations:
             raise ValueError ('illegal integration number %d' % integnum)
 
+        if datakind not in self.sizeinfo:
+            raise ValueError ('unrecognized data kind "%s"' % datakind)
+
+        offset = self.offsets[datakind][integnum]
+        size = self.sizes[datakind][integnum]
+        if offset < 0:
+            raise ValueError ('integration %d has no data of kind "%s"' % (integnum, datakind))
+        if size != self.sizeinfo[datakind]:
+            raise ValueError ('data of kind "%s" in integration %d is %d bytes, not %d' % (datakind, integnum, size, self.sizeinfo[datakind]))
+
+        if dtype is None:
+            dtype = out.dtype if out is not None else _datatypes[datakind]
+        shape = list (self.get_outshape (datakind, 1, None, dtype, layout))
+        axis = 1 if layout == 'planar' else 0
+        del shape[axis]
+        if out is None:
+            out = np.empty (shape, dtype=dtype)
+        elif out.shape != tuple (shape) or out.dtype != np.dtype (dtype):
+            raise ValueError ('out is %s of shape %s, not %s of shape %s' % (out.dtype, out.shape, np.dtype (dtype), tuple (shape)))
+
+        view = np.ndarray (self.get_shape (datakind), dtype=_datatypes[datakind], buffer=self.mmdata, offset=int (offset))
+        stats.count ('bytes_copied', out.nbytes)
+        _convert (view[np.newaxis], None, np.expand_dims (out, axis), scale, layout)
+
+        return out
+
+    @stats.timed ('read')
+    def read (self, datakind, start, stop, out=None, sel=None, dtype=None, layout='interleaved', scale=None):
+        """Copy integrations start to stop of a data kind into array out
+        (allocated if not given) of shape get_outshape(datakind, stop-start, sel, dtype, layout).
+        sel is optional tuple of indexes for the axes after the integration axis
+        (e.g., from selection()). Only the selected data is gathered from the file.
+        Each run of evenly spaced integrations is copied through one strided view.
+
+        dtype, layout and scale convert complex data in the same pass as the copy.
+        dtype is the output dtype (default that of the data kind). A real dtype
+        (e.g., float32, float16 or int16) holds (real, imag) pairs, interleaved in a
+        last axis of length 2 (layout='interleaved') or as two planes in a first
+        axis of length 2 (layout='planar'). scale multiplies the data before it is
+        cast. Casts to integers truncate, so scale should fit the data in range.
+        Given out must have the output shape; its dtype is used if dtype is None."""
+
+        self._check_range (start, stop)
+        if dtype is None:
+            dtype = out.dtype if out is not None else _datatypes[datakind]
+        shape = self.get_outshape (datakind, stop - start, sel, dtype, layout)
+        if out is None:
+            out = np.empty (shape, dtype=dtype)
+        elif out.shape != shape or out.dtype != np.dtype (dtype):
+            raise ValueError ('out is %s of shape %s, not %s of shape %s' % (out.dtype, out.shape, np.dtype (dtype), shape))
+
+        convert = out.dtype != np.dtype (_datatypes[datakind]) or scale is not None
+        for i0, i1 in self.runs (datakind, start, stop):
+            view = self.get_view (datakind, i0, i1)
+            if layout == 'planar':
+                _convert (view, sel, out[:, i0-start:i1-start], scale, layout)
+            elif convert:
+                _convert (view, sel, out[i0-start:i1-start], scale, layout)
+            else:
+                _gather (view, sel, out[i0-start:i1-start])
+        stats.count ('ints_read', stop - start)
+        stats.count ('bytes_copied', out.nbytes)
+
+        return out
+
+    def get_outshape (self, datakind, nints, sel=None, dtype=None, layout='interleaved'):
+        """Shape of the array read returns for nints integrations, selection sel
+        and output dtype and layout. Complex data read into a real dtype has an
+        axis of length 2 for (real, imag), last or (layout='planar') first."""
+
+        if layout not in ('interleaved', 'planar'):
+            raise ValueError ('layout must be "interleaved" or "planar", not "%s"' % layout)
+
+        shape = (nints,) + self.get_shape (datakind, sel)
+        if dtype is None or np.dtype (dtype).kind == 'c' or np.dtype (_datatypes[datakind]).kind != 'c':
+            if layout == 'planar':
+                raise ValueError ('planar layout needs complex data read into a real dtype')
+            return shape
+
+        return (2,) + shape if layout == 'planar' else shape + (2,)
+
+    @stats.timed ('average')
+    def average (self, start, stop, tavg=1, favg=1, sel=None, flags=False, out=None, blocksize=None):
+        """Average crossData.bin of integrations start to stop in bins of tavg
+        integrations and favg channels (counted over the selected channels).
+        Partial bins at the end are left out. Returns array out of shape
+        (nints // tavg, nbl, nchan // favg, npol).
+        Data is read in blocks of whole time bins of about blocksize bytes
+        (default avgblocksize) into one reused buffer, so memory use is the
+        output and one block.
+        flags=True leaves flagged samples out of the averages and returns tuple
+        (out, weights), where weights is the number of unflagged samples in
+        each bin. Bins with all samples flagged have weight 0 and data 0."""
+
+        self._check_range (start, stop)
+        # leave channels of partial bins out of the selection, so blocks reshape into bins without copies
+        sel = tuple (sel or (slice (None),) * 3)
+        chanidx = np.arange (self.n_channels)[sel[1]]
+        nf = len (chanidx) // favg
+        sel = (sel[0], _as_slice (chanidx[:nf * favg]), sel[2])
+        shape = self.get_shape ('crossData.bin', sel)
+        nt = (stop - start) // tavg
+
+        outshape = (nt, shape[0], nf, shape[2])
+        if out is None:
+            out = np.empty (outshape, dtype=np.complex64)
+        weights = np.empty (outshape, dtype=np.float32) if flags else None
+
+        binsize = tavg * int (np.prod (shape)) * np.dtype (np.complex64).itemsize
+        nbins = max (1, (blocksize or avgblocksize) // max (binsize, 1))
+        buf = np.empty ((min (nbins, nt) * tavg,) + shape, dtype=np.complex64)
+        for t0 in xrange (0, nt, nbins):
+            t1 = min (t0 + nbins, nt)
+            i0, i1 = start + t0 * tavg, start + t1 * tavg
+            block = self.read ('crossData.bin', i0, i1, out=buf[:i1 - i0], sel=sel)
+            block = block.reshape ((t1 - t0, tavg, shape[0], nf, favg, shape[2]))
+            if flags:
+                flagged = self.get_flags (i0, i1, sel=sel).reshape (block.shape)
+                np.putmask (block, flagged, 0)
+                np.sum (~flagged, axis=(1, 4), out=weights[t0:t1])
+                np.sum (block, axis=(1, 4), out=out[t0:t1])
+                np.divide (out[t0:t1], np.maximum (weights[t0:t1], 1), out=out[t0:t1])
+            else:
+                np.sum (block, axis=(1, 4), out=out[t0:t1])
+                out[t0:t1] /= tavg * favg
+
+        if flags:
+            return out, weights
+        return out
+
+    @stats.timed ('get_flags')
+    def get_flags (self, start, stop, sel=None, autos=False):
+        """Boolean flags (True is flagged) for integrations start to stop, of shape
+        (stop-start,) + get_shape('crossData.bin', sel). With autos=True, flags of the
+        antennas, of shape (stop-start, n_antennas, n_channels, npol), where npol is the
+        number of single-dish pols (1 if flags are for all pols); sel then indexes
+        (antennas, channels, pols). Flags given per spw or for all pols are spread over
+        channels and pols. Integrations without flags are not flagged."""
+
+        self._check_range (start, stop)
+        crossunits, autounits, crosspols, autopols = self.flag_layout ()
+        if autos:
+            nrows, units, npol, fullpol = self.n_antennas, autounits, autopols, autopols
+            skip = self.n_baselines * crossunits * crosspols
+        else:
+            nrows, units, npol, fullpol = self.n_baselines, crossunits, crosspols, len (self.crosspols)
+            skip = 0
+
+        sel = sel or (slice (None),) * 3
+        shape = tuple ([len (range (n)[idx]) if isinstance (idx, slice) else len (idx)
+                        for n, idx in zip ((nrows, self.n_channels, max (fullpol, 1)), sel)])
+        out = np.zeros ((stop - start,) + shape, dtype=bool)
+        if not npol:
+            return out
+
+        # map selected channels and pols to the units flags are given in
+        if units == self.n_channels:
+            chanunits = np.arange (self.n_channels)
+        elif units == self.n_spws:
+            chanunits = np.repeat (np.arange (self.n_spws), self.spw_nchans)
+        else:
+            chanunits = np.zeros (self.n_channels, dtype=int)
+        polunits = np.arange (fullpol) if npol == fullpol else np.zeros (fullpol, dtype=int)
+        fsel = (sel[0], _as_slice (chanunits[sel[1]]), _as_slice (polunits[sel[2]]))
+
+        offsets = self.offsets['flags.bin'][start:stop]
+        for i0, i1 in _segments (offsets >= 0):
+            for r0, r1 in self.runs ('flags.bin', start + i0, start + i1):
+                raw = self.get_view ('flags.bin', r0, r1)[:, skip:skip + nrows * units * npol]
+                raw = raw.reshape ((r1 - r0, nrows, units, npol))
+                flags = _gather (raw, fsel, np.empty ((r1 - r0,) + shape, dtype=raw.dtype))
+                np.not_equal (flags, 0, out=out[r0-start:r1-start])
+
+        return out
+
+    def flag_layout (self):
+        """Layout of flags.bin from its axes as tuple (crossunits, autounits, crosspols, autopols).
+        units is number of channels (SPP axis) or spws (no SPP axis) per baseline or antenna.
+        pols is number of pols per unit (1 without POL axis) or 0 if there are no such flags."""
+
+        if 'flags.bin' not in self.sizeinfo:
+            return (0, 0, 0, 0)
+
+        axes = self.flagaxes or ['BAL', 'ANT', 'BAB', 'SPW', 'SPP', 'POL']
+        if 'BAB' in axes and 'SPW' not in axes and 'SPP' not in axes and self.n_basebands != self.n_spws:
+            raise ValueError ('cannot decode flags per baseband (axes %s)' % ' '.join (axes))
+        units = self.n_channels if 'SPP' in axes else (self.n_spws if 'SPW' in axes or 'BAB' in axes else 1)
+
+        nflags = self.sizeinfo['flags.bin'] // 4
+        crosspols = (len (self.crosspols) if 'POL' in axes else 1) if 'BAL' in axes else 0
+        rest = nflags - self.n_baselines * units * crosspols
+        autopols = 0
+        if 'ANT' in axes:
+            autopols, extra = divmod (rest, self.n_antennas * units)
+            rest = extra
+        if rest or (autopols and 'POL' not in axes and autopols != 1):
+            raise ValueError ('flags size %d does not match axes %s' % (nflags, ' '.join (axes)))
+
+        return (units if crosspols else 0, units if autopols else 0, crosspols, autopols)
+
+    def _check_range (self, start, stop):
+        """Raise ValueError unless 0 <= start <= stop <= n_integrations."""
+
+        if not 0 <= start <= stop <= self.n_integrations:
+            raise ValueError ('illegal integration range %d to %d of bdf %s with %d integrations'
+                              % (start, stop, self.fp.name, self.n_integrations))
+
+    def time_range (self, tstart=None, tstop=None):
+        """Range (start, stop) of integrations with times (mjd) tstart <= t < tstop,
+        found by binary search of the times in the index. None is an open end.
+        Times are those of the subset headers, which increase through the bdf."""
+
+        times = self.times
+        if np.isnan (times).any ():
+            raise ValueError ('bdf %s has integrations without time' % self.fp.name)
+
+        start = np.searchsorted (times, tstart, 'left') if tstart is not None else 0
+        stop = np.searchsorted (times, tstop, 'left') if tstop is not None else len (times)
+
+        return int (start), int (max (start, stop))
+
+    def advise (self, start, stop):
+        """Ask the kernel to read integrations start to stop ahead of use (see prefetch.willneed)."""
+
+        if stop <= start:
+            return False
+        starts = [self.offsets[kind][start:stop] for kind in self.offsets]
+        starts = np.concatenate ([offs[offs >= 0] for offs in starts])
+        if not len (starts):
+            return False
+        ends = np.concatenate ([(self.offsets[kind] + self.sizes[kind])[start:stop] for kind in self.offsets])
+
+        return willneed (self.mmdata, int (starts.min ()), int (ends.max () - starts.min ()))
+
+    def as_array (self, datakind):
+        """Return all integrations of a data kind as one read-only numpy array of
+        shape (n_integrations,) + get_shape(datakind). The array is a strided view
+        directly on the mmap of the file, so no data is copied until it is used.
+        Only possible when integrations sit at a fixed stride (see is_regular)."""
+
+        if datakind in self.sizeinfo and not self.is_regular (datakind):
+            raise ValueError ('%s in bdf %s is not evenly spaced. Use read or get_data.' % (datakind, self.fp.name))
+
+        return self.get_view (datakind, 0, self.n_integrations)
+
+    def get_view (self, datakind, start, stop):
+        """Read-only strided view on the mmap for integrations start to stop,
+        which must all have full-size blobs at a fixed stride."""
+
         size = self.sizeinfo.get (datakind)
         if size is None:
             raise ValueError ('unrecognized data kind "%s"' % datakind)
 
-        dtype = _datatypes[datakind]
-        offset = self.headsize + integnum * self.intsize
-        dslice = self.mmdata[offset:offset+size]
-        data = np.fromstring (dslice, dtype=dtype)
+        dtype = np.dtype (_datatypes[datakind])
+        shape = self.get_shape (datakind)
+        offsets = self.offsets[datakind][start:stop]
+        stride = offsets[1] - offsets[0] if len (offsets) > 1 else size
+        if len (offsets) and (offsets.min () < 0 or (self.sizes[datakind][start:stop] != size).any ()
+                              or (np.diff (offsets) != stride).any ()):
+            raise ValueError ('%s in integrations %d to %d is not evenly spaced' % (datakind, start, stop))
+
+        # C-order strides within an integration, fixed stride between integrations
+        strides = [dtype.itemsize]
+        for n in shape[:0:-1]:
+            strides.insert (0, strides[0] * n)
+
+        data = np.ndarray ((len (offsets),) + shape, dtype=dtype, buffer=self.mmdata,
+                           offset=int (offsets[0]) if len (offsets) else 0, strides=[int (stride)] + strides)
+        data.flags.writeable = False
+
+        return data
+
+    def runs (self, datakind, start, stop):
+        """Split integrations start to stop into (i0, i1) runs that can each be
+        viewed with get_view. Raises ValueError for missing or partial blobs."""
+
+        offsets = self.offsets[datakind][start:stop]
+        sizes = self.sizes[datakind][start:stop]
+        bad = np.flatnonzero ((offsets < 0) | (sizes != self.sizeinfo[datakind]))
+        if len (bad):
+            i = start + bad[0]
+            raise ValueError ('data of kind "%s" in integration %d is %d bytes, not %d' % (datakind, i, self.sizes[datakind][i], self.sizeinfo[datakind]))
+
+        # a run ends where the spacing to the next integration changes
+        steps = np.diff (offsets)
+        changes = np.flatnonzero (steps[1:] != steps[:-1]) + 1
+        i0 = 0
+        while i0 < len (offsets):
+            j = np.searchsorted (changes, i0 + 1)
+            i1 = changes[j] + 1 if j < len (changes) else len (offsets)
+            yield start + i0, start + i1
+            i0 = i1
+
+    def is_regular (self, datakind):
+        """True if every integration has a full-size blob of datakind at a fixed
+        stride, so the data can be viewed with as_array."""
+
+        offsets = self.offsets[datakind]
+        sizes = self.sizes[datakind]
+        if not len (offsets) or offsets.min () < 0 or (sizes != self.sizeinfo[datakind]).any ():
+            return False
+
+        return len (offsets) < 3 or (np.diff (offsets) == offsets[1] - offsets[0]).all ()
+
+    def get_shape (self, datakind, sel=None):
+        """Shape of the data in one integration for a given data kind.
+        With sel (see read), shape of the selected data."""
 
         if datakind == 'crossData.bin':
-            data = data.reshape ((self.n_baselines, self.n_channels, len (self.crosspols)))
+            shape = (self.n_baselines, self.n_channels, len (self.crosspols))
         elif datakind == 'autoData.bin':
-            data = data.reshape ((self.n_antennas, self.n_channels, 2))
+            shape = (self.n_antennas, self.n_channels, 2)
         elif datakind == 'flags.bin':
-            data = data.reshape ((self.n_baselines + self.n_antennas, self.n_channels,
-                                  len (self.crosspols)))
+            shape = (self.sizeinfo['flags.bin'] // 4,)
+        else:
+            raise ValueError ('unrecognized data kind "%s"' % datakind)
 
-        return data
+        if sel is not None:
+            shape = tuple ([len (range (n)[idx]) if isinstance (idx, slice) else len (idx)
+                            for n, idx in zip (shape, sel)]) + shape[len (sel):]
+
+        return shape
+
+    def calc_offset (self, datakind):
+        """ Calculates the byte offset of a data kind in the first integration
+        """
+
+        offsets = self.offsets.get (datakind)
+        if offsets is None or not len (offsets) or offsets[0] < 0:
+            raise ValueError ('no binary chunk of kind "%s" in first integration' % datakind)
+
+        return int (offsets[0])
 
     def calc_intsize(self):
-        """ Calculates the size of an integration (cross + auto) in bytes
+        """ Calculates the size of an integration (cross + auto) in bytes.
+        intsize is None if integrations are not evenly spaced.
         """
 
-        # assume first cross blob starts after headxml and second is one int of bytes later
-        for k in self.binarychunks.iterkeys():
-            if int(k.split('/')[3]) == 1 and 'cross' in k.split('/')[-1]:
-                headsize = self.binarychunks[k]
-                break
-        for k in self.binarychunks.iterkeys():
-            if int(k.split('/')[3]) == 2 and 'cross' in k.split('/')[-1]:
-                intsize = self.binarychunks[k] - headsize
-                break
+        if not self.n_integrations:
+            return (None, None)
+
+        # first cross blob starts after headxml and second is one int of bytes later
+        headsize = self.calc_offset('crossData.bin')
+        if self.n_integrations > 1 and self.is_regular('crossData.bin'):
+            intsize = int(self.offsets['crossData.bin'][1]) - headsize
+        else:
+            intsize = None
 
         return (headsize, intsize)
 
@@ -489,11 +1760,158 @@ cdtag = 'crossData'
 adtag = 'autoData'
 fgtag = 'flags'
 
-def _extract_size_info (feedparser):
+def _as_slice (idx):
+    """ Returns index array as equivalent slice, if it is a contiguous range.
+    """
+
+    if len (idx) and (np.diff (idx) == 1).all ():
+        return slice (int (idx[0]), int (idx[-1]) + 1)
+    elif not len (idx):
+        return slice (0, 0)
+
+    return idx
+
+def _segments (mask):
+    """ Returns list of (i0, i1) ranges where boolean array mask is True.
+    """
+
+    edges = np.flatnonzero (np.diff (np.concatenate (([0], mask.astype (np.int8), [0]))))
+    return zip (edges[::2], edges[1::2])
+
+def _gather (data, sel, out):
+    """ Copies data[:, sel...] into out, touching only the selected elements of data.
+    Slices are applied as views. Index arrays are gathered in one pass.
+    """
+
+    if sel is None:
+        out[:] = data
+        return out
+
+    data = data[(slice (None),) + tuple ([idx if isinstance (idx, slice) else slice (None) for idx in sel])]
+    fancy = [(axis, idx) for axis, idx in enumerate (sel) if not isinstance (idx, slice)]
+    if not fancy:
+        out[:] = data
+    elif len (fancy) == 1 and out.flags.c_contiguous:
+        np.take (data, fancy[0][1], axis=fancy[0][0]+1, out=out)
+    else:
+        index = [np.arange (n) for n in data.shape]
+        for axis, idx in fancy:
+            index[axis+1] = idx
+        out[:] = data[np.ix_ (*index)]
+
+    return out
+
+def _index_runs (idx):
+    """ Returns list of (source, destination) slice pairs of the contiguous runs of index array
+    (or slice) idx, so that data[source] is out[destination] for out = data[idx].
+    """
+
+    if isinstance (idx, slice):
+        return [(idx, slice (None))]
+
+    idx = np.asarray (idx)
+    breaks = np.flatnonzero (np.diff (idx) != 1) + 1
+    starts = np.concatenate (([0], breaks))
+    stops = np.concatenate ((breaks, [len (idx)]))
+    return [(slice (int (idx[a]), int (idx[b-1]) + 1), slice (int (a), int (b))) for a, b in zip (starts, stops) if b > a]
+
+def _convert (data, sel, out, scale=None, layout='interleaved'):
+    """ Copies complex data[:, sel...] into out, casting to the dtype of out and
+    multiplying by scale in the same pass. A real out holds (real, imag) in a last
+    axis (layout='interleaved') or a first axis (layout='planar') of length 2.
+    Index arrays in sel are copied as their contiguous runs, so nothing is gathered
+    into a temporary array.
+    """
+
+    if np.iscomplexobj (out) or not np.iscomplexobj (data):
+        pairs = [(data, out)]
+    elif layout == 'planar':
+        pairs = [(data.real, out[0]), (data.imag, out[1])]
+    else:
+        parts = data.real
+        parts = np.lib.stride_tricks.as_strided (parts, data.shape + (2,), data.strides + (parts.itemsize,))
+        pairs = [(parts, out)]
+
+    runs = [_index_runs (idx) for idx in (sel or (slice (None),) * (data.ndim - 1))]
+    for source, target in pairs:
+        for combo in itertools.product (*runs):
+            src = source[(slice (None),) + tuple ([run[0] for run in combo])]
+            dst = target[(slice (None),) + tuple ([run[1] for run in combo])]
+            if scale is None:
+                np.copyto (dst, src, casting='unsafe')
+            else:
+                np.multiply (src, scale, out=dst, casting='unsafe')
+
+    return out
+
+def _elementtree ():
+    """ ElementTree module (C version if available), imported on first use.
+    """
+
+    global _et
+    if _et is None:
+        try:
+            import xml.etree.cElementTree as et
+        except ImportError:
+            import xml.etree.ElementTree as et
+        _et = et
+
+    return _et
+
+_et = None
+
+_boundaryregex = re.compile (r'boundary\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+_timeregex = re.compile (r'(<(?:\w+:)?time>\s*)(\d+)')
+
+def _read_mime_headers (mm, pos):
+    """ Reads MIME headers starting at pos up to the blank line that ends them.
+    Returns tuple (headers, start) with dict of headers (lower case names) and
+    position after the blank line, or (None, pos) if headers are incomplete.
+    """
+
+    headers = {}
+    name = None
+    while True:
+        end = mm.find ('\n', pos)
+        if end < 0:
+            return None, pos
+        line = mm[pos:end].rstrip ('\r')
+        pos = end + 1
+        if not line:
+            return headers, pos
+
+        if line[0] in ' \t' and name:
+            headers[name] += ' ' + line.strip ()       # folded header
+        elif ':' in line:
+            name, value = line.split (':', 1)
+            name = name.strip ().lower ()
+            headers[name] = value.strip ()
+
+def _read_part_headers (mm, pos):
+    """ Reads MIME headers of the part whose boundary line starts at pos, as in
+    _read_mime_headers. Returns (None, pos) if the boundary line is not complete.
+    """
+
+    end = mm.find ('\n', pos)
+    if end < 0:
+        return None, pos
+
+    return _read_mime_headers (mm, end + 1)
+
+def _mime_boundary (headers):
+    """ Gets multipart boundary string from MIME headers.
+    """
+
+    match = _boundaryregex.search (headers.get ('content-type', ''))
+    if not match:
+        raise RuntimeError ('cannot find MIME boundary in content type %r' % headers.get ('content-type'))
+
+    return match.group (1)
+
+def _extract_size_info (text):
     # This parses the XML of the header section
 
-    text = feedparser._msgstack[0].get_payload ()[0].get_payload ()
-    headxml = et.fromstring (text)
+    headxml = _elementtree ().fromstring (text)
 
     # The XML may or may not have an xmlns attribute which manifests itself
     # as a prefix to the tags we need to use.
@@ -525,4 +1943,3 @@ def _extract_size_info (feedparser):
     # ... could fill in more if needed ...
 
     return headxml, sizeinfo, tp
-
@@ -0,0 +1,157 @@
+# Copyright 2014 Casey Law <caseyjlaw@gmail.com> and collaborators.
+# Licensed under GNU GPL v2.
+
+""" stats -- timers and counters of the sdmreader read paths
+
+collect -- context manager that collects stats of the reads inside it into a Stats object.
+enable, disable -- start and stop collecting into a Stats object, e.g. for a whole job.
+timer, timed, count -- used by the readers to time a stage (block or function) and count bytes, integrations and cache hits.
+
+Nothing is collected unless a Stats object is active. Until then timer returns a
+shared object that does nothing and timed functions call straight through, so
+the readers run at full speed.
+
+Stages (times can nest, e.g. read is part of read_bdf):
+read_metadata, parse_metadata (xml tables), bdf_scan (MIME scan of a bdf), index_cache_read,
+index_cache_write, get_data, read (copy of data out of the mmap), get_flags, average,
+calc_uvw, calc_uvw_scan.
+
+Counters:
+bytes_mapped, bytes_copied, ints_read, ints_indexed, index_cache_hit, index_cache_miss,
+metadata_memory_hit, metadata_cache_hit, metadata_cache_miss.
+
+> with sdmreader.stats.collect(log=True) as stats:
+>     data = sdmreader.read_bdf(sdmfile, scan)
+> stats.times['read'], stats.counts['bytes_copied'], stats.rate('ints_read', 'read')
+"""
+
+import time, functools, collections, logging
+
+logger = logging.getLogger(__name__)
+
+_active = []
+
+class Stats(object):
+    """ Times (seconds) and calls of each stage and counters, in dicts keyed by name.
+    """
+
+    def __init__(self):
+        self.times = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counts = collections.defaultdict(int)
+
+    def rate(self, counter, stage):
+        """ Counter per second of stage (e.g., rate('ints_read', 'read')), or 0 if stage took no time.
+        """
+
+        seconds = self.times.get(stage, 0.)
+        return self.counts.get(counter, 0)/seconds if seconds else 0.
+
+    def as_dict(self):
+        """ Stats as dict of plain dicts, e.g. for json.
+        """
+
+        return {'times': dict(self.times), 'calls': dict(self.calls), 'counts': dict(self.counts),
+                'ints_per_s': self.rate('ints_read', 'read'), 'copy_mb_per_s': self.rate('bytes_copied', 'read')/1e6}
+
+    def report(self):
+        """ Stats as lines of text.
+        """
+
+        lines = ['%-18s %8d calls %10.4f s' % (stage, self.calls[stage], self.times[stage]) for stage in sorted(self.times)]
+        lines += ['%-18s %14d' % (name, self.counts[name]) for name in sorted(self.counts)]
+        if self.times.get('read'):
+            lines.append('read rate          %10.1f ints/s %10.1f MB/s' % (self.rate('ints_read', 'read'),
+                                                                          self.rate('bytes_copied', 'read')/1e6))
+        return '\n'.join(lines)
+
+class _Timer(object):
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.time() - self.start
+        for stats in _active:
+            stats.times[self.stage] += elapsed
+            stats.calls[self.stage] += 1
+        return False
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_nulltimer = _NullTimer()
+
+def timer(stage):
+    """ Context manager that adds time of the block to stage in active Stats objects.
+    """
+
+    if not _active:
+        return _nulltimer
+    return _Timer(stage)
+
+def timed(stage):
+    """ Decorator that adds time of each call of the function to stage in active Stats objects.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _active:
+                return func(*args, **kwargs)
+            with _Timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    """ Adds n to counter name in active Stats objects.
+    """
+
+    for stats in _active:
+        stats.counts[name] += n
+
+def enable(stats=None):
+    """ Starts collecting into stats (a new Stats object if None) and returns it.
+    """
+
+    stats = stats or Stats()
+    _active.append(stats)
+    return stats
+
+def disable(stats):
+    """ Stops collecting into stats.
+    """
+
+    if stats in _active:
+        _active.remove(stats)
+
+class collect(object):
+    """ Context manager that collects stats inside it and returns the Stats object.
+    log=True logs the report at exit with logger of this module at level.
+    """
+
+    def __init__(self, log=False, level=logging.INFO):
+        self.log = log
+        self.level = level
+
+    def __enter__(self):
+        self.stats = enable()
+        return self.stats
+
+    def __exit__(self, *exc):
+        disable(self.stats)
+        if self.log:
+            logger.log(self.level, 'sdmreader stats:\n' + self.stats.report())
+        return False
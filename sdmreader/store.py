@@ -0,0 +1,209 @@
+# Copyright 2014 Casey Law <caseyjlaw@gmail.com> and collaborators.
+# Licensed under GNU GPL v2.
+
+""" store -- chunked on-disk copies of SDM scans for repeated reading
+
+convert -- writes scans of an SDM to a store directory, in parallel over scans.
+Store -- opens a store and returns data of a scan as memmap slices.
+
+A bdf interleaves cross data, autos and flags of each integration, so every
+read of it is strided and starts with a parse of its MIME structure. A store
+holds the cross data of each scan in contiguous .npy files, one per block of
+integrations and spw, which np.load opens as memmaps. Any slice of a chunk is
+then a view on the file.
+
+Layout of a store directory:
+
+manifest.json -- format version, path of the SDM, source dict and, per scan,
+    the scan dict of read_metadata, the dimensions, the chunk boundaries and the
+    names of the files below.
+scan<N>/data_<block>_spw<k>.npy -- complex64 (nints, nbl, nchan, npol) of one block of integrations and spw.
+scan<N>/flags_<block>_spw<k>.npy -- booleans of the same shape (True is flagged), if converted with flags.
+scan<N>/times.npy -- mjd of each integration.
+scan<N>/uvw.npy -- (nints, nbl, 3) uvw in meters from calc_uvw_scan, if it could be calculated.
+
+> import sdmreader.store
+> store = sdmreader.store.convert(sdmfile, '/data/sdm.store', workers=8)
+> data = store.read(scan, 100, 200, spws=[3])      # memmap view, if in one chunk
+"""
+
+import numpy as np
+import os, json, logging
+from . import sdmreader
+
+logger = logging.getLogger(__name__)
+
+version = 1
+blocksize = 64*1024**2    # bytes of cross data read from the bdf at a time while converting
+
+def convert(sdmpath, outdir, scans=None, chunk_ints=0, flags=True, workers=4, bdfdir=None, cachedir=None, metadata=None):
+    """ Writes scans (default all with bdfs) of sdmpath to store in outdir and returns the Store.
+    chunk_ints is number of integrations per chunk file. 0 puts each scan in one chunk per spw,
+    so every read of a spw is a view.
+    flags=True also writes flags. Data is copied from the bdf straight into the chunk files in blocks,
+    so memory use does not grow with scan size. workers > 1 converts scans in parallel processes.
+    Existing scans in the store are replaced and others are kept.
+    """
+
+    if not metadata:
+        metadata = sdmreader.read_metadata(sdmpath, bdfdir=bdfdir, cachedir=cachedir)
+    scandict, sourcedict = metadata
+    if scans is None:
+        scans = sorted([scan for scan in scandict if scandict[scan].get('bdfstr')])
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    tasks = [(sdmpath, scan, outdir, chunk_ints, flags, bdfdir, cachedir, sdmreader._select_scan(metadata, scan))
+             for scan in scans]
+    logger.info('Converting %d scans of %s to store %s with %d workers' % (len(scans), sdmpath, outdir, workers))
+    if workers > 1 and len(tasks) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            entries = pool.map(_convert_scan, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        entries = map(_convert_scan, tasks)
+
+    manifestname = os.path.join(outdir, 'manifest.json')
+    manifest = {'version': version, 'sdm': os.path.abspath(sdmpath), 'scans': {}, 'sources': {}}
+    if os.path.exists(manifestname):
+        manifest['scans'] = _read_manifest(manifestname)['scans']
+    manifest['scans'].update(dict((str(scan), entry) for scan, entry in zip(scans, entries)))
+    manifest['sources'] = dict((str(source), info) for source, info in sourcedict.iteritems())
+
+    with open(manifestname + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.rename(manifestname + '.tmp', manifestname)
+
+    return Store(outdir)
+
+def _convert_scan(task):
+    """ Converts one scan to store. Returns its manifest entry. Runs in worker process.
+    """
+
+    sdmpath, scan, outdir, chunk_ints, flags, bdfdir, cachedir, metadata = task
+    scans, bdf = sdmreader._open_bdf(sdmpath, scan, bdfdir=bdfdir, cachedir=cachedir, metadata=metadata)
+    nints = bdf.n_integrations
+    nbl, nchan, npol = bdf.get_shape('crossData.bin')
+    chunk_ints = chunk_ints or max(nints, 1)
+    chunks = [(start, min(start+chunk_ints, nints)) for start in xrange(0, nints, chunk_ints)]
+    block_ints = max(1, blocksize // (nbl*nchan*npol*8))
+
+    scandir = 'scan%d' % scan
+    if not os.path.exists(os.path.join(outdir, scandir)):
+        os.makedirs(os.path.join(outdir, scandir))
+
+    entry = {'metadata': scans[scan], 'nints': nints, 'nbl': nbl, 'pols': bdf.crosspols, 'spw_nchans': bdf.spw_nchans,
+             'chunks': chunks, 'data': [], 'flags': [] if flags else None, 'times': os.path.join(scandir, 'times.npy'), 'uvw': None}
+    for i, (start, stop) in enumerate(chunks):
+        datanames = []; flagnames = []
+        for spw, (chan0, nspwchan) in enumerate(zip(bdf.spw_chanoffsets, bdf.spw_nchans)):
+            sel = (slice(None), slice(int(chan0), int(chan0+nspwchan)), slice(None))
+            shape = (stop-start, nbl, nspwchan, npol)
+            datanames.append(os.path.join(scandir, 'data_%05d_spw%02d.npy' % (i, spw)))
+            data = np.lib.format.open_memmap(os.path.join(outdir, datanames[-1]), mode='w+', dtype='complex64', shape=shape)
+            if flags:
+                flagnames.append(os.path.join(scandir, 'flags_%05d_spw%02d.npy' % (i, spw)))
+                flagdata = np.lib.format.open_memmap(os.path.join(outdir, flagnames[-1]), mode='w+', dtype=bool, shape=shape)
+
+            for i0 in xrange(start, stop, block_ints):
+                i1 = min(i0+block_ints, stop)
+                bdf.read('crossData.bin', i0, i1, out=data[i0-start:i1-start], sel=sel)
+                if flags:
+                    flagdata[i0-start:i1-start] = bdf.get_flags(i0, i1, sel=sel)
+
+            data.flush()
+            del data
+            if flags:
+                flagdata.flush()
+                del flagdata
+        entry['data'].append(datanames)
+        if flags:
+            entry['flags'].append(flagnames)
+
+    mjds = sdmreader._int_times(bdf, scans[scan])
+    np.save(os.path.join(outdir, entry['times']), mjds)
+    try:
+        uvw = sdmreader.calc_uvw_scan(sdmpath, scan, mjds=mjds, metadata=metadata)
+        entry['uvw'] = os.path.join(scandir, 'uvw.npy')
+        np.save(os.path.join(outdir, entry['uvw']), uvw)
+    except Exception as exc:
+        logger.warn('Could not calculate uvw for scan %d (%s). Store has no uvw for it.' % (scan, exc))
+
+    logger.info('Converted scan %d (%d ints) in %d chunks' % (scan, nints, len(chunks)))
+    return entry
+
+def _read_manifest(name):
+    with open(name) as fp:
+        manifest = json.load(fp)
+    assert manifest['version'] == version, 'store %s has version %s, not %d' % (os.path.dirname(name), manifest['version'], version)
+    return manifest
+
+class Store(object):
+    """ Store made by convert. Data comes back as memmaps of the chunk files.
+    metadata is (scandict, sourcedict) as from read_metadata, for the scans in the store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = _read_manifest(os.path.join(path, 'manifest.json'))
+        self.scans = dict((int(scan), entry) for scan, entry in self.manifest['scans'].iteritems())
+        scandict = dict((scan, entry['metadata']) for scan, entry in self.scans.iteritems())
+        sourcedict = dict((int(source), info) for source, info in self.manifest['sources'].iteritems())
+        self.metadata = (scandict, sourcedict)
+
+    def chunk(self, scan, block, spw, kind='data'):
+        """ Memmap (read-only) of one chunk file of kind 'data' or 'flags'.
+        """
+
+        names = self.scans[scan][kind]
+        if names is None:
+            raise ValueError('store %s has no %s for scan %d' % (self.path, kind, scan))
+        return np.load(os.path.join(self.path, names[block][spw]), mmap_mode='r')
+
+    def read(self, scan, start=0, stop=None, spws=None, kind='data'):
+        """ Data (or flags with kind='flags') of integrations start to stop and spws (default all)
+        of a scan as array of shape (nints, nbl, nchan, npol).
+        This is a memmap view when the integrations are in one chunk and one spw is read.
+        Otherwise the chunks are copied into a new array. Slicing further is zero-copy on views.
+        """
+
+        entry = self.scans[scan]
+        stop = entry['nints'] if stop is None else min(stop, entry['nints'])
+        if spws is None:
+            spws = range(len(entry['spw_nchans']))
+
+        blocks = [(i, max(start, b0), min(stop, b1)) for i, (b0, b1) in enumerate(entry['chunks']) if b0 < stop and b1 > start]
+        if len(blocks) == 1 and len(spws) == 1:
+            i, i0, i1 = blocks[0]
+            b0 = entry['chunks'][i][0]
+            return self.chunk(scan, i, spws[0], kind)[i0-b0:i1-b0]
+
+        nchan = sum([entry['spw_nchans'][spw] for spw in spws])
+        dtype = 'complex64' if kind == 'data' else bool
+        out = np.empty((max(stop-start, 0), entry['nbl'], nchan, len(entry['pols'])), dtype=dtype)
+        for i, i0, i1 in blocks:
+            b0 = entry['chunks'][i][0]
+            chan = 0
+            for spw in spws:
+                n = entry['spw_nchans'][spw]
+                out[i0-start:i1-start, :, chan:chan+n] = self.chunk(scan, i, spw, kind)[i0-b0:i1-b0]
+                chan += n
+
+        return out
+
+    def times(self, scan):
+        """ mjd of each integration of scan.
+        """
+
+        return np.load(os.path.join(self.path, self.scans[scan]['times']), mmap_mode='r')
+
+    def uvw(self, scan):
+        """ (nints, nbl, 3) uvw in meters of scan, as memmap. None if not in store.
+        """
+
+        name = self.scans[scan]['uvw']
+        return np.load(os.path.join(self.path, name), mmap_mode='r') if name else None
@@ -0,0 +1,201 @@
+# Copyright 2014 Casey Law <caseyjlaw@gmail.com> and collaborators.
+# Licensed under GNU GPL v2.
+
+""" synth -- writes synthetic SDMs for testing and benchmarking
+
+write_sdm -- writes SDM directory with xml tables and one BDF per scan.
+write_bdf -- writes one BDF (MIME multipart binary data file).
+integration_data -- regenerates the cross data written for an integration, to check reads.
+integration_flags -- regenerates the flags written for an integration, to check reads.
+
+Tables are the ones sdmreader reads: ASDM, ExecBlock, Scan, Subscan, Main, Field,
+ConfigDescription, Antenna and Station. They follow the layout of VLA SDMs, but hold only
+the columns used here.
+
+BDFs are laid out like VLA BDFs. Header lines holding the integration number are padded
+with trailing spaces to a fixed length, so integrations sit at a fixed stride.
+irregular=True makes the subset header of each integration a different length and the
+autoData blob of every other integration half its nominal size, as the BDF spec allows.
+
+> import sdmreader.synth
+> sdmreader.synth.write_sdm('/tmp/test.sdm', nants=27, nchans=[64]*16, nints=100)
+"""
+
+import numpy as np
+import os, logging
+
+logger = logging.getLogger(__name__)
+
+arraycenter = np.array([-1601185.4, -5041977.5, 3554875.9])    # VLA, ITRF meters
+bdfuid = 1400000000000
+
+def write_sdm(path, nscans=2, nants=4, nchans=(16, 16), pols=('RR', 'RL', 'LR', 'LL'), nints=10,
+              inttime=1.0, starttime=57000.5, irregular=False, flagfrac=0.05, spwflags=False, seed=0):
+    """ Writes SDM directory at path with nscans scans of nints integrations.
+    nchans is number of channels of each spw. pols are cross pol products.
+    inttime is integration time in seconds and starttime is start of first scan in mjd.
+    irregular, flagfrac and spwflags are as in write_bdf.
+    Returns path.
+    """
+
+    bdfdir = os.path.join(path, 'ASDMBinary')
+    if not os.path.exists(bdfdir):
+        os.makedirs(bdfdir)
+
+    rng = np.random.RandomState(seed)
+    scanlen = nints*inttime/86400.
+    nsources = max(1, nscans//2)
+
+    # stations scattered within 1 km of array center
+    positions = arraycenter + rng.uniform(-1000, 1000, size=(nants, 3))
+    _write_table(path, 'Station', [{'stationId': 'Station_%d' % i, 'name': 'W%02d' % i, 'type': 'ANTENNA_PAD',
+                                    'position': '1 3 %.6f %.6f %.6f' % tuple(positions[i])} for i in range(nants)])
+    _write_table(path, 'Antenna', [{'antennaId': 'Antenna_%d' % i, 'name': 'ea%02d' % (i+1), 'stationId': 'Station_%d' % i}
+                                   for i in range(nants)])
+    _write_table(path, 'ConfigDescription', [{'configDescriptionId': 'ConfigDescription_0', 'numAntenna': str(nants),
+                                              'antennaId': '1 %d ' % nants + ' '.join(['Antenna_%d' % i for i in range(nants)])}])
+    _write_table(path, 'ExecBlock', [{'execBlockId': 'ExecBlock_0', 'telescopeName': 'EVLA', 'numAntenna': str(nants)}])
+    _write_table(path, 'Field', [{'fieldId': 'Field_%d' % i, 'fieldName': 'source%d' % i, 'sourceId': str(i),
+                                  'referenceDir': '2 1 2 %.12f %.12f' % (rng.uniform(0, 2*np.pi), rng.uniform(-0.5, 1.5))}
+                                 for i in range(nsources)])
+
+    scanrows = []; subscanrows = []; mainrows = []
+    for scan in range(1, nscans+1):
+        start = starttime + (scan-1)*scanlen
+        times = (_ns(start), _ns(start+scanlen))
+        source = 'source%d' % ((scan-1) % nsources)
+        uid = bdfuid + scan
+        scanrows.append({'scanNumber': str(scan), 'startTime': '%d' % times[0], 'endTime': '%d' % times[1],
+                         'numIntent': '1', 'numSubscan': '1', 'scanIntent': '1 1 OBSERVE_TARGET', 'sourceName': source})
+        subscanrows.append({'scanNumber': str(scan), 'subscanNumber': '1', 'startTime': '%d' % times[0], 'endTime': '%d' % times[1],
+                            'fieldName': source, 'subscanIntent': 'ON_SOURCE', 'numIntegration': str(nints)})
+        mainrows.append({'time': '%d' % ((times[0]+times[1])//2), 'numAntenna': str(nants), 'fieldId': 'Field_%d' % ((scan-1) % nsources),
+                         'configDescriptionId': 'ConfigDescription_0', 'scanNumber': str(scan), 'subscanNumber': '1',
+                         'numIntegration': str(nints), 'dataUID': 'uid:///evla/bdf/%d' % uid})
+
+        write_bdf(os.path.join(bdfdir, 'uid____evla_bdf_%d' % uid), nants=nants, nchans=nchans, pols=pols, nints=nints,
+                  inttime=inttime, starttime=start, irregular=irregular, flagfrac=flagfrac, spwflags=spwflags, seed=seed+scan, uid=uid)
+
+    _write_table(path, 'Scan', scanrows)
+    _write_table(path, 'Subscan', subscanrows)
+    _write_table(path, 'Main', mainrows)
+
+    tables = ['Main', 'Antenna', 'ConfigDescription', 'ExecBlock', 'Field', 'Scan', 'Station', 'Subscan']
+    nrows = {'Main': nscans, 'Antenna': nants, 'ConfigDescription': 1, 'ExecBlock': 1, 'Field': nsources,
+             'Scan': nscans, 'Station': nants, 'Subscan': nscans}
+    with open(os.path.join(path, 'ASDM.xml'), 'w') as fp:
+        fp.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<ASDM schemaVersion="3">\n')
+        for table in tables:
+            fp.write('<Table><Name>%s</Name><NumberRows>%d</NumberRows></Table>\n' % (table, nrows[table]))
+        fp.write('</ASDM>\n')
+
+    logger.info('Wrote synthetic sdm %s with %d scans' % (path, nscans))
+    return path
+
+def write_bdf(filename, nants=4, nchans=(16, 16), pols=('RR', 'RL', 'LR', 'LL'), nints=10, inttime=1.0,
+              starttime=57000.5, irregular=False, flagfrac=0.05, spwflags=False, seed=0, uid=bdfuid):
+    """ Writes BDF with crossData, autoData and flags for nints integrations.
+    Cross data of integration i is integration_data(i, ...). flagfrac is fraction of flags set.
+    Flags are per channel, or per spw with spwflags=True, and antenna flags are for the two single-dish pols.
+    irregular=True varies the spacing of integrations and the size of autoData blobs.
+    """
+
+    nbl = nants*(nants-1)//2
+    nchan = sum(nchans)
+    npol = len(pols)
+    rng = np.random.RandomState(seed)
+
+    spws = ''.join(['<spectralWindow sw="%d" swbb="AC_8BIT" crossPolProducts="%s" sdPolProducts="RR LL" '
+                    'scaleFactor="1" numSpectralPoint="%d" numBin="1" sideband="U"/>' % (i+1, ' '.join(pols), n)
+                    for i, n in enumerate(nchans)])
+    crosssize = nbl*nchan*npol*2
+    autosize = nants*nchan*2*2
+    nflagchan = len(nchans) if spwflags else nchan
+    flagsize = (nbl*npol + nants*2)*nflagchan
+    head = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<sdmDataHeader xmlns="http://Alma/XASDM/sdmbin" xmlns:xlink="http://www.w3.org/1999/xlink" byteOrder="Little_Endian" projectPath="%d/1/">'
+            '<startTime>%d</startTime><dataOID xlink:href="uid:///evla/bdf/%d" /><dimensionality>1</dimensionality>'
+            '<numAntenna>%d</numAntenna><correlationMode>CROSS_AND_AUTO</correlationMode>'
+            '<dataStruct><baseband name="BB_1">%s</baseband>'
+            '<flags size="%d" axes="BAL ANT BAB SPW %sPOL"/><autoData size="%d" axes="ANT BAB SPW SPP POL"/>'
+            '<crossData type="FLOAT32_TYPE" size="%d" axes="BAL BAB SPW SPP POL"/></dataStruct></sdmDataHeader>\n'
+            % (uid, _ns(starttime), uid, nants, spws, flagsize, '' if spwflags else 'SPP ', autosize, crosssize))
+
+    with open(filename, 'wb') as fp:
+        fp.write('MIME-Version: 1.0\nContent-Type: multipart/mixed; boundary="MIME_boundary-1"; type="text/xml"; '
+                 'start="<uid:///evla/bdf/%d/sdmDataHeader.xml>"\nContent-Description: EVLA/CORRELATOR/WIDAR/FULL_RESOLUTION\n'
+                 'mime-part: Header\n\n' % uid)
+        fp.write('--MIME_boundary-1\nContent-Type: text/xml; charset=utf-8\n'
+                 'Content-Location: uid:///evla/bdf/%d/sdmDataHeader.xml\n\n%s\n' % (uid, head))
+
+        for i in xrange(nints):
+            time = _ns(starttime + (i+0.5)*inttime/86400.)
+            cross = integration_data(i, (nbl, nchan, npol), seed)
+            auto = rng.uniform(0, 1, size=(nants, nchan, 4)).astype('float32').view('complex64')
+            flags = integration_flags(i, flagsize, flagfrac, seed).astype('uint32')
+            if irregular and i % 2:
+                auto = auto[:, :nchan//2]
+
+            fp.write('--MIME_boundary-1\nContent-Type: multipart/related; boundary="MIME_boundary-2"; type="text/xml"; '
+                     'start="<uid:///evla/bdf/%d/%d/desc.xml>"%s\nContent-Description: data and metadata subset\n\n'
+                     % (uid, i+1, _fill(i+1)))
+            fp.write('--MIME_boundary-2\nContent-Type: text/xml; charset=utf-8\nContent-Location: uid:///evla/bdf/%d/%d/desc.xml%s\n\n'
+                     '<sdmDataSubsetHeader xmlns="http://Alma/XASDM/sdmbin" projectPath="%d/1/%d/">%s'
+                     '<schedulePeriodTime><time>%d</time><interval>%d</interval></schedulePeriodTime>'
+                     '<dataStruct ref="sdmDataHeader"/><abortObservation/>%s</sdmDataSubsetHeader>\n'
+                     % (uid, i+1, _fill(i+1), uid, i+1, _fill(i+1), time, int(inttime*1e9), ' '*(i % 7 if irregular else 0)))
+            for kind, data in (('flags', flags), ('autoData', auto), ('crossData', cross)):
+                fp.write('--MIME_boundary-2\nContent-Type: binary/octet-stream\nContent-Location: uid:///evla/bdf/%d/%d/%s.bin%s\n\n'
+                         % (uid, i+1, kind, _fill(i+1)))
+                fp.write(data.tostring())
+                fp.write('\n')
+            fp.write('--MIME_boundary-2--\n\n')
+
+        fp.write('--MIME_boundary-1--\n')
+
+    return filename
+
+def integration_data(i, shape, seed=0):
+    """ Cross data (complex64 array of shape (nbl, nchan, npol)) written for integration i.
+    """
+
+    rng = np.random.RandomState((seed*100003 + i) % 2**32)
+    data = rng.normal(size=shape + (2,)).astype('float32')
+    return data.view('complex64').reshape(shape)
+
+def integration_flags(i, flagsize, flagfrac=0.05, seed=0):
+    """ Flags (boolean array of flagsize) written for integration i, in the order of the flags axes
+    of write_bdf: baselines, channels (or spws) and pols, then antennas, channels (or spws) and the two single-dish pols.
+    """
+
+    rng = np.random.RandomState((seed*100019 + i) % 2**32)
+    return rng.uniform(size=flagsize) < flagfrac
+
+def _fill(num, width=10):
+    """ Spaces that pad a header line holding integration number num to a fixed length.
+    """
+
+    return ' '*(width - len('%d' % num))
+
+def _ns(mjd):
+    """ Time in mjd as integer nanoseconds.
+    """
+
+    return int(round(mjd*86400*1e9))
+
+def _write_table(path, name, rows):
+    """ Writes SDM xml table name.xml with given list of row dicts.
+    """
+
+    with open(os.path.join(path, name + '.xml'), 'w') as fp:
+        fp.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n')
+        fp.write('<%sTable xmlns="http://Alma/XASDM/%sTable" schemaVersion="3">\n' % (name, name))
+        for row in rows:
+            fp.write('<row>')
+            for key, value in row.iteritems():
+                if key == 'dataUID':
+                    fp.write('<dataUID> <EntityRef entityId="%s" partId="X00000000" entityTypeName="Main" documentVersion="1"/> </dataUID>' % value)
+                else:
+                    fp.write('<%s>%s</%s>' % (key, value, key))
+            fp.write('</row>\n')
+        fp.write('</%sTable>\n' % name)
@@ -9,5 +9,6 @@ setup(name='sdmreader',
       author_email='caseyjlaw@gmail.com',
       url='http://github.com/caseyjlaw/sdmreader',
       packages=['sdmreader'],
+      scripts=['scripts/sdmreader'],
       requires=['pwkit'],
      )
@@ -0,0 +1,6 @@
+""" Tests of sdmreader on synthetic SDMs (see sdmreader.synth). Run with python -m unittest discover -s tests -t .
+"""
+
+import logging
+
+logging.getLogger('sdmreader').addHandler(logging.NullHandler())
@@ -0,0 +1,81 @@
+""" Helpers for tests: synthetic SDMs in temporary directories and reference data from synth.
+"""
+
+import numpy as np
+import os, re, shutil, tempfile, unittest
+from sdmreader import sdmreader, synth
+
+class SDMTestCase(unittest.TestCase):
+    """ Test case with temporary directory tmpdir, removed after the tests of the class.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp(prefix='sdmreader-test-')
+        cls.make_sdms()
+
+    @classmethod
+    def make_sdms(cls):
+        """ Writes sdms shared by the tests of the class.
+        """
+
+        pass
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir, ignore_errors=True)
+
+    @classmethod
+    def write_sdm(cls, name, **kwargs):
+        """ Writes synthetic sdm name in tmpdir (see synth.write_sdm) and returns its path.
+        """
+
+        return synth.write_sdm(os.path.join(cls.tmpdir, name), **kwargs)
+
+def bdffile(sdm, scan):
+    """ Path of bdf of scan of synthetic sdm.
+    """
+
+    return os.path.join(sdm, 'ASDMBinary', 'uid____evla_bdf_%d' % (synth.bdfuid + scan))
+
+def reference_data(nints, nants, nchans, npol, scan, seed=0):
+    """ Cross data written by synth.write_sdm for scan as (nints, nbl, nchan, npol) array.
+    """
+
+    shape = (nants*(nants-1)//2, sum(nchans), npol)
+    return np.array([synth.integration_data(i, shape, seed+scan) for i in range(nints)])
+
+def reference_flags(nints, nants, nchans, npol, scan, spwflags=False, flagfrac=0.05, seed=0):
+    """ Flags written by synth.write_sdm for scan as tuple of boolean arrays for
+    baselines (nints, nbl, nchan, npol) and antennas (nints, nants, nchan, 2).
+    Flags per spw are repeated over the channels of the spw.
+    """
+
+    nbl = nants*(nants-1)//2
+    units = len(nchans) if spwflags else sum(nchans)
+    flagsize = (nbl*npol + nants*2)*units
+    flags = np.array([synth.integration_flags(i, flagsize, flagfrac, seed+scan) for i in range(nints)])
+    cross = flags[:, :nbl*units*npol].reshape(nints, nbl, units, npol)
+    autos = flags[:, nbl*units*npol:].reshape(nints, nants, units, 2)
+    if spwflags:
+        cross = np.repeat(cross, nchans, axis=2)
+        autos = np.repeat(autos, nchans, axis=2)
+
+    return cross, autos
+
+def remove_times(sdm, scan):
+    """ Blanks the <time> elements of the subset headers in the bdf of scan, keeping the layout of the file.
+    """
+
+    path = bdffile(sdm, scan)
+    with open(path, 'rb') as fp:
+        text = fp.read()
+    with open(path, 'wb') as fp:
+        fp.write(re.sub(r'<time>\d+</time>', lambda match: ' '*len(match.group()), text))
+
+def open_bdf(sdm, scan):
+    """ Parsed BDFData of scan, without index cache.
+    """
+
+    scans, bdf = sdmreader._open_bdf(sdm, scan, cachedir='', metadata=sdmreader.read_metadata(sdm, cachedir=''))
+    return bdf
@@ -0,0 +1,125 @@
+""" Tests of the BDF index: truncated and growing files, index cache and time lookup.
+"""
+
+import numpy as np
+import os, unittest
+import sdmreader
+from sdmreader import sdmreader as reader, cache
+from tests.common import SDMTestCase, reference_data, bdffile, open_bdf
+
+nants, nchans, nints = 4, [8, 8], 10
+
+class TruncatedTest(SDMTestCase):
+
+    @classmethod
+    def make_sdms(cls):
+        cls.sdm = cls.write_sdm('full.sdm', nscans=1, nants=nants, nchans=nchans, nints=nints, irregular=True)
+        cls.ref = reference_data(nints, nants, nchans, 4, 1)
+        cls.full = open(bdffile(cls.sdm, 1), 'rb').read()
+        cls.bdf = open_bdf(cls.sdm, 1)
+
+    def write_part(self, name, size):
+        """ Writes first size bytes of the bdf to file name in tmpdir and returns its path.
+        """
+
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as fp:
+            fp.write(self.full[:size])
+        return path
+
+    def parse(self, path, follow=False):
+        with open(path, 'r') as fp:
+            return reader.BDFData(fp, cachedir='').parse(follow=follow)
+
+    def test_truncated(self):
+        # cut inside the cross data of integration 4 leaves 4 complete integrations
+        cut = int(self.bdf.offsets['crossData.bin'][4]) + 10
+        bdf = self.parse(self.write_part('cut.bdf', cut))
+        self.assertEqual(bdf.n_integrations, 4)
+        self.assertFalse(bdf.finished)
+        np.testing.assert_array_equal(bdf.read('crossData.bin', 0, 4), self.ref[:4])
+
+    def test_cut_at_boundary(self):
+        # file ends right after a boundary string, without its newline, as when a writer flushes there
+        headend = int(self.bdf.offsets['crossData.bin'][0])
+        for marker in ('--MIME_boundary-1', '--MIME_boundary-2'):
+            pos = self.full.find(marker, headend)
+            while pos >= 0:
+                cut = pos + len(marker)
+                path = self.write_part('boundary.bdf', cut)
+                bdf = self.parse(path, follow=True)
+                complete = (self.bdf.offsets['crossData.bin'] + self.bdf.sizes['crossData.bin'] < cut).sum()
+                self.assertIn(bdf.n_integrations, (complete - 1, complete))
+                np.testing.assert_array_equal(bdf.read('crossData.bin', 0, bdf.n_integrations), self.ref[:bdf.n_integrations])
+
+                with open(path, 'ab') as fp:
+                    fp.write(self.full[cut:])
+                bdf.refresh()
+                self.assertEqual(bdf.n_integrations, nints)
+                pos = self.full.find(marker, cut)
+
+        # header part cut after its boundary is not parsed yet
+        cut = self.full.find('--MIME_boundary-1') + len('--MIME_boundary-1')
+        self.assertRaises(RuntimeError, self.parse, self.write_part('header.bdf', cut), True)
+
+    def test_growing(self):
+        path = self.write_part('grow.bdf', int(self.bdf.offsets['crossData.bin'][2]) + 5)
+        bdf = self.parse(path, follow=True)
+        self.assertEqual(bdf.n_integrations, 2)
+
+        for stop in (5, nints):
+            size = int(self.bdf.offsets['crossData.bin'][stop]) + 30 if stop < nints else len(self.full)
+            with open(path, 'ab') as fp:
+                fp.write(self.full[os.path.getsize(path):size])
+            bdf.refresh()
+            self.assertEqual(bdf.n_integrations, stop)
+        self.assertTrue(bdf.finished)
+        np.testing.assert_array_equal(bdf.read('crossData.bin', 0, nints), self.ref)
+        np.testing.assert_array_equal(bdf.times, self.bdf.times)
+
+    def test_follow_bdf(self):
+        path = self.write_part('follow.bdf', len(self.full))
+        blocks = list(sdmreader.follow_bdf(path, poll=0.01, timeout=1.))
+        np.testing.assert_array_equal(np.concatenate([data for ints, mjds, data in blocks]), self.ref)
+
+class IndexTest(SDMTestCase):
+
+    def test_cache(self):
+        sdm = self.write_sdm('cache.sdm', nscans=1, nants=nants, nchans=nchans, nints=nints, irregular=True)
+        cachedir = os.path.join(self.tmpdir, 'cache')
+        with sdmreader.stats.collect() as stats:
+            first = sdmreader.read_bdf(sdm, 1, cachedir=cachedir)
+            second = sdmreader.read_bdf(sdm, 1, cachedir=cachedir)
+        self.assertEqual(stats.counts['index_cache_miss'], 1)
+        self.assertEqual(stats.counts['index_cache_hit'], 1)
+        np.testing.assert_array_equal(first, second)
+
+    def test_bdfpkldir(self):
+        sdm = self.write_sdm('pkl.sdm', nscans=1, nants=nants, nchans=nchans, nints=nints)
+        pkldir = os.path.join(sdm, 'bdfpkls')
+        with open(bdffile(sdm, 1), 'r') as fp:
+            bdf = reader.BDFData(fp, cachedir='', bdfpkldir=pkldir).parse()
+            self.assertEqual(bdf.n_integrations, nints)
+
+            # second positional argument is bdfpkldir, as before the index cache, and is not used as cachedir
+            bdf = reader.BDFData(fp, pkldir)
+            self.assertEqual(bdf.cachedir, cache.get_cachedir())
+        self.assertFalse(os.path.exists(pkldir))
+
+    def test_find_integrations(self):
+        sdm = self.write_sdm('times.sdm', nscans=3, nants=nants, nchans=nchans, nints=nints)
+        times = np.concatenate([open_bdf(sdm, scan).times for scan in (1, 2, 3)])
+        ranges = sdmreader.find_integrations(sdm, times[7], times[23], cachedir='')
+        self.assertEqual(ranges, [(1, 7, 3), (2, 0, 10), (3, 0, 3)])
+
+    def test_int_times(self):
+        sdm = self.write_sdm('inttimes.sdm', nscans=1, nants=nants, nchans=nchans, nints=nints)
+        bdf = open_bdf(sdm, 1)
+        scandict = {'startmjd': 57000., 'duration': nints/86400.}
+        np.testing.assert_array_equal(reader._int_times(bdf, scandict), bdf.times)
+        bdf.times = bdf.times.copy()
+        bdf.times[3] = np.nan
+        np.testing.assert_allclose(reader._int_times(bdf, scandict), 57000. + (np.arange(nints)+0.5)/86400., rtol=0, atol=1e-10)
+
+if __name__ == '__main__':
+    unittest.main()
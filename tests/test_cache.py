@@ -0,0 +1,79 @@
+""" Tests of the index and metadata caches.
+"""
+
+import os, time, logging, unittest
+import sdmreader
+from sdmreader import cache
+from sdmreader import sdmreader as reader
+from tests.common import SDMTestCase
+
+class EvictTest(SDMTestCase):
+
+    def test_only_cache_files(self):
+        sdm = self.write_sdm('evict.sdm', nscans=2, nants=4, nints=5)
+        cachedir = os.path.join(self.tmpdir, 'shared')
+        os.makedirs(cachedir)
+        others = ['data%d.bin' % i for i in range(3)] + ['tmpwriting.tmp']
+        for name in others:
+            with open(os.path.join(cachedir, name), 'wb') as fp:
+                fp.write('x'*100000)
+        stale = os.path.join(cachedir, 'tmpstale.tmp')
+        with open(stale, 'wb') as fp:
+            fp.write('x'*100000)
+        os.utime(stale, (time.time() - 2*cache.tmpage,)*2)
+
+        sdmreader.read_bdf(sdm, 1, cachedir=cachedir)
+        sdmreader.read_bdf(sdm, 2, cachedir=cachedir)
+        cache.evict(cachedir, maxsize=1)
+
+        self.assertEqual(sorted(os.listdir(cachedir)), sorted(others))
+
+class MetadataTest(SDMTestCase):
+
+    def test_round_trip(self):
+        sdm = self.write_sdm('meta.sdm', nscans=3, nants=4, nints=5)
+        cachedir = os.path.join(self.tmpdir, 'meta')
+        reader._metadatacache.clear()
+        parsed = sdmreader.read_metadata(sdm, cachedir=cachedir)
+        names = os.listdir(cachedir)
+        self.assertEqual([os.path.splitext(name)[1] for name in names], ['.meta'])
+        with open(os.path.join(cachedir, names[0])) as fp:
+            self.assertEqual(fp.read(1), '{')
+
+        reader._metadatacache.clear()
+        with sdmreader.stats.collect() as stats:
+            cached = sdmreader.read_metadata(sdm, cachedir=cachedir)
+        self.assertNotIn('parse_metadata', stats.times)
+        self.assertEqual(cached, parsed)
+        self.assertEqual(sorted(cached[0]), [1, 2, 3])
+        self.assertEqual(sdmreader.read_metadata(sdm, 2, cachedir=cachedir)[0].keys(), [2])
+
+class UnwritableTest(SDMTestCase):
+
+    def test_warn_once(self):
+        sdm = self.write_sdm('unwritable.sdm', nscans=2, nants=4, nints=5)
+        with open(os.path.join(self.tmpdir, 'file'), 'w') as fp:
+            fp.write('not a directory')
+        cachedir = os.path.join(self.tmpdir, 'file', 'cache')
+
+        records = []
+        handler = logging.Handler(logging.DEBUG)
+        handler.emit = records.append
+        logger = logging.getLogger('sdmreader.cache')
+        logger.addHandler(handler)
+        level = logger.level
+        logger.setLevel(logging.DEBUG)
+        try:
+            reader._metadatacache.clear()
+            for scan in (1, 2, 1):
+                sdmreader.read_bdf(sdm, scan, cachedir=cachedir)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        failed = [record for record in records if record.getMessage().startswith('Could not write')]
+        self.assertEqual([record.levelno for record in failed], [logging.WARNING] + [logging.DEBUG]*(len(failed)-1))
+        self.assertTrue(len(failed) >= 3)
+
+if __name__ == '__main__':
+    unittest.main()
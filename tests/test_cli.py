@@ -0,0 +1,86 @@
+""" Tests of the sdmreader command: scan selection and extraction with a pool of workers.
+"""
+
+import numpy as np
+import os, json, unittest
+import sdmreader
+from sdmreader import cli
+from tests.common import SDMTestCase
+
+nants, nchans, nints = 4, [8, 4], 11
+
+class SelectTest(unittest.TestCase):
+
+    def test_select_scans(self):
+        scandict = {1: {'intent': 'CALIBRATE_PHASE OBSERVE_TARGET', 'source': 'J1924-2914', 'bdfstr': 'bdf1'},
+                    2: {'intent': 'OBSERVE_TARGET', 'source': 'FRB121102', 'bdfstr': 'bdf2'},
+                    3: {'intent': 'CALIBRATE_BANDPASS', 'source': 'J1924-2914', 'bdfstr': 'bdf3'},
+                    4: {'intent': 'OBSERVE_TARGET', 'source': 'FRB121102', 'bdfstr': None},
+                    5: {'intent': None, 'source': None, 'bdfstr': 'bdf5'}}
+        metadata = (scandict, {})
+        self.assertEqual(cli.select_scans(metadata), [1, 2, 3, 5])
+        self.assertEqual(cli.select_scans(metadata, intents=['target']), [1, 2])
+        self.assertEqual(cli.select_scans(metadata, intents=['bandpass', 'PHASE']), [1, 3])
+        self.assertEqual(cli.select_scans(metadata, sources=['J19*']), [1, 3])
+        self.assertEqual(cli.select_scans(metadata, sources=['FRB?21102', 'none']), [2])
+        self.assertEqual(cli.select_scans(metadata, scans=[2, 3, 4], intents=['TARGET'], sources=['FRB*']), [2])
+
+class ExtractTest(SDMTestCase):
+
+    @classmethod
+    def make_sdms(cls):
+        cls.sdm = cls.write_sdm('extract.sdm', nscans=2, nants=nants, nchans=nchans, nints=nints, irregular=True, flagfrac=0.5)
+
+    def extract(self, name, workers, **kwargs):
+        outdir = os.path.join(self.tmpdir, '%s%d' % (name, workers))
+        progress = []
+        summary = cli.extract(self.sdm, [1, 2], outdir, workers=workers, queue=2, chunk_ints=4, cachedir='',
+                              progress=lambda *args: progress.append(args), **kwargs)
+        self.assertEqual(progress[-1][:2], (summary['ints'], summary['ints']))
+        with open(os.path.join(outdir, 'extract.json')) as fp:
+            self.assertEqual(sorted(json.load(fp)['scans']), ['1', '2'])
+        return outdir, summary
+
+    def test_plain(self):
+        for workers in (1, 2):
+            outdir, summary = self.extract('plain', workers, flags='zero')
+            self.assertEqual(summary['ints'], 2*nints)
+            for scan in (1, 2):
+                expected = sdmreader.read_bdf(self.sdm, scan, cachedir='', apply_flags='zero')
+                np.testing.assert_array_equal(np.load(os.path.join(outdir, 'scan%d.npy' % scan)), expected)
+                times = [mjds for ints, mjds, data in sdmreader.iter_bdf(self.sdm, scan, chunk_ints=nints, cachedir='')][0]
+                np.testing.assert_array_equal(np.load(os.path.join(outdir, 'scan%d_times.npy' % scan)), times)
+
+    def test_averaged(self):
+        for workers in (1, 2):
+            outdir, summary = self.extract('avg', workers, tavg=2, favg=2, flags='mask', selection={'spws': [1, 0]})
+            self.assertEqual(summary['ints'], 2*(nints - nints % 2))
+            for scan in (1, 2):
+                expected = sdmreader.read_bdf(self.sdm, scan, cachedir='', tavg=2, favg=2, apply_flags=True, spws=[1, 0])
+                self.assertTrue(expected.mask.any())
+                np.testing.assert_array_equal(np.load(os.path.join(outdir, 'scan%d.npy' % scan)), expected.data)
+                np.testing.assert_array_equal(np.load(os.path.join(outdir, 'scan%d_flags.npy' % scan)), expected.mask)
+
+    def test_converted(self):
+        for workers in (1, 2):
+            outdir, summary = self.extract('conv', workers, dtype='int16', layout='planar', scale=1000.,
+                                           selection={'pols': ['RR', 'LL'], 'chans': (2, 10)})
+            for scan in (1, 2):
+                expected = sdmreader.read_bdf(self.sdm, scan, cachedir='', dtype='int16', layout='planar', scale=1000.,
+                                              pols=['RR', 'LL'], chans=(2, 10))
+                np.testing.assert_array_equal(np.load(os.path.join(outdir, 'scan%d.npy' % scan)), expected)
+
+    def test_worker_error(self):
+        # a task past the end of the bdf fails in the worker and is reported in the parent
+        job = cli._make_job(self.sdm, 1, self.tmpdir, {'tavg': 1, 'favg': 1, 'flags': 'none', 'layout': 'interleaved', 'scale': None},
+                            None, {}, None, '', sdmreader.read_metadata(self.sdm, cachedir=''))
+        cli._jobs = [job]
+        try:
+            done = []
+            self.assertRaises(RuntimeError, cli._run_pool, [(0, 0, 4), (0, 8, nints+4)], 2, 1,
+                              lambda *args: done.append(args), sdmreader.stats.Stats())
+        finally:
+            cli._jobs = None
+
+if __name__ == '__main__':
+    unittest.main()
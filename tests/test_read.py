@@ -0,0 +1,178 @@
+""" Tests of reading data, selections, flags and averages from synthetic BDFs.
+"""
+
+import numpy as np
+import os, unittest
+import sdmreader
+from tests.common import SDMTestCase, reference_data, reference_flags, open_bdf
+
+nants, nchans, nints = 5, [8, 8, 4], 12
+
+class ReadTest(SDMTestCase):
+
+    @classmethod
+    def make_sdms(cls):
+        cls.sdms = {}
+        for irregular in (False, True):
+            cls.sdms[irregular] = cls.write_sdm('read%d.sdm' % irregular, nscans=2, nants=nants, nchans=nchans,
+                                                nints=nints, irregular=irregular)
+        cls.ref = dict((scan, reference_data(nints, nants, nchans, 4, scan)) for scan in (1, 2))
+
+    def test_read_bdf(self):
+        for irregular, sdm in self.sdms.items():
+            for scan in (1, 2):
+                data = sdmreader.read_bdf(sdm, scan, cachedir='')
+                self.assertEqual(data.dtype, np.complex64)
+                np.testing.assert_array_equal(data, self.ref[scan])
+
+    def test_ranges(self):
+        sdm = self.sdms[True]
+        np.testing.assert_array_equal(sdmreader.read_bdf(sdm, 1, nskip=3, readints=5, cachedir=''), self.ref[1][3:8])
+        bdf = open_bdf(sdm, 1)
+        for i in (0, 5, nints-1):
+            np.testing.assert_array_equal(bdf.get_data('crossData.bin', i), self.ref[1][i])
+
+    def test_range_errors(self):
+        sdm = self.sdms[True]
+        for copy in (True, False):
+            self.assertRaises(ValueError, sdmreader.read_bdf, sdm, 1, nskip=8, readints=5, cachedir='', copy=copy)
+        bdf = open_bdf(sdm, 1)
+        for start, stop in ((8, 13), (-1, 3), (5, 4)):
+            self.assertRaises(ValueError, bdf.read, 'crossData.bin', start, stop)
+            self.assertRaises(ValueError, bdf.get_flags, start, stop)
+            self.assertRaises(ValueError, bdf.average, start, stop, tavg=1)
+        self.assertRaises(ValueError, sdmreader.prefetch.Prefetcher, bdf, 0, nints+5)
+        self.assertRaises(ValueError, list, sdmreader.iter_bdf(sdm, 1, nskip=10, readints=5, cachedir=''))
+
+    def test_view(self):
+        data = sdmreader.read_bdf(self.sdms[False], 1, cachedir='', copy=False)
+        self.assertFalse(data.flags.writeable)
+        np.testing.assert_array_equal(data, self.ref[1])
+
+    def test_iter_bdf(self):
+        for irregular, sdm in self.sdms.items():
+            for prefetch in (0, 2):
+                blocks = [(ints, data.copy()) for ints, mjds, data in
+                          sdmreader.iter_bdf(sdm, 2, chunk_ints=5, cachedir='', prefetch=prefetch)]
+                self.assertEqual([len(ints) for ints, data in blocks], [5, 5, 2])
+                np.testing.assert_array_equal(np.concatenate([data for ints, data in blocks]), self.ref[2])
+
+    def test_selections(self):
+        ref = self.ref[1]
+        bl = [(i, j) for j in range(nants) for i in range(j)]
+        cases = [({'spws': [2, 0]}, ref[:, :, range(16, 20) + range(0, 8)]),
+                 ({'chans': (3, 11)}, ref[:, :, 3:11]),
+                 ({'spws': [1], 'chans': [0, 2, 7]}, ref[:, :, [8, 10, 15]]),
+                 ({'ants': [0, 2, 4]}, ref[:, [k for k, (i, j) in enumerate(bl) if i in (0, 2, 4) and j in (0, 2, 4)]]),
+                 ({'bls': [6, 1, 3]}, ref[:, [6, 1, 3]]),
+                 ({'pols': ['LL', 'RR']}, ref[..., [3, 0]])]
+        for irregular, sdm in self.sdms.items():
+            for kwargs, expected in cases:
+                np.testing.assert_array_equal(sdmreader.read_bdf(sdm, 1, cachedir='', **kwargs), expected, err_msg=str(kwargs))
+
+    def test_selection_errors(self):
+        bdf = open_bdf(self.sdms[False], 1)
+        nbl = nants*(nants-1)//2
+        for kwargs, name in (({'bls': [1, nbl, -1]}, '[%d, -1]' % nbl), ({'ants': [0, nants]}, '[%d]' % nants),
+                             ({'pols': ['RR', 'XX', 7]}, "['XX', 7]"), ({'spws': [1, 3, -1]}, '[3, -1]'),
+                             ({'chans': (30, 40)}, '[30, 40]'), ({'spws': [2], 'chans': [1, 4]}, '[4]'),
+                             ({'chans': (5, 5)}, 'no channels'), ({'spws': []}, 'no channels')):
+            with self.assertRaises(ValueError) as context:
+                bdf.selection(**kwargs)
+            self.assertIn(name, str(context.exception))
+
+    def test_conversion(self):
+        ref = self.ref[1][..., [0, 3]]
+        pairs = np.stack([ref.real, ref.imag], axis=-1)
+        for irregular, sdm in self.sdms.items():
+            data = sdmreader.read_bdf(sdm, 1, cachedir='', pols=['RR', 'LL'], dtype='int16', scale=1000.)
+            np.testing.assert_array_equal(data, (pairs*1000.).astype('int16'))
+            data = sdmreader.read_bdf(sdm, 1, cachedir='', pols=['RR', 'LL'], dtype='float16', layout='planar')
+            np.testing.assert_array_equal(data, np.rollaxis(pairs, -1).astype('float16'))
+
+        # get_data converts single integrations the same way, also into a given out
+        bdf = open_bdf(self.sdms[True], 1)
+        ref = self.ref[1][4]
+        pairs = np.stack([ref.real, ref.imag], axis=-1)
+        np.testing.assert_array_equal(bdf.get_data('crossData.bin', 4, dtype='int16', scale=1000.), (pairs*1000.).astype('int16'))
+        out = np.empty((2,) + ref.shape, dtype='float32')
+        self.assertIs(bdf.get_data('crossData.bin', 4, out=out, layout='planar'), out)
+        np.testing.assert_array_equal(out, np.rollaxis(pairs, -1))
+        self.assertRaises(ValueError, bdf.get_data, 'crossData.bin', 4, out=np.empty(ref.shape, dtype='float32'))
+
+class ReadBdfsTest(SDMTestCase):
+
+    @classmethod
+    def make_sdms(cls):
+        cls.sdm = cls.write_sdm('pool.sdm', nscans=3, nants=nants, nchans=nchans, nints=nints, irregular=True)
+        cls.ref = dict((scan, reference_data(nints, nants, nchans, 4, scan)) for scan in (1, 2, 3))
+
+    def check(self, result, outdir=None):
+        self.assertEqual(sorted(result), sorted([1, (2, 3, 7), 3]))
+        np.testing.assert_array_equal(result[1], self.ref[1])
+        np.testing.assert_array_equal(result[(2, 3, 7)], self.ref[2][3:10])
+        np.testing.assert_array_equal(result[3], self.ref[3])
+        if outdir:
+            for data in result.values():
+                self.assertIsInstance(data, np.memmap)
+            np.testing.assert_array_equal(np.load(os.path.join(outdir, 'scan2_3_7.npy')), self.ref[2][3:10])
+
+    def test_workers(self):
+        for workers in (1, 3):
+            result = sdmreader.read_bdfs(self.sdm, [1, (2, 3, 7), 3], workers=workers, ints_per_task=5, cachedir='')
+            self.check(result)
+
+    def test_outdir(self):
+        for workers in (1, 3):
+            outdir = os.path.join(self.tmpdir, 'out%d' % workers)
+            result = sdmreader.read_bdfs(self.sdm, [1, (2, 3, 7), 3], workers=workers, outdir=outdir, cachedir='')
+            self.check(result, outdir)
+            self.assertEqual(sorted(os.listdir(outdir)), ['scan1.npy', 'scan2_3_7.npy', 'scan3.npy'])
+
+class FlagsTest(SDMTestCase):
+
+    def check_flags(self, spwflags):
+        sdm = self.write_sdm('flags%d.sdm' % spwflags, nscans=1, nants=nants, nchans=nchans, nints=nints,
+                             spwflags=spwflags, flagfrac=0.2)
+        cross, autos = reference_flags(nints, nants, nchans, 4, 1, spwflags=spwflags, flagfrac=0.2)
+        bdf = open_bdf(sdm, 1)
+        np.testing.assert_array_equal(bdf.get_flags(0, nints), cross)
+        np.testing.assert_array_equal(bdf.get_flags(0, nints, autos=True), autos)
+
+        sel = bdf.selection(spws=[2, 1], pols=['LL'])
+        np.testing.assert_array_equal(bdf.get_flags(2, 9, sel=sel), cross[2:9][:, :, range(16, 20) + range(8, 16)][..., [3]])
+
+        data = sdmreader.read_bdf(sdm, 1, cachedir='', apply_flags=True)
+        np.testing.assert_array_equal(data.mask, cross)
+        data = sdmreader.read_bdf(sdm, 1, cachedir='', apply_flags='zero')
+        self.assertTrue((data[cross] == 0).all())
+        np.testing.assert_array_equal(data[~cross], reference_data(nints, nants, nchans, 4, 1)[~cross])
+
+    def test_channel_flags(self):
+        self.check_flags(False)
+
+    def test_spw_flags(self):
+        self.check_flags(True)
+
+class AverageTest(SDMTestCase):
+
+    def test_average(self):
+        sdm = self.write_sdm('avg.sdm', nscans=1, nants=nants, nchans=nchans, nints=nints, irregular=True, flagfrac=0.3)
+        ref = reference_data(nints, nants, nchans, 4, 1)
+        cross, autos = reference_flags(nints, nants, nchans, 4, 1, flagfrac=0.3)
+
+        # 12 ints in bins of 5 and 20 chans in bins of 3 leave out partial bins
+        expected = ref[:10, :, :18].reshape(2, 5, -1, 6, 3, 4).mean(axis=(1, 4))
+        data = sdmreader.read_bdf(sdm, 1, cachedir='', tavg=5, favg=3)
+        self.assertEqual(data.shape, expected.shape)
+        np.testing.assert_allclose(data, expected, rtol=1e-5, atol=1e-6)
+
+        masked = np.ma.masked_array(ref, mask=cross)[:10, :, :18].reshape(2, 5, -1, 6, 3, 4)
+        expected = masked.sum(axis=(1, 4))/np.maximum(masked.count(axis=(1, 4)), 1)
+        weights = 15 - cross[:10, :, :18].reshape(2, 5, -1, 6, 3, 4).sum(axis=(1, 4))
+        data, w = open_bdf(sdm, 1).average(0, nints, tavg=5, favg=3, flags=True)
+        np.testing.assert_array_equal(w, weights)
+        np.testing.assert_allclose(data, expected.filled(0), rtol=1e-5, atol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+""" Tests of shard plans and the chunked store.
+"""
+
+import numpy as np
+import os, json, unittest
+import sdmreader, sdmreader.store
+from tests.common import SDMTestCase, reference_data, reference_flags, remove_times, open_bdf
+
+nants, nchans, nints = 5, [8, 8, 4], 13
+
+class ShardTest(SDMTestCase):
+
+    @classmethod
+    def make_sdms(cls):
+        cls.sdm = cls.write_sdm('shard.sdm', nscans=2, nants=nants, nchans=nchans, nints=nints, irregular=True, flagfrac=0.2)
+
+    def test_json_round_trip(self):
+        ref = reference_data(nints, nants, nchans, 4, 2)
+        cross, autos = reference_flags(nints, nants, nchans, 4, 2, flagfrac=0.2)
+        plan = json.loads(json.dumps(sdmreader.plan_shards(self.sdm, 2, 4, cachedir='')))
+        self.assertEqual([(shard['start'], shard['stop']) for shard in plan], [(0, 3), (3, 6), (6, 9), (9, 13)])
+
+        with sdmreader.stats.collect() as stats:
+            data = np.concatenate([sdmreader.read_shard(shard) for shard in plan])
+        self.assertNotIn('bdf_scan', stats.times)
+        np.testing.assert_array_equal(data, ref)
+
+        data = np.ma.concatenate([sdmreader.read_shard(shard, apply_flags=True, spws=[2]) for shard in plan])
+        np.testing.assert_array_equal(data.data, ref[:, :, 16:])
+        np.testing.assert_array_equal(data.mask, cross[:, :, 16:])
+
+        bdf = sdmreader.open_shard(plan[2])
+        np.testing.assert_array_equal(bdf.times, open_bdf(self.sdm, 2).times[6:9])
+        sub = json.loads(json.dumps(bdf.shard(1, 3)))
+        self.assertEqual((sub['start'], sub['stop']), (7, 9))
+        np.testing.assert_array_equal(sdmreader.read_shard(sub), ref[7:9])
+
+class StoreTest(SDMTestCase):
+
+    @classmethod
+    def make_sdms(cls):
+        cls.sdm = cls.write_sdm('store.sdm', nscans=2, nants=nants, nchans=nchans, nints=nints, flagfrac=0.2)
+
+    def test_round_trip(self):
+        outdir = os.path.join(self.tmpdir, 'store')
+        store = sdmreader.store.convert(self.sdm, outdir, chunk_ints=5, workers=1, cachedir='')
+        store = sdmreader.store.Store(outdir)
+        self.assertEqual(sorted(store.scans), [1, 2])
+
+        for scan in (1, 2):
+            ref = reference_data(nints, nants, nchans, 4, scan)
+            cross, autos = reference_flags(nints, nants, nchans, 4, scan, flagfrac=0.2)
+            np.testing.assert_array_equal(store.read(scan), ref)
+            np.testing.assert_array_equal(store.read(scan, kind='flags'), cross)
+            np.testing.assert_array_equal(store.read(scan, 3, 11, spws=[2, 0]), ref[3:11][:, :, range(16, 20) + range(8)])
+            np.testing.assert_array_equal(store.times(scan), open_bdf(self.sdm, scan).times)
+
+        view = store.read(1, 5, 9, spws=[1])
+        self.assertIsInstance(view, np.memmap)
+        np.testing.assert_array_equal(view, reference_data(nints, nants, nchans, 4, 1)[5:9, :, 8:16])
+
+    def test_missing_times(self):
+        sdm = self.write_sdm('notimes.sdm', nscans=1, nants=nants, nchans=nchans, nints=nints)
+        remove_times(sdm, 1)
+        outdir = os.path.join(self.tmpdir, 'notimes')
+        sdmreader.store.convert(sdm, outdir, workers=1, cachedir='')
+        store = sdmreader.store.Store(outdir)
+        metadata = sdmreader.read_metadata(sdm, cachedir='')
+        mjds = sdmreader.sdmreader._int_times(open_bdf(sdm, 1), metadata[0][1])
+        self.assertTrue(np.isfinite(mjds).all())
+        np.testing.assert_array_equal(store.times(1), mjds)
+        np.testing.assert_array_equal(store.uvw(1), sdmreader.calc_uvw_scan(sdm, 1, mjds=mjds, metadata=metadata, cachedir=''))
+
+if __name__ == '__main__':
+    unittest.main()
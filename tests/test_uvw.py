@@ -0,0 +1,138 @@
+""" Tests of uvw calculation without CASA.
+"""
+
+import numpy as np
+import sys, types, unittest
+import sdmreader
+from sdmreader import sdmreader as reader
+from tests.common import SDMTestCase, remove_times
+
+# (mjd, ra, dec) and rotation taking ITRF baselines to J2000 uvw from ERFA c2t06a (no polar motion, ut1 = tt = utc)
+erfa_reference = [
+    ((57000.5, 1.0, 0.5),
+     [[-0.352911352639, -0.935655921489, -0.00125449662], [0.4488032309, -0.170456067292, 0.877223112473],
+      [-0.820992836212, 0.309018973053, 0.480081281849]]),
+    ((58849.25, 4.2, -0.6),
+     [[-0.771959220576, 0.635669856583, 0.001671885152], [0.360476961374, 0.435594863768, 0.824811175347],
+      [0.523579336956, 0.637323268122, -0.565405809859]]),
+    ((55197.9, 0.1, 1.3),
+     [[0.862221854319, 0.50653081472, -8.7600056e-05], [-0.488187048101, 0.831043004929, 0.266535044648],
+      [0.135081012731, -0.229769575225, 0.963825223939]]),
+]
+
+class RotationTest(unittest.TestCase):
+
+    def test_erfa(self):
+        for (mjd, ra, dec), expected in erfa_reference:
+            rot = reader._uvw_rotation(np.array([mjd]), ra, dec)
+            np.testing.assert_allclose(rot[0], expected, atol=1e-6, err_msg=str(mjd))
+
+    def test_orthogonal(self):
+        rot = reader._uvw_rotation(np.linspace(57000, 57001, 5), 2., 0.3)
+        np.testing.assert_allclose(np.einsum('tij,tkj->tik', rot, rot), np.tile(np.eye(3), (5, 1, 1)), atol=1e-12)
+
+class UVWScanTest(SDMTestCase):
+
+    def test_calc_uvw_scan(self):
+        nants = 4
+        sdm = self.write_sdm('uvw.sdm', nscans=2, nants=nants, nints=6)
+        metadata = sdmreader.read_metadata(sdm, cachedir='')
+        uvw = sdmreader.calc_uvw_scan(sdm, 2, metadata=metadata, cachedir='')
+        self.assertEqual(uvw.shape, (6, nants*(nants-1)//2, 3))
+
+        # baseline (i, j) is position of j minus i, rotated
+        scans, sources = metadata
+        source = [src for src in sources.values() if src['source'] == scans[2]['source']][0]
+        positions = reader._uvw_session(sdm).positions(2)
+        times = reader._open_bdf(sdm, 2, cachedir='', metadata=metadata)[1].times
+        rot = reader._uvw_rotation(times, source['ra'], source['dec'])
+        np.testing.assert_allclose(uvw[:, 2], np.einsum('tij,j->ti', rot, positions[2] - positions[1]))
+        np.testing.assert_allclose(np.linalg.norm(uvw, axis=2)[:, 0], np.linalg.norm(positions[1] - positions[0]))
+
+    def test_missing_times(self):
+        sdm = self.write_sdm('notimes.sdm', nscans=1, nants=4, nints=6)
+        remove_times(sdm, 1)
+        metadata = sdmreader.read_metadata(sdm, cachedir='')
+        bdf = reader._open_bdf(sdm, 1, cachedir='', metadata=metadata)[1]
+        self.assertTrue(np.isnan(bdf.times).all())
+
+        # integrations evenly fill the scan
+        mjds = reader._int_times(bdf, metadata[0][1])
+        uvw = sdmreader.calc_uvw_scan(sdm, 1, metadata=metadata, cachedir='')
+        self.assertTrue(np.isfinite(uvw).all())
+        np.testing.assert_array_equal(uvw, sdmreader.calc_uvw_scan(sdm, 1, mjds=mjds, metadata=metadata, cachedir=''))
+
+class FakeMeasures(object):
+    """ Stands in for the CASA measures tool in calc_uvw, with zero uvw for every baseline.
+    """
+
+    def __init__(self):
+        self.frames = []
+
+    def doframe(self, frame):
+        self.frames.append(frame)
+
+    def observatory(self, name):
+        return ('observatory', name)
+
+    def epoch(self, ref, time):
+        return ('epoch', time)
+
+    def direction(self, ref, ra, dec):
+        return ('direction', ra, dec)
+
+    def position(self, ref, x, y, z):
+        return len(x)
+
+    def asbaseline(self, nants):
+        return nants
+
+    def touvw(self, nants):
+        return (nants,)
+
+    def expand(self, nants):
+        return (True, {'value': np.zeros(3*nants*(nants-1)//2)})
+
+class FakeQuanta(object):
+
+    def quantity(self, value, unit):
+        return value
+
+    def time(self, value, form=None, prec=None):
+        return ['%.6f' % value]
+
+class CalcUVWTest(SDMTestCase):
+    """ calc_uvw with CASA tools faked, for the handling of metadata and sessions.
+    """
+
+    def setUp(self):
+        measures = FakeMeasures()
+        casautil = types.ModuleType('casautil')
+        casautil.tools = types.ModuleType('tools')
+        casautil.tools.measures = lambda: measures
+        casautil.tools.quanta = FakeQuanta
+        self.measures = measures
+        self.saved = sys.modules.get('casautil')
+        sys.modules['casautil'] = casautil
+        reader._uvwsessions.clear()
+
+    def tearDown(self):
+        if self.saved is None:
+            del sys.modules['casautil']
+        else:
+            sys.modules['casautil'] = self.saved
+        reader._uvwsessions.clear()
+
+    def test_metadata_per_call(self):
+        nants = 4
+        sdm = self.write_sdm('calcuvw.sdm', nscans=3, nants=nants, nints=2)
+        u, v, w = sdmreader.calc_uvw(sdm, 3, metadata=sdmreader.read_metadata(sdm, 3, cachedir=''))
+        self.assertEqual(len(u), nants*(nants-1)//2)
+
+        # metadata of scan 3 only is not kept for later calls
+        u, v, w = sdmreader.calc_uvw(sdm, 2)
+        scans, sources = sdmreader.read_metadata(sdm)
+        self.assertEqual(self.measures.frames[-2], ('epoch', '%.6f' % scans[2]['startmjd']))
+
+if __name__ == '__main__':
+    unittest.main()